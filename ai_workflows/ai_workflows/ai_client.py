@@ -0,0 +1,349 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+
+import frappe
+import httpx
+from frappe.utils.password import get_decrypted_password
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    DefaultHttpxClient,
+    OpenAI,
+)
+
+from ai_workflows.ai_workflows.rate_limit import RateLimiter
+from ai_workflows.ai_workflows.tokens import get_usage
+from ai_workflows.ai_workflows.tracing import get_tracer
+
+# Redis hash holding a version stamp per AI record, bumped whenever an AI is saved
+CLIENT_VERSION_KEY = "ai_workflows_client_version"
+# Field of CLIENT_VERSION_KEY bumped when AI Settings (shared endpoint and key) change
+SETTINGS_VERSION_FIELD = "AI Settings"
+
+# Values of AI.interface
+OPENAI_INTERFACE = "openAI"
+OPENAI_COMPATIBLE_INTERFACE = "OpenAI Compatible"
+INTERFACES = (OPENAI_INTERFACE, OPENAI_COMPATIBLE_INTERFACE)
+
+# Parallel requests when the AI leaves max_concurrency empty. Self-hosted servers
+# batch concurrent requests on the GPU, so they are fed more at once.
+DEFAULT_CONCURRENCY = {OPENAI_INTERFACE: 4, OPENAI_COMPATIBLE_INTERFACE: 16}
+
+# Self-hosted servers often run without authentication, the client still needs a key
+NO_API_KEY = "not-needed"
+
+# Request fields sent as extra_body, e.g. prompt_cache_key
+EXTRA_BODY_FIELDS = ("prompt_cache_key",)
+
+# Connection pool settings for the shared HTTP client
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 120
+
+# Retry defaults when the AI record leaves them empty
+DEFAULT_BACKOFF_BASE = 1
+DEFAULT_BACKOFF_MAX = 30
+
+# Hedging uses the recent p95 latency once this many samples exist
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200
+
+# Per-worker registry: (site, ai_name) -> (version, client)
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Per-worker latency samples: (site, ai_name) -> recent latencies in seconds
+_latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+
+
+def get_openai_client(ai_name):
+    """
+    Returns a cached OpenAI client for the given AI record.
+
+    Clients are kept per worker process so the HTTP connection pool (and its
+    keep-alive connections) and the decrypted API key are reused across calls.
+    """
+    key = (frappe.local.site, ai_name)
+    version = (
+        frappe.cache().hget(CLIENT_VERSION_KEY, ai_name),
+        frappe.cache().hget(CLIENT_VERSION_KEY, SETTINGS_VERSION_FIELD),
+    )
+
+    with _clients_lock:
+        cached = _clients.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+
+    client = build_openai_client(ai_name)
+    with _clients_lock:
+        _clients[key] = (version, client)
+    return client
+
+
+class Backend:
+    """
+    Where the chat completions of an AI record go: OpenAI itself or any
+    OpenAI-compatible server (vLLM, llama.cpp, ...). Compatible AIs without an
+    endpoint or API key use the ones from AI Settings.
+    """
+
+    def __init__(self, ai_name):
+        ai = frappe.get_cached_value(
+            "AI", ai_name, ["interface", "endpoint", "max_concurrency"], as_dict=True
+        )
+        if not ai:
+            frappe.throw(f"AI {ai_name} not found")
+        self.ai_name = ai_name
+        self.interface = ai.interface or OPENAI_INTERFACE
+        if self.interface not in INTERFACES:
+            frappe.throw(f"Interface {self.interface} of AI {ai_name} is not supported")
+        self.endpoint = ai.endpoint
+        if self.is_compatible and not self.endpoint:
+            self.endpoint = frappe.db.get_single_value("AI Settings", "open_ai_compatible_endpoint")
+            if not self.endpoint:
+                frappe.throw(
+                    f"AI {ai_name} needs an endpoint, or AI Settings an Open AI Compatible Endpoint"
+                )
+        self.concurrency = ai.max_concurrency or DEFAULT_CONCURRENCY[self.interface]
+
+    @property
+    def is_compatible(self):
+        return self.interface == OPENAI_COMPATIBLE_INTERFACE
+
+    @property
+    def supports_batch_api(self):
+        # Only OpenAI offers the asynchronous Batch API
+        return not self.is_compatible
+
+    def get_api_key(self):
+        api_key = get_decrypted_password(
+            doctype="AI", name=self.ai_name, fieldname="api_key", raise_exception=False
+        )
+        if self.is_compatible and not api_key:
+            api_key = get_decrypted_password(
+                doctype="AI Settings", name="AI Settings", fieldname="api_key", raise_exception=False
+            )
+            return api_key or NO_API_KEY
+        return api_key
+
+
+def get_backend(ai_name):
+    return Backend(ai_name)
+
+
+class RetryPolicy:
+    """
+    Retry settings of an AI record: attempts, exponential backoff with full
+    jitter, per-request timeout, retryable status codes and hedging.
+    """
+
+    def __init__(self, ai_name):
+        settings = frappe.get_cached_value(
+            "AI",
+            ai_name,
+            [
+                "retry_max_attempts",
+                "retry_backoff_base",
+                "retry_backoff_max",
+                "request_timeout",
+                "retryable_status_codes",
+                "enable_hedged_requests",
+                "hedge_delay",
+            ],
+            as_dict=True,
+        )
+        self.max_attempts = max(settings.retry_max_attempts or 1, 1)
+        self.backoff_base = settings.retry_backoff_base or DEFAULT_BACKOFF_BASE
+        self.backoff_max = settings.retry_backoff_max or DEFAULT_BACKOFF_MAX
+        self.timeout = settings.request_timeout or None
+        self.retryable_status_codes = {
+            int(code)
+            for code in (settings.retryable_status_codes or "").replace(" ", "").split(",")
+            if code.isdigit()
+        }
+        self.hedge = bool(settings.enable_hedged_requests)
+        self.hedge_delay = settings.hedge_delay or 0
+
+    def is_retryable(self, error):
+        if isinstance(error, (APITimeoutError, APIConnectionError)):
+            return True
+        if isinstance(error, APIStatusError):
+            return error.status_code in self.retryable_status_codes
+        return False
+
+    def get_backoff(self, attempt, error=None):
+        # Honour Retry-After from the provider, otherwise full jitter
+        retry_after = None
+        if isinstance(error, APIStatusError):
+            retry_after = error.response.headers.get("retry-after")
+        try:
+            if retry_after:
+                return min(float(retry_after), self.backoff_max)
+        except ValueError:
+            pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+
+class ChatCompletions:
+    """
+    Chat completion calls for one AI record, governed by its rate limiter and
+    retry policy.
+
+    Create it on a frappe thread; create() is safe to call from worker threads.
+    """
+
+    def __init__(self, ai_name):
+        self.ai_name = ai_name
+        self.rate_limiter = RateLimiter(ai_name)
+        self.retry_policy = RetryPolicy(ai_name)
+        # Retries are handled here, so the client must not retry on its own
+        options = {"max_retries": 0}
+        if self.retry_policy.timeout:
+            options["timeout"] = self.retry_policy.timeout
+        self.client = get_openai_client(ai_name).with_options(**options)
+        self.latencies = _latencies[(frappe.local.site, ai_name)]
+        # Trace of the calling frappe thread, requests from worker threads count too
+        self.tracer = get_tracer()
+
+    def create(self, hedge=False, **request):
+        """
+        Sends a chat completion with retries. With hedge=True and hedging
+        enabled on the AI, a second request is fired once the first one is
+        slower than the recent p95 latency and the faster answer wins.
+        """
+        hedge_delay = self.get_hedge_delay() if hedge and self.retry_policy.hedge else None
+        if not hedge_delay:
+            return self.create_with_retry(request)
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            futures = [executor.submit(self.create_with_retry, request)]
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                futures.append(executor.submit(self.create_with_retry, request))
+
+            error = None
+            while futures:
+                done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+                futures = list(pending)
+            raise error
+        finally:
+            # The slower request is left to finish in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stream(self, on_update=None, **request):
+        """
+        Streams a chat completion and returns the full answer text (function
+        call arguments or message content), the token usage and the finish
+        reason. on_update is called with the text received so far. Retries
+        only cover opening the stream, the rate limit covers reading it too.
+        """
+        parts = []
+        usage = {}
+        finish_reason = None
+        started = time.monotonic()
+        request = dict(request, stream=True, stream_options={"include_usage": True})
+        with self.rate_limiter.limit(request):
+            for chunk in self.create_with_retry(request, rate_limit=False):
+                # The final chunk carries the usage and no choices
+                usage = get_usage(chunk) or usage
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta
+                if delta.function_call and delta.function_call.arguments:
+                    parts.append(delta.function_call.arguments)
+                elif delta.content:
+                    parts.append(delta.content)
+                else:
+                    continue
+                if on_update:
+                    on_update("".join(parts))
+        if self.tracer:
+            self.tracer.add_llm_request(time.monotonic() - started)
+        return "".join(parts), usage, finish_reason
+
+    def create_with_retry(self, request, rate_limit=True):
+        # rate_limit=False when the caller already holds the limiter
+        attempt = 0
+        while True:
+            try:
+                with self.rate_limiter.limit(request) if rate_limit else nullcontext():
+                    started = time.monotonic()
+                    response = self.client.chat.completions.create(**get_sdk_arguments(request))
+                # Time to first byte of a stream says nothing about completion latency
+                if not request.get("stream"):
+                    self.latencies.append(time.monotonic() - started)
+                    if self.tracer:
+                        self.tracer.add_llm_request(time.monotonic() - started)
+                return response
+            except Exception as e:
+                attempt += 1
+                if attempt >= self.retry_policy.max_attempts or not self.retry_policy.is_retryable(e):
+                    raise
+                time.sleep(self.retry_policy.get_backoff(attempt, e))
+
+    def get_hedge_delay(self):
+        # p95 of recent latencies, the configured delay until enough samples exist
+        samples = sorted(self.latencies)
+        if len(samples) >= HEDGE_MIN_SAMPLES:
+            return samples[int(len(samples) * 0.95) - 1]
+        return self.retry_policy.hedge_delay
+
+
+def get_sdk_arguments(request):
+    # Request fields older openai versions do not accept as argument go in the body
+    extra = {key: request[key] for key in EXTRA_BODY_FIELDS if key in request}
+    if not extra:
+        return request
+    arguments = {key: value for key, value in request.items() if key not in extra}
+    arguments["extra_body"] = {**(request.get("extra_body") or {}), **extra}
+    return arguments
+
+
+def get_chat_completions(ai_name):
+    return ChatCompletions(ai_name)
+
+
+def build_openai_client(ai_name):
+    # Client for the AI's backend, with a pool large enough for its concurrency
+    backend = get_backend(ai_name)
+    return OpenAI(
+        api_key=backend.get_api_key(),
+        base_url=backend.endpoint or None,
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=max(MAX_CONNECTIONS, backend.concurrency),
+                max_keepalive_connections=max(MAX_KEEPALIVE_CONNECTIONS, backend.concurrency),
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            )
+        ),
+    )
+
+
+def clear_client_cache(doc, method=None):
+    """
+    Drops cached clients for an AI record, or all of them when AI Settings
+    change. Hooked to AI on_update / on_trash and AI Settings on_update.
+    """
+    with _clients_lock:
+        if doc.doctype == "AI Settings":
+            for key in [key for key in _clients if key[0] == frappe.local.site]:
+                del _clients[key]
+        else:
+            _clients.pop((frappe.local.site, doc.name), None)
+    # Bump version so other workers rebuild their client on next use
+    field = SETTINGS_VERSION_FIELD if doc.doctype == "AI Settings" else doc.name
+    frappe.cache().hset(CLIENT_VERSION_KEY, field, frappe.generate_hash(length=10))
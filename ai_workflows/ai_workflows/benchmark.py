@@ -0,0 +1,407 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""
+End-to-end benchmark of the extraction pipeline against the stub server:
+synthetic invoices go through use_openai, create_supplier and
+create_purchase_invoice, and every stage reports throughput, latency
+percentiles and database queries per call, overall and per line count.
+
+    bench --site test_site execute ai_workflows.ai_workflows.benchmark.run_benchmark \\
+        --kwargs '{"sizes": [1, 50, 500], "delay": 0.2, "jitter": 0.1, "output": "bench.json"}'
+
+Creates Paperless Documents, Suppliers, Items and Purchase Invoices and
+commits them, so it only runs on sites with allow_tests. The site needs
+ERPNext set up with a default company, and a payment term for PAYMENT_METHOD
+in the AI Workflow Purchase Invoice Settings (or a fallback payment term).
+"""
+
+import json
+import random
+import re
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import add_days, now_datetime, today
+from openai import APIStatusError
+
+from ai_workflows.ai_workflows.doctype.ai_query import ai_query
+from ai_workflows.ai_workflows.schema_validation import JSON_SCHEMA_MODE
+from ai_workflows.ai_workflows.stub_server import StubOpenAIServer
+from ai_workflows.ai_workflows.tracing import QueryCounter, percentile
+from ai_workflows.ai_workflows.workflow_steps import get_ai_query_json
+
+STAGES = ("use_openai", "create_supplier", "create_purchase_invoice")
+DEFAULT_SIZES = (1, 5, 20, 100, 500)
+DEFAULT_DOCUMENTS_PER_SIZE = 5
+
+BENCHMARK_CAPTION = "Benchmark"
+PAYMENT_METHOD = "Bank Transfer"
+# Invoices of the corpus are spread over this many suppliers, each with an
+# item catalog, so lookups hit existing and new records alike
+SUPPLIER_COUNT = 10
+CATALOG_SIZE = 1000
+# Error messages kept per stage
+MAX_REPORTED_ERRORS = 5
+# Injected errors use ERROR_STATUS, which the benchmark AI retries
+ERROR_STATUS = 503
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+INVOICE_NUMBER = re.compile(r"Invoice number: (\S+)")
+
+INVOICE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "InvoiceDetails": {
+            "type": "object",
+            "properties": {
+                "InvoiceNumber": {"type": "string"},
+                "InvoiceDate": {"type": "string"},
+                "SupplierName": {"type": "string"},
+                "SupplierUstId": {"type": "string"},
+                "SupplierContactPerson": {"type": "string"},
+                "SupplierContactEmail": {"type": "string"},
+                "SupplierAddress": {
+                    "type": "object",
+                    "properties": {
+                        "Street": {"type": "string"},
+                        "City": {"type": "string"},
+                        "PostalCode": {"type": "string"},
+                        "Country": {"type": "string"},
+                    },
+                    "required": ["Street", "City", "PostalCode", "Country"],
+                },
+                "NetTotal": {"type": "number"},
+            },
+            "required": ["InvoiceNumber", "InvoiceDate", "SupplierName", "SupplierAddress"],
+        },
+        "ItemsPurchased": {
+            "type": "object",
+            "properties": {
+                "ItemList": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "ItemNumber": {"type": "string"},
+                            "ItemName": {"type": "string"},
+                            "Description": {"type": "string"},
+                            "Quantity": {"type": "number"},
+                            "UnitPrice": {"type": "number"},
+                            "Total": {"type": "number"},
+                        },
+                        "required": ["ItemNumber", "ItemName", "Description", "Quantity", "UnitPrice", "Total"],
+                    },
+                }
+            },
+            "required": ["ItemList"],
+        },
+        "PaymentInformation": {
+            "type": "object",
+            "properties": {
+                "PaymentMethod": {"type": "string"},
+                "PaymentDueDate": {"type": "string"},
+            },
+        },
+    },
+    "required": ["InvoiceDetails", "ItemsPurchased"],
+}
+
+
+def generate_invoices(sizes=DEFAULT_SIZES, documents_per_size=DEFAULT_DOCUMENTS_PER_SIZE, seed=0):
+    """
+    Synthetic invoices with the given numbers of lines, each a dict with the
+    fulltext a Paperless Document would hold and the answer a model should
+    extract from it.
+    """
+    rng = random.Random(seed)
+    run_id = frappe.generate_hash(length=6).upper()
+    invoices = []
+    for size in sizes:
+        for i in range(documents_per_size):
+            supplier = rng.randrange(SUPPLIER_COUNT)
+            invoice_number = f"BENCH-{run_id}-{size}-{i}"
+            lines = []
+            for _ in range(size):
+                item = rng.randrange(CATALOG_SIZE)
+                quantity = rng.randint(1, 20)
+                unit_price = round(rng.uniform(0.5, 500), 2)
+                discount = rng.choice((0, 0, 0, 0.05, 0.1))
+                lines.append(
+                    {
+                        "ItemNumber": f"S{supplier}-{item:04d}",
+                        "ItemName": f"Article {item}",
+                        "Description": f"Article {item} of supplier {supplier}",
+                        "Quantity": quantity,
+                        "UnitPrice": unit_price,
+                        "Total": round(quantity * unit_price * (1 - discount), 2),
+                    }
+                )
+            invoice_date = add_days(today(), -rng.randint(0, 60))
+            answer = {
+                "InvoiceDetails": {
+                    "InvoiceNumber": invoice_number,
+                    "InvoiceDate": str(invoice_date),
+                    "SupplierName": f"Benchmark Supplier {supplier}",
+                    "SupplierUstId": f"DE{100000000 + supplier}",
+                    "SupplierContactPerson": f"Contact {supplier}",
+                    "SupplierContactEmail": f"billing{supplier}@supplier.example.com",
+                    "SupplierAddress": {
+                        "Street": f"Example Street {supplier + 1}",
+                        "City": "Berlin",
+                        "PostalCode": f"{10115 + supplier}",
+                        "Country": "DE",
+                    },
+                    "NetTotal": round(sum(line["Total"] for line in lines), 2),
+                },
+                "ItemsPurchased": {"ItemList": lines},
+                "PaymentInformation": {
+                    "PaymentMethod": PAYMENT_METHOD,
+                    "PaymentDueDate": str(add_days(invoice_date, 14)),
+                },
+            }
+            invoices.append(
+                frappe._dict(lines=size, fulltext=render_fulltext(answer), answer=answer)
+            )
+    return invoices
+
+
+def render_fulltext(answer):
+    # Roughly what OCR of the invoice would return
+    details = answer["InvoiceDetails"]
+    address = details["SupplierAddress"]
+    text = [
+        details["SupplierName"],
+        address["Street"],
+        f"{address['PostalCode']} {address['City']}",
+        f"VAT ID {details['SupplierUstId']}",
+        "",
+        f"Invoice number: {details['InvoiceNumber']}",
+        f"Invoice date: {details['InvoiceDate']}",
+        "",
+        "Pos  Item no.  Description  Qty  Unit price  Total",
+    ]
+    for i, line in enumerate(answer["ItemsPurchased"]["ItemList"], 1):
+        text.append(
+            f"{i}  {line['ItemNumber']}  {line['Description']}  {line['Quantity']}"
+            f"  {line['UnitPrice']:.2f}  {line['Total']:.2f}"
+        )
+    text += [
+        "",
+        f"Net total {details['NetTotal']:.2f} EUR",
+        f"Payment: {answer['PaymentInformation']['PaymentMethod']}"
+        f" until {answer['PaymentInformation']['PaymentDueDate']}",
+    ]
+    return "\n".join(text)
+
+
+def get_answerer(invoices):
+    # Stub server answer: the extraction of the invoice named in the prompt
+    answers = {invoice.answer["InvoiceDetails"]["InvoiceNumber"]: invoice.answer for invoice in invoices}
+
+    def answer(request):
+        match = INVOICE_NUMBER.search(request["messages"][-1]["content"])
+        return json.dumps(answers.get(match.group(1), {}) if match else {})
+
+    return answer
+
+
+class StageTimer:
+    # Latencies and query counts of one stage, grouped by invoice lines
+    def __init__(self):
+        self.samples = []
+        self.errors = []
+        self.failed = 0
+
+    @contextmanager
+    def measure(self, lines):
+        started = time.perf_counter()
+        try:
+            with QueryCounter() as queries:
+                yield
+        except Exception as e:
+            frappe.db.rollback()
+            self.failed += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append(str(e) or type(e).__name__)
+            raise
+        self.samples.append((lines, time.perf_counter() - started, queries.count))
+
+    def get_results(self):
+        results = summarize(self.samples)
+        results["failed"] = self.failed
+        results["errors"] = self.errors
+        results["by_lines"] = {
+            str(lines): summarize([sample for sample in self.samples if sample[0] == lines])
+            for lines in sorted({sample[0] for sample in self.samples})
+        }
+        return results
+
+
+def summarize(samples):
+    latencies = sorted(sample[1] for sample in samples)
+    queries = sorted(sample[2] for sample in samples)
+    total_time = sum(latencies)
+    return {
+        "count": len(samples),
+        "throughput_per_second": round(len(samples) / total_time, 3) if total_time else None,
+        "latency_ms": {
+            "mean": round(total_time / len(latencies) * 1000, 2) if latencies else None,
+            "p50": to_ms(percentile(latencies, 50)),
+            "p95": to_ms(percentile(latencies, 95)),
+            "p99": to_ms(percentile(latencies, 99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+        "queries": {
+            "mean": round(sum(queries) / len(queries), 1) if queries else None,
+            "p50": percentile(queries, 50),
+            "p95": percentile(queries, 95),
+            "max": queries[-1] if queries else None,
+        },
+    }
+
+
+def get_token_usage(ai_name, started):
+    # Prompt tokens of the run and the share the prompt cache served
+    usage = frappe.get_all(
+        "AI Query",
+        filters={"ai": ai_name, "creation": [">=", started]},
+        fields=["sum(prompt_tokens) as prompt_tokens", "sum(cached_tokens) as cached_tokens"],
+    )[0]
+    prompt_tokens = usage.prompt_tokens or 0
+    cached_tokens = usage.cached_tokens or 0
+    return {
+        "prompt": prompt_tokens,
+        "cached": cached_tokens,
+        "cached_share": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else None,
+    }
+
+
+def to_ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def get_benchmark_records(endpoint):
+    # AI and AI Prompt of the benchmark, pointed at the stub server of this run
+    ai_name = frappe.db.get_value("AI", {"caption": BENCHMARK_CAPTION})
+    ai = frappe.get_doc("AI", ai_name) if ai_name else frappe.new_doc("AI")
+    ai.update(
+        {
+            "caption": BENCHMARK_CAPTION,
+            "interface": "OpenAI Compatible",
+            "endpoint": endpoint,
+            "default_model": "benchmark",
+            "stream_responses": 0,
+            "retry_max_attempts": 5,
+            "retry_backoff_base": 0.05,
+            "retry_backoff_max": 1,
+            "retryable_status_codes": ",".join(str(code) for code in RETRYABLE_STATUS_CODES),
+        }
+    )
+    ai.save()
+
+    prompt_name = frappe.db.get_value("AI Prompt", {"caption": BENCHMARK_CAPTION})
+    prompt = frappe.get_doc("AI Prompt", prompt_name) if prompt_name else frappe.new_doc("AI Prompt")
+    prompt.update(
+        {
+            "caption": BENCHMARK_CAPTION,
+            "ai": ai.name,
+            "for_doctype": "Purchase Invoice",
+            "ai_output_mode": JSON_SCHEMA_MODE,
+            "long_text_fnbe": "Extract the invoice details, the purchased items and the payment information.",
+            "json_scema": json.dumps(INVOICE_SCHEMA, indent=2),
+            "max_repair_attempts": 0,
+        }
+    )
+    prompt.save()
+    frappe.db.commit()
+    return ai.name, prompt.name
+
+
+def run_benchmark(
+    sizes=DEFAULT_SIZES,
+    documents_per_size=DEFAULT_DOCUMENTS_PER_SIZE,
+    delay=0.1,
+    jitter=0.05,
+    error_rate=0,
+    seed=0,
+    output=None,
+):
+    """
+    Runs every synthetic invoice through the three stages in turn and returns
+    the results, also written to output as JSON when given. Stages of an
+    invoice whose previous stage failed are skipped. Injected LLM errors are
+    retried by the AI's retry policy, the results count the errors that were
+    retried and the requests that still failed after all attempts.
+    """
+    if not frappe.conf.allow_tests:
+        frappe.throw("The benchmark writes test data, enable allow_tests for this site first.")
+    if not frappe.db.exists("DocType", "Paperless Document"):
+        frappe.throw("The benchmark needs frappe_goes_paperless.")
+
+    invoices = generate_invoices(sizes, documents_per_size, seed)
+    timers = {stage: StageTimer() for stage in STAGES}
+    server = StubOpenAIServer(
+        get_answerer(invoices),
+        delay,
+        jitter=jitter,
+        error_rate=error_rate,
+        error_status=ERROR_STATUS,
+        seed=seed,
+    )
+    # use_openai calls given up on after the last retry
+    failed_llm_requests = 0
+    started = now_datetime()
+    with server:
+        ai_name, prompt_name = get_benchmark_records(server.url)
+        for invoice in invoices:
+            paperless_doc = frappe.get_doc(
+                {"doctype": "Paperless Document", "document_fulltext": invoice.fulltext}
+            ).insert(ignore_permissions=True)
+            frappe.db.commit()
+            doc = json.dumps({"name": paperless_doc.name, "document_fulltext": invoice.fulltext})
+            try:
+                with timers["use_openai"].measure(invoice.lines):
+                    ai_query.use_openai(doc, prompt_name, ai_name)
+                name = frappe.db.get_value(
+                    "AI Query", {"paperless_doc": paperless_doc.name}, order_by="creation desc"
+                )
+                with timers["create_supplier"].measure(invoice.lines):
+                    ai_query.create_supplier(get_ai_query_json(name))
+                    frappe.db.commit()
+                with timers["create_purchase_invoice"].measure(invoice.lines):
+                    ai_query.create_purchase_invoice(get_ai_query_json(name))
+                # Stage traces are stored after the stage's own commit
+                frappe.db.commit()
+            except APIStatusError:
+                failed_llm_requests += 1
+            except Exception:
+                continue
+
+    results = {
+        "started": str(started),
+        "duration_seconds": round((now_datetime() - started).total_seconds(), 3),
+        "config": {
+            "sizes": list(sizes),
+            "documents_per_size": documents_per_size,
+            "delay": delay,
+            "jitter": jitter,
+            "error_rate": error_rate,
+            "error_status": ERROR_STATUS,
+            "retryable_status_codes": list(RETRYABLE_STATUS_CODES),
+            "seed": seed,
+        },
+        "llm_requests": len(server.requests),
+        "llm_errors": {
+            "injected": server.errors,
+            "retried": server.errors - failed_llm_requests,
+            "failed_requests": failed_llm_requests,
+        },
+        "llm_tokens": get_token_usage(ai_name, started),
+        "stages": {stage: timer.get_results() for stage, timer in timers.items()},
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
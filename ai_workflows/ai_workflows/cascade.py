@@ -0,0 +1,107 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import cint, flt
+
+from ai_workflows.ai_workflows.chunking import ITEM_LIST_KEY, ITEMS_KEY
+from ai_workflows.ai_workflows.schema_validation import STRUCTURED_OUTPUT_MODES
+
+# Models used when neither the AI Prompt nor the AI names one, per output mode
+DEFAULT_STRUCTURED_MODEL = "gpt-4o-2024-08-06"
+DEFAULT_CHAT_MODEL = "chatgpt-4o-latest"
+
+DEFAULT_TOTAL_TOLERANCE = 0.05
+
+
+def get_model_settings(prompt, ai_name=None):
+    """
+    Returns the model, temperature and max_tokens of the request. The AI
+    Prompt overrides the AI, unset values are left to the provider.
+    """
+    ai = (
+        frappe.get_cached_value(
+            "AI", ai_name, ["default_model", "temperature", "max_tokens"], as_dict=True
+        )
+        if ai_name
+        else None
+    ) or frappe._dict()
+
+    if prompt.get("model") or ai.default_model:
+        model = prompt.get("model") or ai.default_model
+    elif prompt.ai_output_mode in STRUCTURED_OUTPUT_MODES:
+        model = DEFAULT_STRUCTURED_MODEL
+    else:
+        model = DEFAULT_CHAT_MODEL
+    settings = {"model": model.strip()}
+
+    temperature = prompt.get("temperature") or ai.temperature
+    if temperature not in (None, ""):
+        settings["temperature"] = flt(temperature)
+    max_tokens = cint(prompt.get("max_tokens")) or cint(ai.max_tokens)
+    if max_tokens:
+        settings["max_tokens"] = max_tokens
+    return settings
+
+
+def validate_temperature(doc):
+    # Temperature is a Data field so that empty means "provider default"
+    if doc.temperature in (None, ""):
+        return
+    try:
+        temperature = float(doc.temperature)
+    except ValueError:
+        frappe.throw(f"Temperature must be a number, got '{doc.temperature}'.")
+    if not 0 <= temperature <= 2:
+        frappe.throw("Temperature must be between 0 and 2.")
+
+
+def check_invoice_totals(prompt, data):
+    """
+    Arithmetic check of an extracted invoice: the line totals must add up to
+    the value at the prompt's invoice_total_path. Partial results without
+    lines or without the total (e.g. single chunks) are not checked.
+    """
+    if not prompt.get("invoice_total_path") or not isinstance(data, dict):
+        return []
+    items = data.get(ITEMS_KEY)
+    items = items.get(ITEM_LIST_KEY) if isinstance(items, dict) else None
+    invoice_total = get_value_at_path(data, prompt.invoice_total_path)
+    if not items or not is_number(invoice_total):
+        return []
+
+    line_total = 0
+    for i, item in enumerate(items):
+        total = item.get("Total") if isinstance(item, dict) else None
+        if not is_number(total):
+            return [f"$.{ITEMS_KEY}.{ITEM_LIST_KEY}[{i}].Total: expected a number"]
+        line_total += flt(total)
+
+    tolerance = flt(prompt.get("total_tolerance") or DEFAULT_TOTAL_TOLERANCE)
+    if abs(line_total - flt(invoice_total)) > tolerance:
+        return [
+            f"$.{prompt.invoice_total_path}: the line totals add up to {flt(line_total, 2)}, "
+            f"not to {flt(invoice_total, 2)}"
+        ]
+    return []
+
+
+def get_value_at_path(data, path):
+    # Dotted path like InvoiceDetails.NetTotal
+    for key in path.strip().split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def is_number(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return True
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
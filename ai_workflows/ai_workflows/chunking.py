@@ -0,0 +1,134 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import copy
+import json
+
+# Characters per token used to turn token budgets into text lengths
+CHARS_PER_TOKEN = 4
+ITEMS_KEY = "ItemsPurchased"
+ITEM_LIST_KEY = "ItemList"
+
+
+def can_chunk(json_schema):
+    # Chunking needs a schema with an item list to extract per chunk
+    return bool(json_schema) and ITEMS_KEY in json_schema.get("properties", {})
+
+
+def split_fulltext(text, chunk_tokens, overlap_tokens=0):
+    """
+    Splits a document into windows of at most chunk_tokens (estimated).
+
+    Pages (form feeds) are packed together while they fit, longer pages are
+    split on line boundaries. Each window repeats the last overlap_tokens of
+    the previous one so items crossing a boundary are seen completely.
+    """
+    max_chars = max(chunk_tokens, 1) * CHARS_PER_TOKEN
+    overlap_chars = min(max(overlap_tokens, 0) * CHARS_PER_TOKEN, max_chars // 2)
+    if len(text) <= max_chars:
+        return [text]
+
+    lines = []
+    for page in text.split("\f"):
+        lines.extend(page.splitlines(keepends=True))
+        lines.append("\n")
+
+    chunks = []
+    current = []
+    size = 0
+    # Lines at the start of current repeated from the previous chunk
+    carried = 0
+    for line in lines:
+        if size + len(line) > max_chars and len(current) > carried:
+            chunks.append("".join(current))
+            current, size = _overlap(current, overlap_chars)
+            carried = len(current)
+        # Hard-wrap lines that are longer than a whole chunk, each piece
+        # starts with the overlap of the one before
+        while len(line) > max_chars:
+            cut = max_chars - size
+            chunks.append("".join(current) + line[:cut])
+            tail = line[:cut][-overlap_chars:] if overlap_chars else ""
+            current, size, carried = ([tail], len(tail), 1) if tail else ([], 0, 0)
+            line = line[cut:]
+        current.append(line)
+        size += len(line)
+    if "".join(current[carried:]).strip():
+        chunks.append("".join(current))
+    return chunks
+
+
+def _overlap(lines, overlap_chars):
+    # Last lines of a chunk that fit into the overlap
+    tail = []
+    size = 0
+    for line in reversed(lines):
+        if size + len(line) > overlap_chars:
+            break
+        tail.insert(0, line)
+        size += len(line)
+    return tail, size
+
+
+def get_header_schema(json_schema):
+    # Schema without the item list, used once per document
+    schema = copy.deepcopy(json_schema)
+    schema.get("properties", {}).pop(ITEMS_KEY, None)
+    if ITEMS_KEY in schema.get("required", []):
+        schema["required"] = [key for key in schema["required"] if key != ITEMS_KEY]
+    return schema
+
+
+def get_items_schema(json_schema):
+    # Schema with only the item list, used per chunk
+    schema = copy.deepcopy(json_schema)
+    schema["properties"] = {ITEMS_KEY: schema["properties"][ITEMS_KEY]}
+    schema["required"] = [ITEMS_KEY]
+    return schema
+
+
+def get_header_text(chunks):
+    # Header fields sit on the first page, totals and payment terms on the last
+    if len(chunks) == 1:
+        return chunks[0]
+    return f"{chunks[0]}\n...\n{chunks[-1]}"
+
+
+def merge_results(header, item_results, chunks=(), overlap_tokens=0):
+    """
+    Merges the header extraction and the per-chunk item lists into one result.
+    Items repeated at a chunk boundary because of the overlap are dropped, at
+    most one per line of the repeated text. Without overlap nothing is dropped,
+    identical consecutive items are real lines then.
+    """
+    merged = dict(header or {})
+    items = []
+    for i, result in enumerate(item_results):
+        chunk_items = ((result or {}).get(ITEMS_KEY) or {}).get(ITEM_LIST_KEY) or []
+        overlap_lines = get_overlap_lines(chunks[i - 1], chunks[i], overlap_tokens) if i else 0
+        items.extend(chunk_items[_boundary_duplicates(items, chunk_items, overlap_lines):])
+    merged[ITEMS_KEY] = {ITEM_LIST_KEY: items}
+    return merged
+
+
+def get_overlap_lines(previous, chunk, overlap_tokens):
+    # Non-blank lines at the start of a chunk repeated from the end of the previous one
+    overlap_chars = min(max(overlap_tokens, 0) * CHARS_PER_TOKEN, len(previous), len(chunk))
+    for size in range(overlap_chars, 0, -1):
+        if previous.endswith(chunk[:size]):
+            return sum(1 for line in chunk[:size].splitlines() if line.strip())
+    return 0
+
+
+def _boundary_duplicates(previous, current, limit):
+    # Longest run at the start of current that repeats the end of previous
+    keys_previous = [_item_key(item) for item in previous]
+    keys_current = [_item_key(item) for item in current]
+    for size in range(min(len(keys_previous), len(keys_current), limit), 0, -1):
+        if keys_previous[-size:] == keys_current[:size]:
+            return size
+    return 0
+
+
+def _item_key(item):
+    return json.dumps(item, sort_keys=True, default=str).lower()
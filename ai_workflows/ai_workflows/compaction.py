@@ -0,0 +1,191 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import hashlib
+import re
+from collections import Counter
+
+import frappe
+
+# Lines at the top and bottom of a page that may be running headers/footers
+PAGE_EDGE_LINES = 4
+# Boilerplate candidates: long, mostly text lines
+BOILERPLATE_MIN_LENGTH = 40
+BOILERPLATE_MAX_DIGIT_RATIO = 0.1
+# A line becomes boilerplate once seen in this many documents of a supplier
+BOILERPLATE_MIN_DOCUMENTS = 3
+# Learned lines are only stripped once this many of them identify the supplier
+BOILERPLATE_MIN_MATCHES = 2
+
+# Redis: per supplier counts of candidate lines and the documents counted,
+# and learned line -> supplier
+BOILERPLATE_COUNTS_KEY = "ai_workflows_boilerplate_counts|"
+BOILERPLATE_DOCUMENTS_KEY = "ai_workflows_boilerplate_documents|"
+BOILERPLATE_LINES_KEY = "ai_workflows_boilerplate_lines"
+
+TABLE_CELL_SEPARATOR = re.compile(r"\t+| {2,}")
+SPACES = re.compile(r"[ \t ]+")
+BLANK_LINES = re.compile(r"\n{3,}")
+# Lines with an amount carry extraction data, e.g. an item line at a page edge
+AMOUNT = re.compile(r"\d[.,]\d{2}(?!\d)")
+
+
+def compact_fulltext(prompt, text):
+    """
+    Runs the compaction steps enabled on the AI Prompt over a document
+    fulltext before the prompt is built.
+    """
+    if not text:
+        return text
+    text = prepare_fulltext(prompt, text)
+    if prompt.get("strip_supplier_boilerplate"):
+        text = strip_supplier_boilerplate(text)
+    if prompt.get("normalize_whitespace"):
+        text = normalize_whitespace(text)
+    return text
+
+
+def prepare_fulltext(prompt, text):
+    # The steps before boilerplate stripping, learning sees the same lines
+    if prompt.get("linearize_tables"):
+        text = linearize_tables(text)
+    if prompt.get("remove_repeated_lines"):
+        text = remove_repeated_lines(text)
+    return text
+
+
+def normalize_whitespace(text):
+    # Collapse runs of spaces, trailing blanks and multiple empty lines
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    # Form feeds are kept, they mark page breaks for chunking
+    lines = [SPACES.sub(" ", line).strip(" ") for line in text.split("\n")]
+    return BLANK_LINES.sub("\n\n", "\n".join(lines)).strip(" \n")
+
+
+def remove_repeated_lines(text):
+    """
+    Drops running headers and footers: lines near the top or bottom of a page
+    whose exact text is at the same place on most pages. The first one is
+    kept. Lines with an amount are never dropped.
+    """
+    pages = [page.split("\n") for page in text.split("\f")]
+    if len(pages) < 2:
+        return text
+
+    def get_edge_keys(lines):
+        # (place counted from the top or the bottom, text) of the edge lines
+        for i, line in enumerate(lines):
+            line = line.strip()
+            if not line or AMOUNT.search(line):
+                continue
+            if i < PAGE_EDGE_LINES:
+                yield i, (i, line)
+            if i >= len(lines) - PAGE_EDGE_LINES:
+                yield i, (i - len(lines), line)
+
+    counts = Counter(key for lines in pages for key in {key for _, key in get_edge_keys(lines)})
+    repeated = {key for key, count in counts.items() if count > len(pages) / 2 and count > 1}
+    seen = set()
+    result = []
+    for lines in pages:
+        dropped = set()
+        for i, key in get_edge_keys(lines):
+            if key in repeated:
+                if key in seen:
+                    dropped.add(i)
+                seen.add(key)
+        result.append("\n".join(line for i, line in enumerate(lines) if i not in dropped))
+    return "\f".join(result)
+
+
+def linearize_tables(text):
+    # Turn column-aligned rows (3+ cells) into "cell | cell | cell"
+    lines = []
+    for line in text.split("\n"):
+        cells = [cell for cell in TABLE_CELL_SEPARATOR.split(line.strip()) if cell]
+        lines.append(" | ".join(cells) if len(cells) >= 3 else line)
+    return "\n".join(lines)
+
+
+def strip_supplier_boilerplate(text):
+    """
+    Removes lines learned as boilerplate of one supplier. The supplier is
+    recognised by the learned lines themselves, so this works before the
+    supplier of the document is known.
+    """
+    hashes = list(
+        {get_line_hash(line) for line in text.split("\n") if is_boilerplate_candidate(line)}
+    )
+    if not hashes:
+        return text
+
+    cache = frappe.cache()
+    owners = cache.hmget(cache.make_key(BOILERPLATE_LINES_KEY), hashes)
+    matches = {}
+    for line_hash, owner in zip(hashes, owners):
+        if owner:
+            matches.setdefault(frappe.safe_decode(owner), set()).add(line_hash)
+    if not matches:
+        return text
+
+    supplier_lines = max(matches.values(), key=len)
+    if len(supplier_lines) < BOILERPLATE_MIN_MATCHES:
+        return text
+    return "\n".join(
+        line
+        for line in text.split("\n")
+        if not (is_boilerplate_candidate(line) and get_line_hash(line) in supplier_lines)
+    )
+
+
+def learn_supplier_boilerplate(prompt, supplier, supplier_name, document, text):
+    """
+    Counts candidate lines of a document whose supplier is known, each document
+    once per supplier. Lines seen in BOILERPLATE_MIN_DOCUMENTS documents of the
+    supplier are learned. Lines mentioning the supplier name are never learned,
+    they carry extraction data.
+    """
+    if not text:
+        return
+    text = prepare_fulltext(prompt, text)
+    supplier_name = (supplier_name or "").lower()
+    line_hashes = {
+        get_line_hash(line)
+        for line in text.split("\n")
+        if is_boilerplate_candidate(line)
+        and not (supplier_name and supplier_name in line.lower())
+    }
+    if not line_hashes:
+        return
+
+    cache = frappe.cache()
+    if not cache.sadd(cache.make_key(BOILERPLATE_DOCUMENTS_KEY + supplier), document):
+        # Counted before, e.g. when the supplier is created again
+        return
+    counts_key = cache.make_key(BOILERPLATE_COUNTS_KEY + supplier)
+    pipeline = cache.pipeline()
+    for line_hash in line_hashes:
+        pipeline.hincrby(counts_key, line_hash, 1)
+    counts = pipeline.execute()
+
+    learned = {
+        line_hash: supplier
+        for line_hash, count in zip(line_hashes, counts)
+        if count >= BOILERPLATE_MIN_DOCUMENTS
+    }
+    if learned:
+        pipeline.hset(cache.make_key(BOILERPLATE_LINES_KEY), mapping=learned)
+        pipeline.execute()
+
+
+def is_boilerplate_candidate(line):
+    line = line.strip()
+    if len(line) < BOILERPLATE_MIN_LENGTH:
+        return False
+    digits = sum(ch.isdigit() for ch in line)
+    return digits / len(line) <= BOILERPLATE_MAX_DIGIT_RATIO
+
+
+def get_line_hash(line):
+    normalized = SPACES.sub(" ", line.strip().lower())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
@@ -4,6 +4,9 @@
 # import frappe
 from frappe.model.document import Document
 
+from ai_workflows.ai_workflows.cascade import validate_temperature
+
 
 class AI(Document):
-	pass
+	def validate(self):
+		validate_temperature(self)
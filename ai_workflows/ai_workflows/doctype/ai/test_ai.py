@@ -1,9 +1,184 @@
 # Copyright (c) 2024, itsdave GmbH and Contributors
 # See license.txt
 
-# import frappe
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import frappe
+import httpx
 from frappe.tests.utils import FrappeTestCase
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+from ai_workflows.ai_workflows.ai_client import RetryPolicy, get_backend, get_chat_completions
+from ai_workflows.ai_workflows.stub_server import StubOpenAIServer
+
+REQUEST = {"model": "local", "messages": [{"role": "user", "content": "Extract"}]}
+
+
+def make_ai(server, **values):
+	return frappe.get_doc(
+		{
+			"doctype": "AI",
+			"caption": "Local Test",
+			"interface": "OpenAI Compatible",
+			"endpoint": server.url,
+			**values,
+		}
+	).insert()
+
+
+def get_limited_completions(ai):
+	# Starts from a full bucket and no slots, whatever earlier runs left in redis
+	completions = get_chat_completions(ai.name)
+	limiter = completions.rate_limiter
+	limiter.redis.delete(limiter.bucket_key, limiter.inflight_key)
+	return completions
 
 
 class TestAI(FrappeTestCase):
-	pass
+	def test_openai_compatible_backend(self):
+		with StubOpenAIServer('{"InvoiceDetails": {}}', delay=0.2) as server:
+			ai = make_ai(server)
+			backend = get_backend(ai.name)
+			self.assertEqual(backend.concurrency, 16)
+			self.assertFalse(backend.supports_batch_api)
+
+			completions = get_chat_completions(ai.name)
+			with ThreadPoolExecutor(max_workers=8) as executor:
+				responses = list(executor.map(lambda _: completions.create(**REQUEST), range(8)))
+
+		self.assertEqual(len(server.requests), 8)
+		self.assertEqual(server.requests[0]["model"], "local")
+		self.assertEqual(responses[0].choices[0].message.content, '{"InvoiceDetails": {}}')
+		# Requests reach the server concurrently, so it can batch them
+		self.assertGreater(server.max_inflight, 1)
+
+	def test_stream_response(self):
+		answer = '{"InvoiceDetails": {"InvoiceNumber": "R-1001"}}'
+		with StubOpenAIServer(answer) as server:
+			ai = make_ai(server)
+			updates = []
+			text, usage, finish_reason = get_chat_completions(ai.name).stream(
+				on_update=updates.append, **REQUEST
+			)
+
+		self.assertEqual((text, finish_reason), (answer, "stop"))
+		self.assertTrue(server.requests[0]["stream"])
+		# Every update is the text received so far, the last one all of it
+		self.assertGreater(len(updates), 1)
+		self.assertTrue(all(answer.startswith(update) for update in updates))
+		self.assertEqual(updates[-1], answer)
+		# The usage arrives in the final chunk
+		self.assertEqual(usage["completion_tokens"], len(answer) // 4)
+
+	def test_token_bucket_refill(self):
+		with StubOpenAIServer() as server:
+			ai = make_ai(server, tokens_per_minute=120000)
+			completions = get_limited_completions(ai)
+			# Use up the whole minute
+			completions.rate_limiter.acquire(120000)
+
+			# About 1000 tokens refill in half a second
+			started = time.monotonic()
+			completions.create(max_tokens=1000, **REQUEST)
+			waited = time.monotonic() - started
+			self.assertGreater(waited, 0.4)
+			self.assertLess(waited, 5)
+
+			# A request within the refilled budget does not wait
+			time.sleep(1)
+			started = time.monotonic()
+			completions.create(max_tokens=1000, **REQUEST)
+			self.assertLess(time.monotonic() - started, 0.4)
+		self.assertEqual(len(server.requests), 2)
+
+	def test_inflight_limit(self):
+		with StubOpenAIServer(delay=0.1) as server:
+			ai = make_ai(server, max_inflight_requests=2)
+			completions = get_limited_completions(ai)
+			with ThreadPoolExecutor(max_workers=6) as executor:
+				list(executor.map(lambda _: completions.create(**REQUEST), range(6)))
+		self.assertEqual(len(server.requests), 6)
+		self.assertEqual(server.max_inflight, 2)
+
+	@patch("ai_workflows.ai_workflows.rate_limit.INFLIGHT_LEASE_MS", 500)
+	def test_inflight_lease_expiry(self):
+		with StubOpenAIServer() as server:
+			ai = make_ai(server, max_inflight_requests=1)
+			completions = get_limited_completions(ai)
+			# A worker that died holding the only slot never releases it
+			completions.rate_limiter.acquire(0)
+
+			started = time.monotonic()
+			completions.create(**REQUEST)
+			waited = time.monotonic() - started
+		self.assertGreater(waited, 0.3)
+		self.assertLess(waited, 5)
+		self.assertEqual(len(server.requests), 1)
+
+	def test_retry_classification(self):
+		retry_settings = {"retry_max_attempts": 3, "retry_backoff_base": 0.01, "retry_backoff_max": 0.05}
+		with StubOpenAIServer(error_rate=1, error_status=503) as server:
+			ai = make_ai(server, retryable_status_codes="429, 503", **retry_settings)
+			completions = get_chat_completions(ai.name)
+			self.assertRaises(APIStatusError, completions.create, **REQUEST)
+			self.assertEqual(len(server.requests), 3)
+
+			# Client errors are not retried
+			server.error_status = 400
+			self.assertRaises(APIStatusError, completions.create, **REQUEST)
+			self.assertEqual(len(server.requests), 4)
+
+		with StubOpenAIServer(error_rate=0.5, seed=1) as server:
+			ai = make_ai(server, retryable_status_codes="503", **dict(retry_settings, retry_max_attempts=10))
+			completions = get_chat_completions(ai.name)
+			for _ in range(10):
+				completions.create(**REQUEST)
+		self.assertGreater(server.errors, 0)
+		self.assertEqual(len(server.requests), 10 + server.errors)
+
+		policy = RetryPolicy(ai.name)
+		request = httpx.Request("POST", server.url)
+		self.assertTrue(policy.is_retryable(APIConnectionError(request=request)))
+		self.assertTrue(policy.is_retryable(APITimeoutError(request=request)))
+		self.assertFalse(policy.is_retryable(ValueError("no API error")))
+
+	def test_retry_backoff(self):
+		with StubOpenAIServer() as server:
+			ai = make_ai(server, retry_backoff_base=1, retry_backoff_max=30)
+		policy = RetryPolicy(ai.name)
+
+		def get_error(status, **headers):
+			response = httpx.Response(status, headers=headers, request=httpx.Request("POST", server.url))
+			return APIStatusError("rate limited", response=response, body=None)
+
+		# Retry-After of the provider, capped at the maximum backoff
+		self.assertEqual(policy.get_backoff(1, get_error(429, **{"retry-after": "2"})), 2)
+		self.assertEqual(policy.get_backoff(1, get_error(429, **{"retry-after": "120"})), 30)
+		# Full jitter up to base * 2 ** attempt otherwise
+		for attempt, error in ((1, get_error(503)), (3, get_error(429, **{"retry-after": "soon"}))):
+			self.assertLessEqual(policy.get_backoff(attempt, error), 2**attempt)
+		self.assertLessEqual(max(policy.get_backoff(10) for _ in range(100)), 30)
+
+	def test_stream_holds_inflight_slot(self):
+		with StubOpenAIServer('{"InvoiceDetails": {"InvoiceNumber": "R-1001"}}') as server:
+			ai = make_ai(server, max_inflight_requests=1)
+			completions = get_limited_completions(ai)
+
+			def stream(_):
+				# Slow reader: the slot must stay taken until the stream is read
+				updates = []
+
+				def on_update(text):
+					updates.append(time.monotonic())
+					time.sleep(0.05)
+
+				completions.stream(on_update=on_update, **REQUEST)
+				return updates[0], updates[-1]
+
+			with ThreadPoolExecutor(max_workers=2) as executor:
+				first, second = sorted(executor.map(stream, range(2)))
+		self.assertEqual(len(server.requests), 2)
+		# The second stream is only read after the first one was read completely
+		self.assertGreater(second[0], first[1])
@@ -0,0 +1,12 @@
+// Copyright (c) 2026, itsdave GmbH and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("AI Batch Job", {
+	refresh(frm) {
+		if (frm.doc.status === "Submitted") {
+			frm.add_custom_button(__("Check Status"), () => {
+				frm.call("check_status").then(() => frm.reload_doc());
+			});
+		}
+	},
+});
@@ -0,0 +1,233 @@
+# Copyright (c) 2026, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from openai.types.chat import ChatCompletion
+
+from ai_workflows.ai_workflows.ai_client import get_backend, get_openai_client
+from ai_workflows.ai_workflows.compaction import compact_fulltext
+from ai_workflows.ai_workflows.doctype.ai_query.ai_query import (
+	build_openai_request,
+	create_ai_query,
+	get_paperless_document_data,
+	is_truncated,
+	parse_openai_response,
+	repair_structured_response,
+	set_usage,
+)
+from ai_workflows.ai_workflows.response_cache import (
+	get_cache_key,
+	get_cached_response,
+	set_cached_response,
+)
+from ai_workflows.ai_workflows.schema_validation import get_compiled_schema, is_structured
+from ai_workflows.ai_workflows.tokens import get_usage
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+
+# Provider states after which no further output will arrive
+FINAL_PROVIDER_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+class AIBatchJob(Document):
+	def submit_to_provider(self):
+		"""
+		Builds the JSONL input the same way use_openai builds its requests,
+		uploads it and creates the provider batch.
+		"""
+		prompt = frappe.get_doc("AI Prompt", self.ai_prompt)
+
+		lines = []
+		for item in self.items:
+			doc = get_paperless_document_data(item.paperless_doc)
+			effective_prompt, request = build_openai_request(
+				prompt,
+				compact_fulltext(prompt, doc.get("document_fulltext")),
+				ai_name=self.ai,
+				paperless_doc=item.paperless_doc,
+			)
+			item.cache_key = get_cache_key(prompt.ai_output_mode, request)
+			# Results are processed with what was sent, the AI Prompt may change meanwhile
+			item.effective_prompt = effective_prompt
+			item.request_json = json.dumps(request)
+
+			# Identical requests are answered from the response cache right away
+			resp = get_cached_response(item.cache_key)
+			if resp is not None:
+				self.save_item_result(prompt, item, effective_prompt, resp, from_cache=True)
+				continue
+
+			lines.append(
+				json.dumps(
+					{
+						"custom_id": item.name,
+						"method": "POST",
+						"url": BATCH_ENDPOINT,
+						"body": request,
+					}
+				)
+			)
+
+		self.total_requests = len(lines)
+		if not lines:
+			self.status = "Completed"
+			self.save()
+			return
+
+		client = get_openai_client(self.ai)
+		input_file = client.files.create(
+			file=(f"{self.name}.jsonl", "\n".join(lines).encode("utf-8")),
+			purpose="batch",
+		)
+		batch = client.batches.create(
+			input_file_id=input_file.id,
+			endpoint=BATCH_ENDPOINT,
+			completion_window=BATCH_COMPLETION_WINDOW,
+			metadata={"ai_batch_job": self.name},
+		)
+		self.input_file_id = input_file.id
+		self.batch_id = batch.id
+		self.provider_status = batch.status
+		self.status = "Submitted"
+		self.save()
+
+	@frappe.whitelist()
+	def check_status(self):
+		# Poll the provider and fan finished results out into AI Queries
+		client = get_openai_client(self.ai)
+		batch = client.batches.retrieve(self.batch_id)
+		self.provider_status = batch.status
+		if batch.request_counts:
+			self.completed_requests = batch.request_counts.completed
+			self.failed_requests = batch.request_counts.failed
+
+		if batch.status in FINAL_PROVIDER_STATES:
+			self.output_file_id = batch.output_file_id
+			self.error_file_id = batch.error_file_id
+			prompt = frappe.get_doc("AI Prompt", self.ai_prompt)
+			if batch.output_file_id:
+				self.process_output(prompt, client.files.content(batch.output_file_id).text)
+			if batch.error_file_id:
+				self.process_output(prompt, client.files.content(batch.error_file_id).text)
+
+			# Anything still pending got no answer from the provider
+			for item in self.items:
+				if item.status == "Pending":
+					item.status = "Failed"
+					item.error = f"No result, batch ended with status '{batch.status}'"
+			self.status = "Completed" if batch.status == "completed" else "Failed"
+
+		self.save()
+
+	def process_output(self, prompt, content):
+		items = {item.name: item for item in self.items}
+		compiled_schema = get_compiled_schema(prompt) if is_structured(prompt) else None
+		for line in content.splitlines():
+			if not line.strip():
+				continue
+			result = json.loads(line)
+			item = items.get(result.get("custom_id"))
+			if not item or item.status != "Pending":
+				continue
+
+			response = result.get("response") or {}
+			if result.get("error") or response.get("status_code") != 200:
+				item.status = "Failed"
+				item.error = json.dumps(result.get("error") or response.get("body"))
+				continue
+
+			chat_response = ChatCompletion.model_validate(response["body"])
+			resp = parse_openai_response(prompt, chat_response)
+			usage = get_usage(chat_response)
+			effective_prompt, request = self.get_item_request(prompt, item)
+			errors = []
+			if compiled_schema:
+				# Offline results are validated and repaired locally only
+				resp, usage, errors = repair_structured_response(
+					prompt, None, request, compiled_schema, resp, usage, truncated=is_truncated(chat_response)
+				)
+			if not errors:
+				set_cached_response(item.cache_key, resp, prompt.ai_output_mode, request.get("model"))
+			self.save_item_result(
+				prompt, item, effective_prompt, resp, usage=usage, model=request.get("model"), errors=errors
+			)
+
+	def get_item_request(self, prompt, item):
+		# Effective prompt and request of an item as submitted, rebuilt for jobs submitted without them
+		if item.request_json:
+			return item.effective_prompt, json.loads(item.request_json)
+		doc = get_paperless_document_data(item.paperless_doc)
+		return build_openai_request(
+			prompt,
+			compact_fulltext(prompt, doc.get("document_fulltext")),
+			ai_name=self.ai,
+			paperless_doc=item.paperless_doc,
+		)
+
+	def save_item_result(
+		self, prompt, item, effective_prompt, resp, from_cache=False, usage=None, model=None, errors=None
+	):
+		new_query = create_ai_query(
+			prompt, item.paperless_doc, self.ai, effective_prompt, resp, from_cache=from_cache, errors=errors
+		)
+		new_query.response_cache_key = item.cache_key
+		set_usage(new_query, usage, model)
+		new_query.insert()
+		frappe.db.set_value(
+			"Paperless Document", item.paperless_doc, "status", "AI-Response-Received"
+		)
+		item.ai_query = new_query.name
+		item.status = "Done"
+
+
+@frappe.whitelist()
+def call_ai_offline(ai, prompt, docs):
+	"""
+	Offline counterpart of call_ai: queues the documents for the provider's
+	Batch API instead of calling the model directly.
+	"""
+	if isinstance(docs, str):
+		docs = json.loads(docs)
+	if not docs:
+		return "No documents selected!"
+	if not frappe.db.exists("AI", ai):
+		return "AI not found!"
+	if not get_backend(ai).supports_batch_api:
+		return "The Batch API is only available for openAI, use call_ai_batch instead."
+
+	batch_job = frappe.new_doc("AI Batch Job")
+	batch_job.ai = ai
+	batch_job.ai_prompt = prompt
+	for doc in docs:
+		batch_job.append(
+			"items", {"paperless_doc": doc.get("name") if isinstance(doc, dict) else doc}
+		)
+	batch_job.insert()
+
+	frappe.enqueue(
+		"ai_workflows.ai_workflows.doctype.ai_batch_job.ai_batch_job.submit_batch_job",
+		queue="long",
+		batch_job=batch_job.name,
+		enqueue_after_commit=True,
+	)
+	return batch_job.name
+
+
+def submit_batch_job(batch_job):
+	frappe.get_doc("AI Batch Job", batch_job).submit_to_provider()
+	frappe.db.commit()
+
+
+def poll_batch_jobs():
+	# Scheduler hook: check all batches still running at the provider
+	for name in frappe.get_all("AI Batch Job", filters={"status": "Submitted"}, pluck="name"):
+		try:
+			frappe.get_doc("AI Batch Job", name).check_status()
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(title=f"Polling AI Batch Job {name} failed")
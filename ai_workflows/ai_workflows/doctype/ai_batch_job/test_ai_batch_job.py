@@ -0,0 +1,142 @@
+# Copyright (c) 2026, itsdave GmbH and Contributors
+# See license.txt
+
+import json
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ai_workflows.ai_workflows.doctype.ai_batch_job.ai_batch_job import poll_batch_jobs
+
+
+class FakeBatchAPI:
+	"""
+	Local stand-in for the files and batches endpoints of the OpenAI client.
+	Every request in an uploaded batch is answered with the given arguments.
+	"""
+
+	def __init__(self, arguments):
+		self.arguments = arguments
+		self.uploads = {}
+		self.batches_by_id = {}
+		self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+		self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+	def create_file(self, file, purpose):
+		file_id = f"file-{len(self.uploads) + 1}"
+		self.uploads[file_id] = file[1].decode("utf-8")
+		return SimpleNamespace(id=file_id)
+
+	def file_content(self, file_id):
+		return SimpleNamespace(text=self.uploads[file_id])
+
+	def create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+		batch = SimpleNamespace(
+			id=f"batch-{len(self.batches_by_id) + 1}",
+			status="in_progress",
+			input_file_id=input_file_id,
+			output_file_id=None,
+			error_file_id=None,
+			request_counts=SimpleNamespace(completed=0, failed=0),
+		)
+		self.batches_by_id[batch.id] = batch
+		return batch
+
+	def retrieve_batch(self, batch_id):
+		return self.batches_by_id[batch_id]
+
+	def complete(self, batch_id):
+		# Answer all requests of a batch and write the output file
+		batch = self.batches_by_id[batch_id]
+		output = []
+		for line in self.uploads[batch.input_file_id].splitlines():
+			request = json.loads(line)
+			output.append(
+				json.dumps(
+					{
+						"custom_id": request["custom_id"],
+						"response": {
+							"status_code": 200,
+							"body": {
+								"id": "chatcmpl-fake",
+								"object": "chat.completion",
+								"created": 0,
+								"model": request["body"]["model"],
+								"choices": [
+									{
+										"index": 0,
+										"finish_reason": "stop",
+										"message": {
+											"role": "assistant",
+											"content": self.arguments,
+											"function_call": {
+												"name": "generate_invoice",
+												"arguments": self.arguments,
+											},
+										},
+									}
+								],
+							},
+						},
+						"error": None,
+					}
+				)
+			)
+		batch.output_file_id = f"file-{len(self.uploads) + 1}"
+		self.uploads[batch.output_file_id] = "\n".join(output)
+		batch.status = "completed"
+		batch.request_counts = SimpleNamespace(completed=len(output), failed=0)
+
+
+class TestAIBatchJob(FrappeTestCase):
+	def setUp(self):
+		if not frappe.db.exists("DocType", "Paperless Document"):
+			raise unittest.SkipTest("frappe_goes_paperless is not installed")
+
+	def test_batch_results_create_ai_queries(self):
+		ai = frappe.get_doc({"doctype": "AI", "caption": "Batch Test", "interface": "openAI"}).insert()
+		prompt = frappe.get_doc(
+			{
+				"doctype": "AI Prompt",
+				"caption": "Batch Test",
+				"ai": ai.name,
+				"ai_output_mode": "Structured Output (JSON)",
+				"long_text_fnbe": "Extract the invoice.",
+				"json_scema": json.dumps({"type": "object", "properties": {}}),
+			}
+		).insert()
+		paperless_doc = frappe.get_doc(
+			{"doctype": "Paperless Document", "document_fulltext": "Invoice 4711"}
+		).insert()
+
+		fake = FakeBatchAPI(json.dumps({"InvoiceDetails": {"InvoiceNumber": "4711"}}))
+		with patch(
+			"ai_workflows.ai_workflows.doctype.ai_batch_job.ai_batch_job.get_openai_client",
+			return_value=fake,
+		):
+			batch_job = frappe.get_doc(
+				{
+					"doctype": "AI Batch Job",
+					"ai": ai.name,
+					"ai_prompt": prompt.name,
+					"items": [{"paperless_doc": paperless_doc.name}],
+				}
+			).insert()
+			batch_job.submit_to_provider()
+			self.assertEqual(batch_job.status, "Submitted")
+
+			# Results use the prompt and request of the submission
+			prompt.db_set("long_text_fnbe", "Changed after submission.")
+			fake.complete(batch_job.batch_id)
+			poll_batch_jobs()
+
+		batch_job.reload()
+		self.assertEqual(batch_job.status, "Completed")
+		self.assertEqual(batch_job.items[0].status, "Done")
+		ai_query = frappe.get_doc("AI Query", batch_job.items[0].ai_query)
+		self.assertEqual(json.loads(ai_query.ai_response_json)["InvoiceDetails"]["InvoiceNumber"], "4711")
+		self.assertIn("Extract the invoice.", ai_query.effective_prompt)
+		self.assertNotIn("Changed after submission.", ai_query.effective_prompt)
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, itsdave GmbH and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("AI Extraction Template", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -0,0 +1,89 @@
+# Copyright (c) 2026, itsdave GmbH and Contributors
+# See license.txt
+
+from frappe.tests.utils import FrappeTestCase
+
+from ai_workflows.ai_workflows.extraction_templates import (
+	TemplateError,
+	apply_rules,
+	check_line_sum,
+	learn_rules,
+)
+
+
+def get_invoice(number, day, lines):
+	text = [
+		"Muster GmbH - Hauptstr. 1 - 10115 Berlin - USt-IdNr. DE 123 456 789",
+		f"Rechnung Nr. {number}",
+		f"Datum: {day:02d}.10.2026",
+		"Pos Artikel        Bezeichnung              Menge   Einzelpreis   Gesamt",
+	]
+	items = []
+	for i, (item, quantity, price) in enumerate(lines, 1):
+		text.append(f"{i}   {item}   Schraube {item} verzinkt   {quantity}   {price:.2f}   {quantity * price:.2f}".replace(".", ","))
+		items.append(
+			{
+				"ItemNumber": item,
+				"ItemName": f"Schraube {item}",
+				"Quantity": quantity,
+				"Total": round(quantity * price, 2),
+			}
+		)
+	text.append(f"Summe netto: {sum(item['Total'] for item in items):.2f} EUR".replace(".", ","))
+	data = {
+		"InvoiceDetails": {
+			"InvoiceNumber": number,
+			"InvoiceDate": f"2026-10-{day:02d}",
+			"SupplierName": "Muster GmbH",
+			"NetTotal": round(sum(item["Total"] for item in items), 2),
+		},
+		"ItemsPurchased": {"ItemList": items},
+	}
+	return "\n".join(text), data
+
+
+class TestAIExtractionTemplate(FrappeTestCase):
+	def test_learned_rules_extract_new_invoice(self):
+		examples = [
+			get_invoice("R-1001", 1, [("M8", 100, 0.12), ("M10", 50, 0.2)]),
+			get_invoice("R-1002", 9, [("M6", 200, 0.08)]),
+			get_invoice("R-1003", 17, [("M12", 10, 1.5), ("M8", 300, 0.11), ("M4", 1000, 0.03)]),
+		]
+		rules = learn_rules(examples)
+
+		text, data = get_invoice("R-1004", 24, [("M16", 4, 3.75), ("M10", 20, 0.19)])
+		self.assertEqual(apply_rules(rules, text), data)
+		# A required field missing from the text is not guessed
+		self.assertIsNone(apply_rules(rules, text.replace("Rechnung Nr.", "Gutschrift")))
+
+	def test_unreproducible_field(self):
+		examples = [get_invoice(f"R-{i}", i, [("M8", i, 0.1)]) for i in range(1, 4)]
+		for i, (_, data) in enumerate(examples):
+			data["InvoiceDetails"]["OrderNumber"] = f"B-{i}"
+		with self.assertRaises(TemplateError):
+			learn_rules(examples)
+
+	def test_values_same_in_every_example(self):
+		# Same date in every example: still read from the text
+		examples = [
+			get_invoice("R-2001", 5, [("M8", 100, 0.12), ("M10", 50, 0.2)]),
+			get_invoice("R-2002", 5, [("M6", 200, 0.08)]),
+			get_invoice("R-2003", 5, [("M12", 10, 1.5), ("M4", 1000, 0.03)]),
+		]
+		rules = learn_rules(examples)
+		self.assertNotIn("constant", [rule["type"] for rule in rules["fields"] if rule["path"][-1] != "SupplierName"])
+		text, data = get_invoice("R-2004", 12, [("M16", 4, 3.75)])
+		self.assertEqual(apply_rules(rules, text), data)
+
+		# Quantity 1 in every line: the column is next to the position 1, and
+		# the totals equal the unit prices
+		examples = [get_invoice(f"R-{i}", i, [("M8", 1, 0.1 * i)]) for i in range(1, 4)]
+		with self.assertRaises(TemplateError):
+			learn_rules(examples)
+
+	def test_line_sum_must_be_in_text(self):
+		text, data = get_invoice("R-3001", 3, [("M8", 100, 0.12), ("M10", 50, 0.2)])
+		self.assertEqual(check_line_sum(data, text), [])
+		# A misread line total
+		data["ItemsPurchased"]["ItemList"][0]["Total"] = 1.2
+		self.assertTrue(check_line_sum(data, text))
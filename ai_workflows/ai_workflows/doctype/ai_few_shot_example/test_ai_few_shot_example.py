@@ -0,0 +1,31 @@
+# Copyright (c) 2026, itsdave GmbH and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ai_workflows.ai_workflows.few_shot import FewShotIndex
+
+
+def get_example(name, paperless_doc, input_text):
+	return frappe._dict(name=name, paperless_doc=paperless_doc, input_text=input_text, output_json="{}")
+
+
+class TestAIFewShotExample(FrappeTestCase):
+	def test_index_ranks_similar_layouts(self):
+		index = FewShotIndex(
+			[
+				get_example("hotel", "1", "Hotel Seeblick Zimmer Übernachtung Frühstück Kurtaxe 2 Nächte"),
+				get_example("fuel", "2", "Tankstelle Diesel Liter Zapfsäule Kassenbon 45,12"),
+				get_example("hardware", "3", "Baumarkt Schrauben Dübel Lieferschein Pos Menge Einzelpreis"),
+			]
+		)
+		results = index.search("Rechnung Hotel Alpenblick: Übernachtung mit Frühstück, Kurtaxe", 2)
+		self.assertEqual(results[0].name, "hotel")
+		# Examples of the document itself are not used
+		self.assertNotIn("hotel", [e.name for e in index.search("Hotel Übernachtung", 3, exclude="1")])
+
+		index.remove("hotel")
+		index.add(get_example("fuel", "2", "Hotel Übernachtung Frühstück"))
+		self.assertEqual(index.search("Hotel Übernachtung", 1)[0].name, "fuel")
+		self.assertEqual(len(index.entries), 2)
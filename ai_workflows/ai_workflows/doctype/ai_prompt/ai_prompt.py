@@ -1,9 +1,24 @@
 # Copyright (c) 2024, itsdave GmbH and contributors
 # For license information, please see license.txt
 
-# import frappe
+import json
+
+import frappe
 from frappe.model.document import Document
 
+from ai_workflows.ai_workflows.cascade import validate_temperature
+from ai_workflows.ai_workflows.few_shot import MAX_EXAMPLES_PER_PROMPT
+from ai_workflows.ai_workflows.schema_validation import CompiledSchema, is_structured
+
 
 class AIPrompt(Document):
-	pass
+	def validate(self):
+		validate_temperature(self)
+		if not 0 <= (self.few_shot_examples or 0) <= MAX_EXAMPLES_PER_PROMPT:
+			frappe.throw(f"Few-Shot Examples must be between 0 and {MAX_EXAMPLES_PER_PROMPT}.")
+		if is_structured(self) and self.json_scema:
+			# Fail on save instead of on the first extraction
+			try:
+				CompiledSchema(json.loads(self.json_scema), strict=False)
+			except (ValueError, TypeError) as e:
+				frappe.throw(f"JSON Scema is not a valid JSON schema: {e}")
@@ -1,9 +1,225 @@
 # Copyright (c) 2024, itsdave GmbH and Contributors
 # See license.txt
 
-# import frappe
+import json
+from types import SimpleNamespace
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from ai_workflows.ai_workflows.cascade import check_invoice_totals
+from ai_workflows.ai_workflows.chunking import CHARS_PER_TOKEN, merge_results, split_fulltext
+from ai_workflows.ai_workflows.compaction import (
+	compact_fulltext,
+	learn_supplier_boilerplate,
+	linearize_tables,
+	remove_repeated_lines,
+)
+from ai_workflows.ai_workflows.doctype.ai_query.ai_query import (
+	TRUNCATED_ERROR,
+	complete_request,
+	complete_with_cascade,
+	repair_structured_response,
+)
+from ai_workflows.ai_workflows.schema_validation import (
+	JSON_SCHEMA_MODE,
+	CompiledSchema,
+	parse_json_response,
+)
+
+INVOICE_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"InvoiceDetails": {
+			"type": "object",
+			"properties": {
+				"InvoiceNumber": {"type": "string"},
+				"Currency": {"type": "string", "enum": ["EUR", "USD"]},
+			},
+			"required": ["InvoiceNumber"],
+		},
+	},
+	"required": ["InvoiceDetails"],
+}
+
+
+class FakeCompletions:
+	# Answers every request with the next of the given responses, a text or (text, finish_reason)
+	def __init__(self, *answers):
+		self.answers = list(answers)
+		self.requests = []
+
+	def create(self, **request):
+		self.requests.append(request)
+		answer = self.answers.pop(0)
+		content, finish_reason = answer if isinstance(answer, tuple) else (answer, "stop")
+		message = SimpleNamespace(content=content, function_call=None)
+		return SimpleNamespace(
+			choices=[SimpleNamespace(message=message, finish_reason=finish_reason)], usage=None
+		)
+
 
 class TestAIPrompt(FrappeTestCase):
-	pass
+	def test_strict_schema(self):
+		schema = CompiledSchema(INVOICE_SCHEMA)
+		details = schema.strict_schema["properties"]["InvoiceDetails"]
+		self.assertEqual(details["required"], ["InvoiceNumber", "Currency"])
+		self.assertFalse(details["additionalProperties"])
+		self.assertEqual(details["properties"]["Currency"]["type"], ["string", "null"])
+
+		self.assertEqual(schema.validate({"InvoiceDetails": {"InvoiceNumber": "1", "Currency": None}}), [])
+		errors = schema.validate({"InvoiceDetails": {"InvoiceNumber": 1, "Currency": "GBP"}})
+		self.assertEqual(len(errors), 2)
+
+	def test_repair_locally_and_by_retry(self):
+		prompt = frappe._dict(ai_output_mode=JSON_SCHEMA_MODE, max_repair_attempts=1)
+		request = {"messages": [{"role": "user", "content": "Extract"}]}
+		schema = CompiledSchema(INVOICE_SCHEMA)
+
+		# Code fences and nulls of optional fields are handled without a request
+		resp, _, errors = repair_structured_response(
+			prompt,
+			FakeCompletions(),
+			request,
+			schema,
+			'```json\n{"InvoiceDetails": {"InvoiceNumber": "4711", "Currency": null}}\n```',
+			{},
+		)
+		self.assertEqual(errors, [])
+		self.assertEqual(json.loads(resp), {"InvoiceDetails": {"InvoiceNumber": "4711"}})
+
+		# Schema violations are sent back to the model once
+		completions = FakeCompletions('{"InvoiceDetails": {"InvoiceNumber": "4711", "Currency": "EUR"}}')
+		resp, _, errors = repair_structured_response(
+			prompt, completions, request, schema, '{"InvoiceDetails": {"InvoiceNumber": 4711}}', {}
+		)
+		self.assertEqual(errors, [])
+		self.assertEqual(len(completions.requests), 1)
+		self.assertIn("InvoiceNumber", completions.requests[0]["messages"][-1]["content"])
+
+	def test_truncated_answer_is_not_completed(self):
+		prompt = frappe._dict(ai_output_mode=JSON_SCHEMA_MODE, max_repair_attempts=1)
+		schema = CompiledSchema({"type": "object"})
+		complete = '{"InvoiceDetails": {"InvoiceNumber": "4711"}, "Items": [{"Total": 10}, {"Total": 20}]}'
+		truncated = complete[:60]
+
+		# Syntax is repaired, a cut-off item list is not closed
+		self.assertEqual(parse_json_response("```json\n" + complete + "\n```"), json.loads(complete))
+		self.assertEqual(parse_json_response("Here it is: " + complete[:-1] + ",}"), json.loads(complete))
+		self.assertIsNone(parse_json_response(truncated))
+
+		# Asked again with more room instead of a repair turn
+		request = {"max_tokens": 100, "messages": [{"role": "user", "content": "Extract"}]}
+		completions = FakeCompletions((truncated, "length"), complete)
+		resp, _, errors = complete_request(prompt, completions, request, schema)
+		self.assertEqual((json.loads(resp), errors), (json.loads(complete), []))
+		self.assertEqual(completions.requests[1]["max_tokens"], 200)
+		self.assertEqual(completions.requests[1]["messages"], request["messages"])
+
+		# Without max_tokens more room cannot be asked for, the answer fails
+		request = {"messages": [{"role": "user", "content": "Extract"}]}
+		completions = FakeCompletions((truncated, "length"))
+		_, _, errors = complete_request(prompt, completions, request, schema)
+		self.assertEqual(errors, [TRUNCATED_ERROR])
+
+	def test_cascade_escalates_on_wrong_totals(self):
+		prompt = frappe._dict(
+			ai_output_mode=JSON_SCHEMA_MODE,
+			max_repair_attempts=0,
+			cascade_model="small-model",
+			invoice_total_path="InvoiceDetails.NetTotal",
+		)
+		request = {"model": "large-model", "messages": [{"role": "user", "content": "Extract"}]}
+		schema = CompiledSchema({"type": "object"})
+		invoice = {
+			"InvoiceDetails": {"NetTotal": 30},
+			"ItemsPurchased": {"ItemList": [{"Total": 10}, {"Total": 20}]},
+		}
+		self.assertEqual(check_invoice_totals(prompt, invoice), [])
+
+		# A correct answer of the small model is used as is
+		small = FakeCompletions(json.dumps(invoice))
+		large = FakeCompletions()
+		_, _, errors, model = complete_with_cascade(prompt, large, request, schema, small)
+		self.assertEqual((errors, model), ([], "small-model"))
+		self.assertEqual(small.requests[0]["model"], "small-model")
+
+		# Line totals that do not add up escalate to the configured model
+		wrong = {**invoice, "InvoiceDetails": {"NetTotal": 35}}
+		self.assertEqual(len(check_invoice_totals(prompt, wrong)), 1)
+		small = FakeCompletions(json.dumps(wrong))
+		large = FakeCompletions(json.dumps(invoice))
+		resp, _, errors, model = complete_with_cascade(prompt, large, request, schema, small)
+		self.assertEqual((errors, model), ([], "large-model"))
+		self.assertEqual(json.loads(resp), invoice)
+
+	def test_remove_repeated_lines(self):
+		header = "Muster GmbH - Rechnung R-1001"
+		pages = [
+			[header, "Pos Artikel Menge Preis", "1 Screw M8 10 1,20", "5 Washer 3 0,30", "Seite 1 von 3"],
+			[header, "6 Bolt 4 9,99", "7 Nut M4 6 0,60", "Lieferung frei Haus", "Seite 2 von 3"],
+			[header, "6 Bolt 4 9,99", "8 Nut M6 2 0,80", "Summe 24,99", "Seite 3 von 3"],
+		]
+		text = remove_repeated_lines("\f".join("\n".join(page) for page in pages))
+		pages = [page.split("\n") for page in text.split("\f")]
+
+		# The running header is kept on the first page only
+		self.assertEqual([page.count(header) for page in pages], [1, 0, 0])
+		# Item lines at a page edge stay, even when the same line repeats
+		self.assertEqual(pages[1][:2], ["6 Bolt 4 9,99", "7 Nut M4 6 0,60"])
+		self.assertEqual(pages[2][0], "6 Bolt 4 9,99")
+		# Page numbers differ, lines seen on one page only stay
+		self.assertIn("Seite 2 von 3", pages[1])
+		self.assertIn("Lieferung frei Haus", pages[1])
+
+	def test_learn_supplier_boilerplate(self):
+		# A new supplier and new lines, whatever earlier runs left in redis
+		supplier = f"_Test Boilerplate {frappe.generate_hash(length=8)}"
+		legal = f"Es gelten unsere Allgemeinen Geschaeftsbedingungen, siehe Website {supplier}"
+		bank = f"Bankverbindung    Musterbank    Kontoinhaber Handelshaus {supplier}"
+		text = f"Rechnung R-1001\n{legal}\n{bank}\n1 Schraube M8 10 1,20"
+		prompt = frappe._dict(linearize_tables=1, strip_supplier_boilerplate=1)
+
+		# Creating the supplier again counts the same document once
+		for _ in range(3):
+			learn_supplier_boilerplate(prompt, supplier, "Muster Handel", "PD-1", text)
+		self.assertEqual(compact_fulltext(prompt, text), linearize_tables(text))
+
+		for document in ("PD-2", "PD-3"):
+			learn_supplier_boilerplate(prompt, supplier, "Muster Handel", document, text)
+		# Lines are learned as they are after table linearization
+		self.assertEqual(compact_fulltext(prompt, text), "Rechnung R-1001\n1 Schraube M8 10 1,20")
+
+	def test_split_fulltext(self):
+		lines = [f"{i} Bolt M{i} 1,00\n" for i in range(1, 31)]
+		chunks = split_fulltext("".join(lines), 20, 5)
+		self.assertTrue(all(len(chunk) <= (20 + 5) * CHARS_PER_TOKEN for chunk in chunks))
+		# Every chunk but the first starts with the last line of the one before
+		for previous, chunk in zip(chunks, chunks[1:]):
+			self.assertTrue(previous.endswith(chunk.split("\n")[0] + "\n"))
+
+		# A hard-wrapped line repeats the overlap once and stays in order
+		text = "Header line\n" + "".join(f"word{i:03d} " for i in range(100)) + "\nFooter\n"
+		chunks = split_fulltext(text, 40, 5)
+		self.assertEqual(sum(chunk.count("Header line") for chunk in chunks), 2)
+		rebuilt = chunks[0]
+		for chunk in chunks[1:]:
+			overlap = next(size for size in range(len(chunk), -1, -1) if rebuilt.endswith(chunk[:size]))
+			rebuilt += chunk[overlap:]
+		self.assertEqual(rebuilt.rstrip("\n"), text.rstrip("\n"))
+
+	def test_merge_results(self):
+		def get_result(*names):
+			return {"ItemsPurchased": {"ItemList": [{"ItemName": name, "Quantity": 1} for name in names]}}
+
+		# Without overlap identical items at a boundary are real lines
+		chunks = ["Nut\nBolt\n", "Bolt\nWasher\n"]
+		merged = merge_results({}, [get_result("Nut", "Bolt"), get_result("Bolt", "Washer")], chunks, 0)
+		self.assertEqual(len(merged["ItemsPurchased"]["ItemList"]), 4)
+
+		# With overlap only the items of the repeated lines are dropped
+		chunks = ["Bolt\nNut\nBolt\n", "Bolt\nBolt\nWasher\n"]
+		results = [get_result("Bolt", "Nut", "Bolt"), get_result("Bolt", "Bolt", "Washer")]
+		merged = merge_results({}, results, chunks, 2)
+		names = [item["ItemName"] for item in merged["ItemsPurchased"]["ItemList"]]
+		self.assertEqual(names, ["Bolt", "Nut", "Bolt", "Bolt", "Washer"])
@@ -1,4 +1,23 @@
 frappe.ui.form.on("AI Query", {
+    onload: function(frm) {
+        // Show partial results while a streamed response is arriving
+        frappe.realtime.off("ai_query_partial");
+        frappe.realtime.on("ai_query_partial", (data) => {
+            if (data.ai_query !== frm.doc.name) {
+                return;
+            }
+            if (data.done) {
+                frm.reload_doc();
+                return;
+            }
+            frm.doc.ai_response = data.ai_response;
+            if (data.partial_json) {
+                frm.doc.ai_response_json = JSON.stringify(data.partial_json, null, 2);
+            }
+            frm.refresh_field("ai_response");
+            frm.refresh_field("ai_response_json");
+        });
+    },
     refresh: function(frm) {
         frm.add_custom_button(__('Create Supplier'), () => {
             frappe.call({
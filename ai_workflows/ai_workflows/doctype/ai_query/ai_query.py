@@ -1,32 +1,89 @@
 # Copyright (c) 2024, itsdave GmbH and contributors
 # For license information, please see license.txt
 
+import hashlib
 import json
 import re
 import frappe
 import random
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from frappe.model.document import Document
-from frappe.utils.password import get_decrypted_password
-from frappe.utils import getdate, validate_email_address, today
-from openai import OpenAI
+from frappe.utils import cint, getdate, validate_email_address, today
 from erpnext.controllers.accounts_controller import get_taxes_and_charges
+from ai_workflows.ai_workflows.ai_client import INTERFACES, get_backend, get_chat_completions
+from ai_workflows.ai_workflows.cascade import check_invoice_totals, get_model_settings
+from ai_workflows.ai_workflows.chunking import (
+    can_chunk,
+    get_header_schema,
+    get_header_text,
+    get_items_schema,
+    merge_results,
+    split_fulltext,
+)
+from ai_workflows.ai_workflows.compaction import compact_fulltext, learn_supplier_boilerplate
+from ai_workflows.ai_workflows.duplicates import (
+    add_to_duplicate_index,
+    find_duplicate_query,
+    is_duplicate_detection_enabled,
+)
+from ai_workflows.ai_workflows.extraction_templates import extract_with_template
+from ai_workflows.ai_workflows.few_shot import get_few_shot_examples, get_few_shot_messages
+from ai_workflows.ai_workflows.partial_json import parse_partial_json
+from ai_workflows.ai_workflows.tokens import (
+    add_usage,
+    count_request_tokens,
+    count_tokens,
+    get_cost,
+    get_usage,
+    truncate_to_tokens,
+)
+from ai_workflows.ai_workflows.supplier_index import get_supplier_index
+from ai_workflows.ai_workflows.tracing import set_trace_ai_query, trace, traced
+from ai_workflows.ai_workflows.doctype.ai_workflow_purchase_invoice_settings.ai_workflow_purchase_invoice_settings import (
+    get_purchase_invoice_settings,
+)
+from ai_workflows.ai_workflows.schema_validation import (
+    FUNCTION_CALL_MODE,
+    JSON_SCHEMA_MODE,
+    drop_null_optionals,
+    get_compiled_schema,
+    get_repair_messages,
+    is_structured,
+    parse_json_response,
+)
+from ai_workflows.ai_workflows.response_cache import (
+    get_cache_key,
+    get_cached_response,
+    set_cached_response,
+)
 
 if 'frappe_goes_paperless' in frappe.get_installed_apps():
     from frappe_goes_paperless.frappe_goes_paperless.tools import get_paperless_settings
 
+# Start of the system prompt of the structured output modes
+SYSTEM_INSTRUCTION = "You are a wizard that generates invoice details in JSON format."
 
-class AIQuery(Document):
-    pass
+# Defaults for call_ai_batch
+BATCH_COMMIT_SIZE = 50
+BATCH_JOB_TIMEOUT = 3600
 
-# Get settings from AI doctype settings
-def get_ai_settings(doc_ai):
-    doc_ai = frappe.get_doc("AI", doc_ai)
+# Estimated tokens per chunk when chunking is enabled without a size
+DEFAULT_CHUNK_SIZE = 3000
+
+# Seconds between realtime updates while a response is streamed
+STREAM_PUBLISH_INTERVAL = 0.5
+# Answers cut off at max_tokens are incomplete, closing their brackets would hide lost items
+TRUNCATED_ERROR = "$: the answer was cut off at max_tokens"
+# Naming series for Items created from invoice lines
+ITEM_NAMING_SERIES = "ITEM-.#####"
+# Supplier fields set by create_supplier
+SUPPLIER_UPDATE_FIELDS = ("tax_id", "supplier_primary_address", "supplier_primary_contact")
 
-    api_key = get_decrypted_password(
-        doctype="AI", name=doc_ai.name, fieldname="api_key", raise_exception=False
-    )
-    return api_key
+
+class AIQuery(Document):
+    pass
 
 
 def get_country(code_country):
@@ -46,15 +103,16 @@ def call_ai(ai, prompt, doc, background=True):
         doc_ai = frappe.get_doc("AI", ai)
     except frappe.DoesNotExistError:
         return "AI not found!"
-    if doc_ai.interface == "openAI":
+    # openAI and OpenAI compatible servers share one client, see ai_client.Backend
+    if doc_ai.interface in INTERFACES:
         if background:
             jobId = frappe.enqueue(
-                "frappe_goes_paperless.frappe_goes_paperless.doctype.paperless_document.paperless_document.use_openai",
+                "ai_workflows.ai_workflows.doctype.ai_query.ai_query.use_openai",
                 queue="short",
                 now=False,
                 doc=doc,
                 prompt=prompt,
-                ai_config=doc_ai.name,
+                ai_name=doc_ai.name,
                 background=True,
             )
             return jobId
@@ -67,72 +125,692 @@ def call_ai(ai, prompt, doc, background=True):
 def use_openai(doc, prompt, ai_name, background=True):
     print("Initiate get ai data ...")
 
-    client = OpenAI(api_key=get_ai_settings(ai_name))
-    doc = json.loads(doc)
+    new_query = run_ai_query(json.loads(doc), prompt, ai_name, background)
+
+    # Return success
+    if background:
+        frappe.publish_realtime(
+            "msgprint_end", "Response received successfully, fields updated!"
+        )
+        return True
+    else:
+        return f'AI query sucessfull. <a href="{frappe.utils.get_url()}/app/ai-query/{new_query.name}">Check out response</a>.'
+
 
+@traced("use_openai")
+def run_ai_query(doc, prompt, ai_name, background=True):
+    """
+    Extracts a Paperless Document (dict with name and document_fulltext) with
+    the given AI Prompt and returns the saved AI Query.
+    """
     # get prompt
     prompt = frappe.get_doc("AI Prompt", prompt)
-    # check AI mode
-    if prompt.ai_output_mode == "Structured Output (JSON)":
-        effective_prompt = f"{prompt.long_text_fnbe}\n\n{doc.get('document_fulltext')}"
-        json_schema = (
-            json.loads(prompt.json_scema)
-            if type(prompt.json_scema) == str
-            else prompt.json_scema
+
+    # A rescan of an extracted document reuses its AI Query instead of the LLM
+    check_duplicates = is_duplicate_detection_enabled()
+    if check_duplicates:
+        with trace("duplicate_check"):
+            duplicate_of = find_duplicate_query(prompt.name, doc.get("name"), doc.get("document_fulltext"))
+        if duplicate_of:
+            return save_duplicate_query(doc.get("name"), ai_name, duplicate_of)
+
+    # Recurring layouts of known suppliers are extracted with learned rules
+    if prompt.get("enable_extraction_templates"):
+        with trace("template_extraction"):
+            template, resp = extract_with_template(prompt, doc.get("document_fulltext"))
+        if template:
+            return save_template_query(prompt, doc, ai_name, template, resp, check_duplicates)
+
+    document_fulltext = compact_fulltext(prompt, doc.get("document_fulltext"))
+    effective_prompt, request = build_openai_request(
+        prompt, document_fulltext, ai_name=ai_name, paperless_doc=doc.get("name")
+    )
+
+    # Identical requests are answered from the response cache
+    cache_key = get_cache_key(prompt.ai_output_mode, request)
+    resp = get_cached_response(cache_key)
+    from_cache = resp is not None
+    new_query = None
+    streamed = False
+    usage = {}
+    errors = []
+    model = request.get("model")
+    if not from_cache:
+        with trace("llm"):
+            completions = get_chat_completions(ai_name)
+            compiled_schema = get_compiled_schema(prompt) if is_structured(prompt) else None
+            chunks = get_chunks(prompt, document_fulltext)
+            if len(chunks) > 1:
+                resp, usage, errors = extract_chunked(prompt, ai_name, completions, chunks)
+            elif not background and frappe.get_cached_value("AI", ai_name, "stream_responses"):
+                # Stream into an existing AI Query so its form can follow along
+                new_query = create_ai_query(prompt, doc.get("name"), ai_name, effective_prompt, "")
+                new_query.insert()
+                frappe.db.commit()
+                frappe.publish_realtime(
+                    "ai_query_stream_started",
+                    {"ai_query": new_query.name, "paperless_doc": doc.get("name")},
+                    user=frappe.session.user,
+                )
+                try:
+                    resp, usage, finish_reason = completions.stream(
+                        on_update=get_stream_publisher(new_query.name), **request
+                    )
+                    streamed = True
+                    if compiled_schema:
+                        resp, usage, errors = repair_structured_response(
+                            prompt,
+                            completions,
+                            request,
+                            compiled_schema,
+                            resp,
+                            usage,
+                            truncated=finish_reason == "length",
+                        )
+                except Exception as e:
+                    save_failed_stream(new_query, e)
+                    raise
+            else:
+                # Interactive calls may hedge against slow responses
+                resp, usage, errors, model = complete_with_cascade(
+                    prompt,
+                    completions,
+                    request,
+                    compiled_schema,
+                    get_cascade_completions(prompt, ai_name),
+                    hedge=not background,
+                )
+            # Responses still invalid after repairs are not reused
+            if not errors:
+                set_cached_response(cache_key, resp, prompt.ai_output_mode, model)
+
+    # add doctype AI Query
+    if new_query:
+        set_ai_response(new_query, resp, is_structured(prompt), errors)
+    else:
+        new_query = create_ai_query(
+            prompt, doc.get("name"), ai_name, effective_prompt, resp, from_cache=from_cache, errors=errors
         )
-        chat_response = client.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a wizard that generates invoice details in JSON format.",
+    new_query.response_cache_key = cache_key
+    set_usage(new_query, usage, model)
+    # save query ai
+    with trace("ai_query_save"):
+        new_query.save()
+    set_trace_ai_query(new_query.name)
+    if check_duplicates and not new_query.validation_errors:
+        add_to_duplicate_index(prompt.name, new_query.name, doc.get("document_fulltext"))
+    set_ai_response_received(doc.get("name"))
+    frappe.db.commit()
+    if streamed:
+        # Let the AI Query form load the final response
+        frappe.publish_realtime(
+            "ai_query_partial",
+            {"ai_query": new_query.name, "done": True},
+            doctype="AI Query",
+            docname=new_query.name,
+        )
+    return new_query
+
+
+def save_failed_stream(new_query, error):
+    # Keep the committed AI Query with the error and let its form stop following
+    frappe.db.rollback()
+    new_query.reload()
+    new_query.validation_errors = f"$: streaming failed: {str(error) or type(error).__name__}"
+    new_query.save()
+    frappe.db.commit()
+    frappe.publish_realtime(
+        "ai_query_partial",
+        {"ai_query": new_query.name, "done": True},
+        doctype="AI Query",
+        docname=new_query.name,
+    )
+
+
+def save_duplicate_query(paperless_doc, ai_name, duplicate_of):
+    """
+    Saves an AI Query with the response, supplier and Purchase Invoice of the
+    AI Query of the near-duplicate, so the workflow creates neither again.
+    """
+    original = frappe.get_doc("AI Query", duplicate_of)
+    new_query = frappe.new_doc("AI Query")
+    for field in (
+        "document_type",
+        "document",
+        "supplier",
+        "ai_prompt_template",
+        "effective_prompt",
+        "ai_response",
+        "ai_response_json",
+        "model",
+    ):
+        new_query.set(field, original.get(field))
+    new_query.paperless_doc = paperless_doc
+    new_query.ai = ai_name
+    new_query.duplicate_of = duplicate_of
+    with trace("ai_query_save"):
+        new_query.insert()
+    set_trace_ai_query(new_query.name)
+    set_ai_response_received(paperless_doc)
+    frappe.db.commit()
+    return new_query
+
+
+def save_template_query(prompt, doc, ai_name, template, resp, index_duplicates=False):
+    # AI Query of a document extracted with an AI Extraction Template
+    new_query = create_ai_query(prompt, doc.get("name"), ai_name, "", resp)
+    new_query.extraction_template = template
+    with trace("ai_query_save"):
+        new_query.insert()
+    set_trace_ai_query(new_query.name)
+    if index_duplicates:
+        add_to_duplicate_index(prompt.name, new_query.name, doc.get("document_fulltext"))
+    set_ai_response_received(doc.get("name"))
+    frappe.db.commit()
+    return new_query
+
+
+def set_ai_response_received(paperless_doc):
+    # Load document paperless and set status
+    with trace("paperless_document_save"):
+        doc_paperless = frappe.get_doc("Paperless Document", paperless_doc)
+        doc_paperless.status = "AI-Response-Received"
+        doc_paperless.save()
+
+
+def get_stream_publisher(ai_query):
+    # Push the partial response to the AI Query form, at most every STREAM_PUBLISH_INTERVAL
+    last_publish = [0]
+
+    def publish(text):
+        now = time.monotonic()
+        if now - last_publish[0] < STREAM_PUBLISH_INTERVAL:
+            return
+        last_publish[0] = now
+        frappe.publish_realtime(
+            "ai_query_partial",
+            {
+                "ai_query": ai_query,
+                "ai_response": text,
+                "partial_json": parse_partial_json(text),
+            },
+            doctype="AI Query",
+            docname=ai_query,
+        )
+
+    return publish
+
+
+@frappe.whitelist()
+def call_ai_batch(ai, prompt, docs):
+    # Run many Paperless Documents through one AI inside a single background job
+    if isinstance(docs, str):
+        docs = json.loads(docs)
+    if not docs:
+        return "No documents selected!"
+    # Get AI
+    try:
+        doc_ai = frappe.get_doc("AI", ai)
+    except frappe.DoesNotExistError:
+        return "AI not found!"
+    jobId = frappe.enqueue(
+        "ai_workflows.ai_workflows.doctype.ai_query.ai_query.use_openai_batch",
+        queue="long",
+        timeout=BATCH_JOB_TIMEOUT,
+        now=False,
+        docs=docs,
+        prompt=prompt,
+        ai_name=doc_ai.name,
+        user=frappe.session.user,
+    )
+    return jobId
+
+
+def use_openai_batch(docs, prompt, ai_name, user=None):
+    """
+    Sends the requests for all documents concurrently and writes the AI Queries
+    in the job's own transaction, committing every BATCH_COMMIT_SIZE documents.
+
+    Only the HTTP calls run in the thread pool, all database work stays on the
+    job's thread.
+    """
+    prompt = frappe.get_doc("AI Prompt", prompt)
+    # Self-hosted servers batch whatever arrives concurrently, so keep them busy
+    concurrency = get_backend(ai_name).concurrency
+
+    # Build all requests first, cache hits need no API call
+    items = []
+    for doc in docs:
+        doc = get_paperless_document_data(doc)
+        effective_prompt, request = build_openai_request(
+            prompt,
+            compact_fulltext(prompt, doc.get("document_fulltext")),
+            ai_name=ai_name,
+            paperless_doc=doc.get("name"),
+        )
+        cache_key = get_cache_key(prompt.ai_output_mode, request)
+        items.append(
+            frappe._dict(
+                paperless_doc=doc.get("name"),
+                effective_prompt=effective_prompt,
+                request=request,
+                cache_key=cache_key,
+                resp=get_cached_response(cache_key),
+            )
+        )
+
+    progress = frappe._dict(done=0, failed=0, total=len(items))
+    for item in items:
+        if item.resp is not None:
+            save_batch_ai_query(prompt, ai_name, item, progress, user, from_cache=True)
+
+    completions = get_chat_completions(ai_name)
+    cascade_completions = get_cascade_completions(prompt, ai_name)
+    compiled_schema = get_compiled_schema(prompt) if is_structured(prompt) else None
+    pending = [item for item in items if item.resp is None]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(
+                complete_with_cascade,
+                prompt,
+                completions,
+                item.request,
+                compiled_schema,
+                cascade_completions,
+            ): item
+            for item in pending
+        }
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                item.resp, item.usage, item.errors, item.model = future.result()
+            except Exception:
+                frappe.log_error(
+                    title=f"AI batch request failed for {item.paperless_doc}",
+                    message=frappe.get_traceback(),
+                )
+                progress.failed += 1
+                publish_batch_progress(progress, item, user, error=True)
+                continue
+            if not item.errors:
+                set_cached_response(item.cache_key, item.resp, prompt.ai_output_mode, item.model)
+            save_batch_ai_query(prompt, ai_name, item, progress, user)
+
+    frappe.db.commit()
+    frappe.publish_realtime(
+        "msgprint_end",
+        f"AI batch finished: {progress.done} of {progress.total} documents processed, {progress.failed} failed.",
+        user=user,
+    )
+    return progress
+
+
+def save_batch_ai_query(prompt, ai_name, item, progress, user, from_cache=False):
+    new_query = create_ai_query(
+        prompt,
+        item.paperless_doc,
+        ai_name,
+        item.effective_prompt,
+        item.resp,
+        from_cache=from_cache,
+        errors=item.get("errors"),
+    )
+    new_query.response_cache_key = item.cache_key
+    set_usage(new_query, item.get("usage"), item.get("model") or item.request.get("model"))
+    new_query.insert()
+    frappe.db.set_value(
+        "Paperless Document", item.paperless_doc, "status", "AI-Response-Received"
+    )
+    item.ai_query = new_query.name
+
+    progress.done += 1
+    if progress.done % BATCH_COMMIT_SIZE == 0:
+        frappe.db.commit()
+    publish_batch_progress(progress, item, user)
+
+
+def publish_batch_progress(progress, item, user, error=False):
+    frappe.publish_realtime(
+        "ai_batch_progress",
+        {
+            "paperless_doc": item.paperless_doc,
+            "ai_query": item.get("ai_query"),
+            "error": error,
+            "done": progress.done,
+            "failed": progress.failed,
+            "total": progress.total,
+        },
+        user=user,
+    )
+
+
+def get_paperless_document_data(doc):
+    # Accept a Paperless Document name, a dict or its JSON representation
+    if isinstance(doc, str):
+        try:
+            doc = json.loads(doc)
+        except json.JSONDecodeError:
+            pass
+    if isinstance(doc, str):
+        return frappe.db.get_value(
+            "Paperless Document", doc, ["name", "document_fulltext"], as_dict=True
+        )
+    return frappe._dict(doc)
+
+
+def build_openai_request(prompt, document_fulltext, json_schema=None, ai_name=None, paperless_doc=None):
+    # Build the chat completion arguments for an AI Prompt and a document fulltext
+    # Similar confirmed documents as examples, for whole documents only
+    examples = [] if json_schema else get_few_shot_examples(prompt, document_fulltext, paperless_doc)
+    effective_prompt, request = compose_openai_request(
+        prompt, document_fulltext, json_schema, ai_name, examples
+    )
+
+    # Enforce the prompt token budget, dropping the examples before shortening the document text
+    if prompt.max_prompt_tokens and document_fulltext:
+        excess = count_request_tokens(request) - prompt.max_prompt_tokens
+        while excess > 0 and examples:
+            examples = examples[:-1]
+            effective_prompt, request = compose_openai_request(
+                prompt, document_fulltext, json_schema, ai_name, examples
+            )
+            excess = count_request_tokens(request) - prompt.max_prompt_tokens
+        if excess > 0:
+            model = request.get("model")
+            document_fulltext = truncate_to_tokens(
+                document_fulltext,
+                count_tokens(document_fulltext, model) - excess,
+                prompt.truncation_strategy,
+                model,
+            )
+            effective_prompt, request = compose_openai_request(
+                prompt, document_fulltext, json_schema, ai_name, examples
+            )
+    return effective_prompt, request
+
+
+def compose_openai_request(prompt, document_fulltext, json_schema=None, ai_name=None, examples=None):
+    """
+    Instructions, schema and examples first and the document last: requests of
+    a prompt then share their prefix and hit the provider's prompt cache.
+    """
+    # Model, temperature and max_tokens of the AI Prompt, falling back to the AI
+    model_settings = get_model_settings(prompt, ai_name)
+    # check AI mode
+    if prompt.ai_output_mode == JSON_SCHEMA_MODE:
+        compiled_schema = get_compiled_schema(prompt, json_schema)
+        request = {
+            **model_settings,
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "generate_invoice",
+                    "strict": True,
+                    "schema": compiled_schema.strict_schema,
                 },
-                {"role": "user", "content": effective_prompt},
-            ],
-            functions=[
+            },
+        }
+        instructions = [SYSTEM_INSTRUCTION, prompt.long_text_fnbe]
+    elif prompt.ai_output_mode == FUNCTION_CALL_MODE:
+        json_schema = json_schema or get_json_schema(prompt)
+        request = {
+            **model_settings,
+            "functions": [
                 {
                     "name": "generate_invoice",
                     "description": "Generates an invoice based on the provided schema.",
                     "parameters": json_schema,
                 }
             ],
-            function_call={"name": "generate_invoice"},
-        )
-        if chat_response.choices:
-            function_call = chat_response.choices[0].message.function_call
-            if function_call:
-                resp = function_call.arguments
-            else:
-                resp = ""
-        else:
-            resp = ""
+            "function_call": {"name": "generate_invoice"},
+        }
+        instructions = [SYSTEM_INSTRUCTION, prompt.long_text_fnbe]
     # else if AI mode is Chat or None
     else:
-        # concat fulltext and prompt
-        effective_prompt = f"{prompt.long_text_fnbe}\n\n{doc.get('document_fulltext')}"
-        # init chat
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": effective_prompt,
-                }
-            ],
-            model="chatgpt-4o-latest",
+        request = {**model_settings}
+        instructions = [prompt.long_text_fnbe]
+
+    system_prompt = "\n\n".join(part for part in instructions if part)
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    messages += get_few_shot_messages(examples or [])
+    messages.append({"role": "user", "content": document_fulltext or ""})
+    request["messages"] = messages
+    if ai_name and not get_backend(ai_name).is_compatible:
+        request["prompt_cache_key"] = get_prompt_cache_key(request)
+    effective_prompt = "\n\n".join(message["content"] for message in messages)
+    return effective_prompt, request
+
+
+def get_prompt_cache_key(request):
+    """
+    Same key for all requests of a prompt with the same model, instructions
+    and schema, so the provider routes them to the machine holding the cached
+    prefix. Examples differ per document and are left out.
+    """
+    prefix = {key: value for key, value in request.items() if key not in ("messages", "prompt_cache_key")}
+    prefix["system"] = [message for message in request["messages"] if message["role"] == "system"]
+    payload = json.dumps(prefix, sort_keys=True, separators=(",", ":"), default=str)
+    return "ai_workflows-" + hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def set_usage(new_query, usage, model=None):
+    # Store token usage and cost of the request on the AI Query
+    new_query.model = model
+    if not usage:
+        return
+    new_query.prompt_tokens = usage.get("prompt_tokens", 0)
+    new_query.completion_tokens = usage.get("completion_tokens", 0)
+    new_query.cached_tokens = usage.get("cached_tokens", 0)
+    prices = frappe.get_cached_value(
+        "AI",
+        new_query.ai,
+        ["input_token_price", "cached_input_token_price", "output_token_price"],
+        as_dict=True,
+    )
+    new_query.cost = get_cost(usage, prices or {})
+
+
+def get_json_schema(prompt):
+    return (
+        json.loads(prompt.json_scema)
+        if type(prompt.json_scema) == str
+        else prompt.json_scema
+    )
+
+
+def get_chunks(prompt, document_fulltext):
+    # Split long documents when chunking is enabled and the schema has an item list
+    document_fulltext = document_fulltext or ""
+    if (
+        not prompt.enable_chunking
+        or not is_structured(prompt)
+        or not can_chunk(get_json_schema(prompt))
+    ):
+        return [document_fulltext]
+    return split_fulltext(
+        document_fulltext,
+        prompt.chunk_size or DEFAULT_CHUNK_SIZE,
+        prompt.chunk_overlap or 0,
+    )
+
+
+def extract_chunked(prompt, ai_name, completions, chunks):
+    """
+    Map-reduce extraction for long documents: header fields are extracted once
+    from the first and last chunk, the item list from every chunk in parallel,
+    then everything is merged into one result for the full schema.
+    Returns the merged JSON, the summed usage and its validation errors.
+    """
+    json_schema = get_json_schema(prompt)
+    _, header_request = build_openai_request(
+        prompt, get_header_text(chunks), get_header_schema(json_schema), ai_name
+    )
+    items_schema = get_items_schema(json_schema)
+    requests = [header_request] + [
+        build_openai_request(prompt, chunk, items_schema, ai_name)[1] for chunk in chunks
+    ]
+    # Every part is validated and repaired against its own sub-schema
+    header_compiled_schema = get_compiled_schema(prompt, get_header_schema(json_schema))
+    items_compiled_schema = get_compiled_schema(prompt, items_schema)
+    compiled_schemas = [header_compiled_schema] + [items_compiled_schema] * len(chunks)
+
+    concurrency = get_backend(ai_name).concurrency
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        responses = list(
+            executor.map(
+                lambda args: complete_request(prompt, completions, *args),
+                zip(requests, compiled_schemas),
+            )
         )
-        if chat_completion.choices:
-            resp = chat_completion.choices[0].message.content
+
+    results = []
+    usage = {}
+    for resp, part_usage, _ in responses:
+        add_usage(usage, part_usage)
+        results.append(parse_json_response(resp) or {})
+    merged = merge_results(results[0], results[1:], chunks, prompt.chunk_overlap or 0)
+    errors = get_compiled_schema(prompt).validate(merged) or check_invoice_totals(prompt, merged)
+    return json.dumps(merged), usage, errors
+
+
+def is_truncated(chat_response):
+    # The answer stopped at max_tokens
+    return bool(chat_response.choices) and chat_response.choices[0].finish_reason == "length"
+
+
+def parse_openai_response(prompt, chat_response):
+    # Extract the raw answer text from a chat completion
+    if not chat_response.choices:
+        return ""
+    message = chat_response.choices[0].message
+    if prompt.ai_output_mode == FUNCTION_CALL_MODE:
+        return message.function_call.arguments if message.function_call else ""
+    return message.content or ""
+
+
+def get_cascade_completions(prompt, ai_name):
+    # Completions for the small model tried first, None without a cascade
+    if not (prompt.enable_cascade and prompt.cascade_model and is_structured(prompt)):
+        return None
+    return get_chat_completions(prompt.cascade_ai or ai_name)
+
+
+def complete_with_cascade(
+    prompt, completions, request, compiled_schema=None, cascade_completions=None, **kwargs
+):
+    """
+    Tries the prompt's cascade model first, without repair turns, and only
+    escalates to the configured model when its answer fails the schema or the
+    total check. Returns (resp, usage, validation errors, model used).
+    """
+    usage = {}
+    if cascade_completions and compiled_schema:
+        cascade_request = {**request, "model": prompt.cascade_model.strip()}
+        try:
+            resp, usage, errors = complete_request(
+                prompt, cascade_completions, cascade_request, compiled_schema, repair_attempts=0
+            )
+            if not errors:
+                return resp, usage, errors, cascade_request["model"]
+        except Exception:
+            # The configured model still gets its chance
+            pass
+    resp, request_usage, errors = complete_request(
+        prompt, completions, request, compiled_schema, **kwargs
+    )
+    add_usage(usage, request_usage)
+    return resp, usage, errors, request.get("model")
+
+
+def complete_request(prompt, completions, request, compiled_schema=None, repair_attempts=None, **kwargs):
+    """
+    Runs one chat completion and, for structured modes, validates and repairs
+    the answer. Only talks HTTP, so it can run in worker threads.
+    Returns (resp, usage, validation errors).
+    """
+    chat_response = completions.create(**kwargs, **request)
+    resp = parse_openai_response(prompt, chat_response)
+    usage = get_usage(chat_response)
+    if not compiled_schema:
+        return resp, usage, []
+    return repair_structured_response(
+        prompt,
+        completions,
+        request,
+        compiled_schema,
+        resp,
+        usage,
+        repair_attempts,
+        truncated=is_truncated(chat_response),
+    )
+
+
+def repair_structured_response(
+    prompt, completions, request, compiled_schema, resp, usage, repair_attempts=None, truncated=False
+):
+    """
+    Validates a structured answer against the compiled schema and the total
+    check. Syntax defects like code fences are repaired locally, violations
+    are sent back to the model up to max_repair_attempts times (not when
+    completions is None). Answers cut off at max_tokens are never completed
+    locally, they are requested again with twice the max_tokens or fail, so a
+    cascade escalates. Valid answers are returned as compact JSON.
+    """
+    if completions is None:
+        attempts = 0
+    elif repair_attempts is not None:
+        attempts = repair_attempts
+    else:
+        attempts = cint(prompt.max_repair_attempts)
+    for attempt in range(attempts + 1):
+        data = None if truncated else parse_json_response(resp)
+        if truncated:
+            errors = [TRUNCATED_ERROR]
+        elif data is None:
+            errors = ["$: the answer is not a JSON object"]
         else:
-            resp = ""
+            errors = compiled_schema.validate(data) or check_invoice_totals(prompt, data)
+        if not errors:
+            return json.dumps(drop_null_optionals(data, compiled_schema.schema)), usage, []
+        if attempt == attempts:
+            break
+        if truncated:
+            # A repair turn would be cut off as well
+            if not request.get("max_tokens"):
+                break
+            request = {**request, "max_tokens": request["max_tokens"] * 2}
+            chat_response = completions.create(**request)
+        else:
+            chat_response = completions.create(
+                **{**request, "messages": get_repair_messages(request, resp, errors)}
+            )
+        add_usage(usage, get_usage(chat_response))
+        resp = parse_openai_response(prompt, chat_response)
+        truncated = is_truncated(chat_response)
+    return resp, usage, errors
 
-    # add doctype AI Query
+
+def create_ai_query(prompt, paperless_doc, ai_name, effective_prompt, resp, from_cache=False, errors=None):
+    # Build a new AI Query from a response, the caller saves it
     new_query = frappe.new_doc("AI Query")
     new_query.document_type = prompt.for_doctype
-    new_query.paperless_doc = doc.get("name")
+    new_query.paperless_doc = paperless_doc
     new_query.ai = ai_name
-    new_query.ai_prompt_template = prompt
+    new_query.ai_prompt_template = prompt.name
     new_query.effective_prompt = effective_prompt
+    new_query.served_from_cache = 1 if from_cache else 0
+    set_ai_response(new_query, resp, is_structured(prompt), errors)
+    return new_query
+
+
+def set_ai_response(new_query, resp, structured=False, errors=None):
     new_query.ai_response = resp.strip() if resp else ""
+    new_query.validation_errors = "\n".join(errors or [])
+
+    # Structured responses were already parsed and validated
+    if structured:
+        new_query.ai_response_json = new_query.ai_response
+        return
 
     json_pattern = r"\{.*\}"
     if resp is not None:
@@ -149,25 +827,12 @@ def use_openai(doc, prompt, ai_name, background=True):
             new_query.ai_response_json = f"Error on decode JSON: {e}"
     else:
         new_query.ai_response_json = "The content is not in JSON format"
-    # save query ai
-    new_query.save()
-    # Load document paperless and set status
-    doc_paperless = frappe.get_doc("Paperless Document", doc.get("name"))
-    doc_paperless.status = "AI-Response-Received"
-    doc_paperless.save()
-    frappe.db.commit()
-    # Return success
-    if background:
-        frappe.publish_realtime(
-            "msgprint_end", "Response received successfully, fields updated!"
-        )
-        return True
-    else:
-        return f'AI query sucessfull. <a href="{frappe.utils.get_url()}/app/ai-query/{new_query.name}">Check out response</a>.'
 
 @frappe.whitelist()
+@traced("create_supplier")
 def create_supplier(doc):
     doc = json.loads(doc)
+    set_trace_ai_query(doc.get("name"))
 
     # Extract JSON data
     json_data = doc.get("ai_response_json")
@@ -182,16 +847,9 @@ def create_supplier(doc):
     supplier_ust_id = invoice_details.get("SupplierUstId")
     supplier_name = invoice_details.get("SupplierName")
 
-    # First, try to find the supplier by tax_id (SupplierUstId)
-    supplier = None
-    if supplier_ust_id:
-        supplier = frappe.db.get_value("Supplier", {"tax_id": supplier_ust_id}, "name")
-
-    # If supplier not found by tax_id, fall back to supplier_name
-    if not supplier:
-        supplier = frappe.db.get_value(
-            "Supplier", {"supplier_name": supplier_name}, "name"
-        )
+    # Find the supplier by tax_id (SupplierUstId), normalized or fuzzy supplier_name
+    with trace("supplier_lookup"):
+        supplier = get_supplier_index().lookup(supplier_ust_id, supplier_name)
 
     # When its there, we need to fetch the Document
     if supplier:
@@ -212,18 +870,34 @@ def create_supplier(doc):
         print(f"Supplier '{supplier.supplier_name}' created successfully!")
         return_msg = "Supplier created successfully"
     else:
-        # Update the existing supplier with the tax_id if not already set
-        supplier_doc = frappe.get_doc("Supplier", supplier)
-        if supplier_ust_id and not supplier_doc.tax_id:
-            supplier_doc.tax_id = supplier_ust_id
-            supplier_doc.save()
         return_msg = "Supplier already exists, updated successfully"
 
+    # The supplier is only saved again when one of these fields changes
+    saved_values = {field: supplier.get(field) for field in SUPPLIER_UPDATE_FIELDS}
+
+    # Update the existing supplier with the tax_id if not already set,
+    # it is saved together with address and contact below
+    if supplier_ust_id and not supplier.tax_id:
+        supplier.tax_id = supplier_ust_id
+
     # Update AI Query with supplier
     ai_query_doc = frappe.get_doc("AI Query", doc.get("name"))
     ai_query_doc.supplier = supplier.name
     ai_query_doc.save()
 
+    # Learn boilerplate of this supplier for fulltext compaction
+    prompt = ai_query_doc.ai_prompt_template and frappe.get_cached_doc(
+        "AI Prompt", ai_query_doc.ai_prompt_template
+    )
+    if ai_query_doc.paperless_doc and prompt and prompt.strip_supplier_boilerplate:
+        learn_supplier_boilerplate(
+            prompt,
+            supplier.name,
+            supplier.supplier_name,
+            ai_query_doc.paperless_doc,
+            frappe.db.get_value("Paperless Document", ai_query_doc.paperless_doc, "document_fulltext"),
+        )
+
 
     # Create or update Address
     supplier = create_or_update_address(supplier, invoice_details)
@@ -232,11 +906,14 @@ def create_supplier(doc):
     supplier = create_or_update_contact(supplier, invoice_details, supplier.supplier_primary_address)
 
     # Commit database and return message
-    supplier.save()
+    if any(supplier.get(field) != value for field, value in saved_values.items()):
+        with trace("supplier_save"):
+            supplier.save()
 
     return return_msg
 
 
+@traced("create_or_update_contact")
 def create_or_update_contact(supplier, invoice_details, address_name):
     print("create_or_update_contact")
     contact_person = invoice_details.get(
@@ -332,6 +1009,7 @@ def create_or_update_contact(supplier, invoice_details, address_name):
 
 
 
+@traced("create_or_update_address")
 def create_or_update_address(supplier, invoice_details):
     print("create_or_update_address")
     # Fetch the address name if it exists
@@ -375,8 +1053,10 @@ def create_or_update_address(supplier, invoice_details):
 
 
 @frappe.whitelist()
+@traced("create_purchase_invoice")
 def create_purchase_invoice(doc):
     doc = json.loads(doc)
+    set_trace_ai_query(doc.get("name"))
 
     # Get JSON data
     json_data_str = doc.get("ai_response_json")
@@ -413,28 +1093,25 @@ def create_purchase_invoice(doc):
             frappe.throw("InvoiceDate is missing in the InvoiceDetails.")
 
         # Get supplier from database
-        supplier = frappe.db.get_value("Supplier", {"name": supplier_name})
-        if not supplier:
+        if not frappe.db.exists("Supplier", supplier_name):
             frappe.throw(f"Supplier '{supplier_name}' does not exist.")
 
-        supplier_doc = frappe.get_doc("Supplier", supplier)
-
         # Check if Purchase Invoice already exists for this InvoiceNumber and Supplier, ignoring canceled invoices
         existing_purchase_invoice = frappe.db.exists(
             "Purchase Invoice",
             {
                 "bill_no": invoice_details["InvoiceNumber"],
-                "supplier": supplier_doc.name,
+                "supplier": supplier_name,
                 "docstatus": ["!=", 2],  # Exclude canceled invoices
             },
         )
         if existing_purchase_invoice:
             frappe.msgprint(
-                f"Purchase Invoice with Invoice Number '{invoice_details['InvoiceNumber']}' already exists for supplier '{supplier_doc.name}'."
+                f"Purchase Invoice with Invoice Number '{invoice_details['InvoiceNumber']}' already exists for supplier '{supplier_name}'."
             )
             return
 
-       # Extract due date and posting date
+        # Extract due date and posting date
         invoice_date = invoice_details.get("InvoiceDate")
         due_date = payment_information.get("PaymentDueDate", invoice_date)
 
@@ -458,41 +1135,61 @@ def create_purchase_invoice(doc):
         if due_date_parsed < invoice_date_parsed:
             due_date = invoice_date
 
-        # Create a new Purchase Invoice
+        # Translate PaymentMethod using AI Workflow Payment Terms Assignment,
+        # resolved up front so nothing is inserted when it is missing
+        payment_method_string = payment_information.get("PaymentMethod")
+        ai_settings = get_purchase_invoice_settings()
+        payment_term = ai_settings.get_payment_term(payment_method_string)
+
+        if not payment_term:
+            frappe.throw(
+                f"No payment term found for payment method '{payment_method_string}'"
+            )
 
+        # Build the complete Purchase Invoice so it is validated and inserted only once
         purchase_invoice = frappe.get_doc(
             {
                 "doctype": "Purchase Invoice",
-                "supplier": supplier_doc.name,
+                "supplier": supplier_name,
                 "due_date": due_date,
                 "bill_no": invoice_details["InvoiceNumber"],
                 "bill_date": invoice_details["InvoiceDate"],
                 "items": [],
+                # Link to Paperless Document
+                "custom_paperless_document": doc.get("paperless_doc"),
             }
         )
+
+        # Set posting_date if the InvoiceDate is different from today's date
+        if getdate(invoice_date) != getdate(today()):
+            purchase_invoice.set_posting_time = 1
+            purchase_invoice.posting_date = invoice_date
+
         # Get destination Item Group for new Items
-        item_group = frappe.db.get_single_value(
-            "AI Workflow Purchase Invoice Settings", "default_item_group"
-        )
+        item_group = ai_settings.default_item_group
 
-        # Check and add items to the Purchase Invoice
+        # Ensure all items exist, create if not
         for item in items_purchased:
-
-            item_number = item.get("ItemNumber", None)
             # If ItemNumber is missing, generate a new one
-            if not item_number:
-                item_number = generate_item_number()
-
-            # Ensure the item exists, create if not
-            item_doc_name = create_or_get_item(
-                item_number,
-                item["ItemName"],
-                item["Description"],
-                supplier_doc.name,
-                item_group=item_group,
+            if not item.get("ItemNumber"):
+                item["ItemNumber"] = generate_item_number()
+
+        item_names = create_or_get_items(
+            items_purchased, supplier_name, item_group=item_group
+        )
+
+        # Fetch the stock UOMs of all items in one query
+        stock_uoms = dict(
+            frappe.get_all(
+                "Item",
+                filters={"name": ["in", list(set(item_names))]},
+                fields=["name", "stock_uom"],
+                as_list=True,
             )
-            item_doc = frappe.get_doc("Item", item_doc_name)
+        )
 
+        # Add items to the Purchase Invoice
+        for item, item_name in zip(items_purchased, item_names):
             # Check if quantity and unit price are zero
             if float(item["Quantity"]) == 0 or float(item["UnitPrice"]) == 0:
                 calculated_rate = 0
@@ -515,9 +1212,9 @@ def create_purchase_invoice(doc):
 
             # Create a Purchase Invoice Item entry
             po_item = create_purchase_invoice_doc_item(
-                item_doc.name,
+                item_name,
                 float(item["Quantity"]),
-                item_doc.stock_uom,
+                stock_uoms.get(item_name),
                 calculated_rate,
             )
 
@@ -541,85 +1238,31 @@ def create_purchase_invoice(doc):
             # Add the item to the Purchase Invoice without checking for duplicates
             purchase_invoice.append("items", po_item)
 
-        # Save the Purchase Invoice, which fills taxes_and_charges
-        purchase_invoice.insert()
-
-        # Check if the InvoiceDate is different from today's date, and set posting_date if so
-        if getdate(purchase_invoice.posting_date) != getdate(
-            invoice_details["InvoiceDate"]
-        ):
-            # If different, enable set_posting_time and update posting_date
-            purchase_invoice.set_posting_time = 1
-            purchase_invoice.posting_date = invoice_details["InvoiceDate"]
-            purchase_invoice.save()
-
-        # --- Begin code to handle PaymentMethod and Payment Schedule ---
-
-        # Extract PaymentMethod from payment_information
-        payment_method_string = payment_information.get("PaymentMethod")
-
-        # Translate PaymentMethod using AI Workflow Payment Terms Assignment
-        payment_term = None
-        ai_settings = frappe.get_single("AI Workflow Purchase Invoice Settings")
-        if ai_settings.payment_terms_assignments:
-            for assignment in ai_settings.payment_terms_assignments:
-                if (
-                    assignment.ai_response_paymentmethod_string.lower().strip()
-                    == payment_method_string.lower().strip()
-                ):
-                    payment_term = assignment.payment_term
-                    break
-
-        if not payment_term:
-            frappe.throw(
-                f"No payment term found for payment method '{payment_method_string}'"
-            )
-
-        # Validate that payment_term exists
-        if not frappe.db.exists("Payment Term", payment_term):
-            frappe.throw(f"Payment Term '{payment_term}' does not exist in the system.")
-
-        # Set allocate_payment_based_on_payment_terms to 1
+        # Payment schedule over the full amount, ERPNext computes payment_amount
+        # from the invoice_portion when totals are calculated on insert
         purchase_invoice.allocate_payment_based_on_payment_terms = 1
+        purchase_invoice.append(
+            "payment_schedule",
+            {
+                "doctype": "Payment Schedule",
+                "payment_term": payment_term,
+                "due_date": due_date,
+                "invoice_portion": 100,
+            },
+        )
 
-        # Clear existing payment schedule entries
-        purchase_invoice.set("payment_schedule", [])
-
-        # Calculate payment_amount
-        payment_amount = purchase_invoice.grand_total  # Assuming full amount
-
-        # Get due_date
-        due_date =  purchase_invoice.due_date or payment_information.get("PaymentDueDate")
-
-        # Create payment schedule entry
-        payment_schedule_entry = {
-            "doctype": "Payment Schedule",
-            "payment_term": payment_term,
-            "due_date": due_date,
-            "invoice_portion": 100,
-            "payment_amount": payment_amount,
-        }
-        purchase_invoice.append("payment_schedule", payment_schedule_entry)
-
-        # Save the purchase_invoice with the new payment schedule
-        purchase_invoice.save()
-
-        # --- End code to handle PaymentMethod and Payment Schedule ---
-
-        # Apply Purchase Taxes and Charges Template
-        if purchase_invoice.taxes_and_charges:
+        # Fill taxes_and_charges from the supplier and apply the template before insert
+        purchase_invoice.set_missing_values()
+        if purchase_invoice.taxes_and_charges and not purchase_invoice.get("taxes"):
             taxes_and_charges = get_taxes_and_charges(
                 "Purchase Taxes and Charges Template",
                 purchase_invoice.taxes_and_charges,
             )
             purchase_invoice.set("taxes", taxes_and_charges)
-        
-        #Link to Paperless Document
-        paperless_doc_name = doc.get("paperless_doc")
-        if paperless_doc_name:
-            purchase_invoice.custom_paperless_document = paperless_doc_name
 
-        purchase_invoice.save()
+        # Single validate/insert cycle
+        with trace("purchase_invoice_insert"):
+            purchase_invoice.insert()
 
         # If paperless app is installed:
         if "frappe_goes_paperless" in frappe.get_installed_apps():
@@ -651,9 +1294,7 @@ def create_purchase_invoice(doc):
                     file_doc.save()
 
         # Update AI Query with the Purchase Invoice document
-        ai_query_doc = frappe.get_doc("AI Query", doc.get("name"))
-        ai_query_doc.document = purchase_invoice.name
-        ai_query_doc.save()
+        frappe.db.set_value("AI Query", doc.get("name"), "document", purchase_invoice.name)
 
         # Commit changes to the database
         frappe.db.commit()
@@ -668,52 +1309,90 @@ def create_purchase_invoice(doc):
 
 
 
-def create_or_get_item(
-    supplier_item_code,
-    item_name,
-    item_description,
+@traced("create_or_get_items")
+def create_or_get_items(
+    items_purchased,
     supplier_name,
     item_group="All Item Groups",
     stock_uom="Stk",
 ):
-    # Check if the supplier's item code is already linked to any existing item
-    linked_item = frappe.db.get_value(
-        "Item Supplier",
-        {"supplier_part_no": supplier_item_code, "supplier": supplier_name},
-        "parent",
+    """
+    Returns the Item for every invoice line, in order. Existing Items are
+    matched on the supplier's item code in one query, missing ones are
+    created with item codes from one reserved block of the naming series.
+    Nothing is committed, new Items become part of the caller's transaction.
+    """
+    supplier_item_codes = [item["ItemNumber"] for item in items_purchased]
+
+    # Check which of the supplier's item codes are already linked to items
+    linked_items = dict(
+        frappe.get_all(
+            "Item Supplier",
+            filters={
+                "supplier": supplier_name,
+                "supplier_part_no": ["in", list(set(supplier_item_codes))],
+            },
+            fields=["supplier_part_no", "parent"],
+            as_list=True,
+        )
     )
 
-    if linked_item:
-        # If it is linked, return the existing item
-        print(
-            f"Item with supplier's item code '{supplier_item_code}' already exists as '{linked_item}'."
+    # Lines repeating an unknown item code only create one item
+    new_items = {}
+    for item in items_purchased:
+        if item["ItemNumber"] not in linked_items:
+            new_items.setdefault(item["ItemNumber"], item)
+
+    item_codes = reserve_series_numbers(ITEM_NAMING_SERIES, len(new_items))
+    for item_code, (supplier_item_code, item) in zip(item_codes, new_items.items()):
+        new_item = frappe.get_doc(
+            {
+                "doctype": "Item",
+                "item_code": item_code,
+                "item_name": item["ItemName"],
+                "description": item["Description"],
+                "item_group": item_group,
+                "stock_uom": stock_uom,
+                "is_stock_item": 1,  # Set as a stock item
+                "include_item_in_manufacturing": 0,
+                "supplier_items": [
+                    {"supplier": supplier_name, "supplier_part_no": supplier_item_code}
+                ],
+            }
         )
-        return linked_item
+        new_item.insert()
+        linked_items[supplier_item_code] = new_item.name
 
-    # If not linked, create a new item
-    item = frappe.get_doc(
-        {
-            "doctype": "Item",
-            "item_code": frappe.model.naming.make_autoname(
-                "ITEM-.#####"
-            ),  # Determine item_code by naming series
-            "item_name": item_name,
-            "description": item_description,
-            "item_group": item_group,
-            "stock_uom": stock_uom,
-            "is_stock_item": 1,  # Set as a stock item
-            "include_item_in_manufacturing": 0,
-            "supplier_items": [
-                {"supplier": supplier_name, "supplier_part_no": supplier_item_code}
-            ],
-        }
-    )
-    item.insert()
-    frappe.db.commit()
-    print(
-        f"Item '{item.item_code}' created successfully with supplier's item code '{supplier_item_code}'!"
+    return [linked_items[supplier_item_code] for supplier_item_code in supplier_item_codes]
+
+
+def reserve_series_numbers(series, count):
+    """
+    Takes count consecutive names from a naming series like "ITEM-.#####" with
+    a single update of its counter, e.g. ["ITEM-00041", "ITEM-00042"].
+    """
+    if not count:
+        return []
+    prefix, hashes = series.rsplit(".", 1)
+    digits = len(hashes)
+
+    # Lock the counter row, the same way make_autoname does for a single name
+    current = frappe.db.sql(
+        "select `current` from `tabSeries` where `name`=%s for update", prefix
     )
-    return item.name
+    if current and current[0][0] is not None:
+        start = cint(current[0][0]) + 1
+        frappe.db.sql(
+            "update `tabSeries` set `current` = `current` + %s where `name`=%s",
+            (count, prefix),
+        )
+    else:
+        start = 1
+        frappe.db.sql(
+            "insert into `tabSeries` (`name`, `current`) values (%s, %s)",
+            (prefix, count),
+        )
+    return [f"{prefix}{number:0{digits}d}" for number in range(start, start + count)]
 
 
 def create_purchase_invoice_doc_item(item_code, qty, uom, price_list_rate):
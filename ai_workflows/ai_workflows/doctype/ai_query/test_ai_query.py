@@ -1,9 +1,291 @@
 # Copyright (c) 2024, itsdave GmbH and Contributors
 # See license.txt
 
-# import frappe
+import json
+import unittest
+from types import SimpleNamespace
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from openai import APIStatusError
+
+from ai_workflows.ai_workflows.doctype.ai_query.ai_query import (
+	ITEM_NAMING_SERIES,
+	build_openai_request,
+	compose_openai_request,
+	create_or_get_items,
+	get_prompt_cache_key,
+	reserve_series_numbers,
+	run_ai_query,
+)
+from ai_workflows.ai_workflows.duplicates import get_band_keys, get_number_tokens, get_shingles, jaccard
+from ai_workflows.ai_workflows.schema_validation import JSON_SCHEMA_MODE
+from ai_workflows.ai_workflows.stub_server import StubOpenAIServer
+from ai_workflows.ai_workflows.supplier_index import (
+	INDEX_VERSION_KEY,
+	SupplierIndex,
+	get_supplier_index,
+	update_supplier_index,
+)
+from ai_workflows.ai_workflows.tokens import (
+	TRUNCATION_MARKER,
+	add_usage,
+	count_request_tokens,
+	count_tokens,
+	get_cost,
+	get_usage,
+	truncate_to_tokens,
+)
+from ai_workflows.ai_workflows.tracing import get_tracer, to_openmetrics, trace
 
 
 class TestAIQuery(FrappeTestCase):
-	pass
+	def test_trace_stages(self):
+		with trace("outer") as tracer:
+			with trace("inner"):
+				frappe.db.sql("select 1")
+				tracer.add_llm_request(0.25)
+		self.assertIsNone(get_tracer())
+
+		inner, outer = tracer.stages
+		self.assertEqual((inner["stage"], inner["level"]), ("inner", 1))
+		self.assertEqual((outer["stage"], outer["level"]), ("outer", 0))
+		self.assertEqual(inner["db_queries"], 1)
+		self.assertEqual(inner["llm_requests"], 1)
+		self.assertAlmostEqual(outer["llm_time"], 250)
+		self.assertGreaterEqual(outer["wall_time"], inner["wall_time"])
+
+	def test_openmetrics_export(self):
+		statistics = [
+			frappe._dict(
+				stage="llm",
+				count=2,
+				**{
+					f"{field}_{key}": value
+					for field in ("wall_time", "db_queries", "db_time", "llm_time")
+					for key, value in (("sum", 3000), ("p50", 1000), ("p95", 2000), ("p99", 2000))
+				},
+			)
+		]
+		text = to_openmetrics(statistics)
+		self.assertIn('ai_workflows_stage_duration_seconds{stage="llm",quantile="0.95"} 2\n', text)
+		self.assertIn('ai_workflows_stage_db_queries_count{stage="llm"} 2\n', text)
+		self.assertTrue(text.endswith("# EOF\n"))
+
+	def test_near_duplicate_signatures(self):
+		invoice = (
+			"Muster GmbH, VAT ID DE123456789\nInvoice number: RE-2026-0042, 12.10.2026\n"
+			+ "".join(f"{i} x Item {i} at {i * 3},50 EUR\n" for i in range(1, 30))
+			+ "Total: 1.305,00 EUR"
+		)
+		rescan = invoice.replace("Invoice", "lnvoice").replace("x Item 7", "x ltem 7").replace(":", " :")
+		other = invoice.replace("0042", "0043").replace("12.10.2026", "19.10.2026").replace(",50", ",90")
+
+		self.assertTrue(set(get_band_keys("Prompt", invoice)) & set(get_band_keys("Prompt", rescan)))
+		self.assertIn("|DE123456789|", get_band_keys("Prompt", invoice)[0])
+		self.assertGreaterEqual(jaccard(get_shingles(invoice), get_shingles(rescan)), 0.8)
+		self.assertEqual(get_number_tokens(invoice), get_number_tokens(rescan))
+		# Same supplier template, different numbers
+		self.assertLess(jaccard(get_number_tokens(invoice), get_number_tokens(other)), 0.8)
+
+	def test_document_last_for_prompt_caching(self):
+		prompt = frappe._dict(
+			name="Invoice", ai_output_mode=JSON_SCHEMA_MODE, long_text_fnbe="Extract the invoice.", model="gpt-4o"
+		)
+		schema = {"type": "object", "properties": {"InvoiceNumber": {"type": "string"}}}
+		example = frappe._dict(input_text="Invoice 1", output_json='{"InvoiceNumber": "1"}')
+		_, first = compose_openai_request(prompt, "Invoice 2", schema, examples=[example])
+		_, second = compose_openai_request(prompt, "Invoice 3", schema)
+
+		self.assertEqual(first["messages"][0], second["messages"][0])
+		self.assertIn("Extract the invoice.", first["messages"][0]["content"])
+		self.assertEqual([m["role"] for m in first["messages"]], ["system", "user", "assistant", "user"])
+		self.assertEqual(first["messages"][-1]["content"], "Invoice 2")
+		# Examples and document do not change the cache key
+		self.assertEqual(get_prompt_cache_key(first), get_prompt_cache_key(second))
+		self.assertNotEqual(
+			get_prompt_cache_key(first), get_prompt_cache_key({**first, "model": "gpt-4o-mini"})
+		)
+
+	def test_prompt_token_budget(self):
+		text = (
+			"Invoice RE-4711\n"
+			+ "".join(f"{i} x Item {i} at {i},00 EUR\n" for i in range(1, 300))
+			+ "Total: 44.850,00 EUR"
+		)
+		truncated = truncate_to_tokens(text, 100, "Keep Head and Tail")
+		self.assertLessEqual(count_tokens(truncated), 100)
+		self.assertTrue(truncated.startswith("Invoice RE-4711"))
+		self.assertTrue(truncated.endswith("Total: 44.850,00 EUR"))
+		self.assertIn(TRUNCATION_MARKER, truncated)
+		head = truncate_to_tokens(text, 100)
+		self.assertTrue(head.startswith("Invoice RE-4711") and head.endswith(TRUNCATION_MARKER))
+		self.assertEqual(truncate_to_tokens("Invoice", 100), "Invoice")
+
+		prompt = frappe._dict(
+			name="Invoice",
+			ai_output_mode=JSON_SCHEMA_MODE,
+			long_text_fnbe="Extract the invoice.",
+			model="gpt-4o",
+			max_prompt_tokens=300,
+			truncation_strategy="Keep Head and Tail",
+		)
+		schema = {"type": "object", "properties": {"InvoiceNumber": {"type": "string"}}}
+		_, request = build_openai_request(prompt, text, schema)
+		self.assertLessEqual(count_request_tokens(request), 300)
+		self.assertIn("Total: 44.850,00 EUR", request["messages"][-1]["content"])
+
+	def test_usage_and_cost(self):
+		response = SimpleNamespace(
+			usage=SimpleNamespace(
+				prompt_tokens=1000000,
+				completion_tokens=100000,
+				prompt_tokens_details=SimpleNamespace(cached_tokens=400000),
+			)
+		)
+		usage = get_usage(response)
+		self.assertEqual(usage, {"prompt_tokens": 1000000, "completion_tokens": 100000, "cached_tokens": 400000})
+		self.assertEqual(get_usage(SimpleNamespace(usage=None)), {})
+
+		total = add_usage({}, usage)
+		add_usage(total, {"prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 0})
+		self.assertEqual(total, {"prompt_tokens": 1000010, "completion_tokens": 100005, "cached_tokens": 400000})
+
+		prices = {"input_token_price": 2.5, "cached_input_token_price": 1.25, "output_token_price": 10}
+		self.assertAlmostEqual(get_cost(usage, prices), 3.0)
+		# Cached tokens cost the input price when no cached price is set
+		self.assertAlmostEqual(get_cost(usage, dict(prices, cached_input_token_price=None)), 3.5)
+
+	def test_supplier_index(self):
+		def get_supplier(name, supplier_name, tax_id=None):
+			return frappe._dict(name=name, supplier_name=supplier_name, tax_id=tax_id)
+
+		index = SupplierIndex(
+			[
+				get_supplier("SUP-1", "Acme GmbH", "DE 123 456 789"),
+				get_supplier("SUP-2", "ACME GmbH.", "DE123456789"),
+				get_supplier("SUP-3", "Muster Bau GmbH"),
+			]
+		)
+		self.assertEqual(index.lookup("de123.456.789"), "SUP-1")
+		self.assertEqual(index.lookup(None, "acme gmbh"), "SUP-1")
+		# A removed Supplier hands its keys to the one sharing them
+		index.remove("SUP-1")
+		self.assertEqual(index.lookup("DE123456789"), "SUP-2")
+		self.assertEqual(index.lookup(None, "Acme GmbH"), "SUP-2")
+
+		# Trigram similarity 0.84: below the default threshold, above a configured 0.8
+		self.assertIsNone(index.lookup(None, "Muster-Bau GmbH & Co"))
+		index = SupplierIndex([get_supplier("SUP-3", "Muster Bau GmbH")], fuzzy_threshold=0.8)
+		self.assertEqual(index.lookup(None, "Muster-Bau GmbH & Co"), "SUP-3")
+
+	def test_supplier_index_after_commit(self):
+		supplier = frappe._dict(name="_Test Index Supplier", supplier_name="Index Test GmbH", tax_id="DE999999999")
+		self.assertIsNone(get_supplier_index().lookup(supplier.tax_id))
+		update_supplier_index(supplier, "after_insert")
+		# Not before the transaction is committed
+		self.assertIsNone(get_supplier_index().lookup(supplier.tax_id))
+		frappe.db.after_commit.run()
+		self.assertEqual(get_supplier_index().lookup(supplier.tax_id), supplier.name)
+
+		update_supplier_index(supplier, "on_trash")
+		frappe.db.after_commit.run()
+		self.assertIsNone(get_supplier_index().lookup(supplier.tax_id))
+
+		# After another process changed a Supplier, the stale index is rebuilt
+		# from the table instead of being updated in place
+		get_supplier_index()
+		frappe.cache().incr(frappe.cache().make_key(INDEX_VERSION_KEY))
+		update_supplier_index(supplier, "after_insert")
+		frappe.db.after_commit.run()
+		self.assertIsNone(get_supplier_index().lookup(supplier.tax_id))
+
+		# Saves that change no indexed field keep the version
+		index = get_supplier_index()
+		update_supplier_index(frappe._dict(supplier, has_value_changed=lambda field: False), "on_update")
+		frappe.db.after_commit.run()
+		self.assertIs(get_supplier_index(), index)
+
+	def test_create_or_get_items(self):
+		if "erpnext" not in frappe.get_installed_apps():
+			raise unittest.SkipTest("erpnext is not installed")
+
+		supplier = frappe.get_doc(
+			{"doctype": "Supplier", "supplier_name": "_Test Item Batch Supplier", "supplier_group": "All Supplier Groups"}
+		).insert()
+		existing = frappe.get_doc(
+			{
+				"doctype": "Item",
+				"item_code": "_Test Item Batch A-1",
+				"item_group": "All Item Groups",
+				"stock_uom": "Nos",
+				"supplier_items": [{"supplier": supplier.name, "supplier_part_no": "A-1"}],
+			}
+		).insert()
+
+		def get_line(item_number):
+			return {"ItemNumber": item_number, "ItemName": f"Item {item_number}", "Description": item_number}
+
+		items = create_or_get_items(
+			[get_line(code) for code in ("A-1", "B-2", "C-3", "B-2")],
+			supplier.name,
+			stock_uom="Nos",
+		)
+		self.assertEqual(items[0], existing.name)
+		# A repeated supplier item code creates a single Item
+		self.assertEqual(items[1], items[3])
+		self.assertEqual(len(set(items)), 3)
+		self.assertEqual(
+			frappe.get_all("Item Supplier", filters={"parent": items[2]}, pluck="supplier_part_no"), ["C-3"]
+		)
+		# New item codes are consecutive numbers of one reserved block
+		first, second = (int(item.rsplit("-", 1)[1]) for item in items[1:3])
+		self.assertEqual(second, first + 1)
+
+		# Known codes are found again, nothing new is created
+		self.assertEqual(create_or_get_items([get_line("C-3"), get_line("A-1")], supplier.name), [items[2], items[0]])
+
+	def test_reserve_series_numbers(self):
+		prefix = ITEM_NAMING_SERIES.rsplit(".", 1)[0]
+		first = reserve_series_numbers(ITEM_NAMING_SERIES, 2)
+		second = reserve_series_numbers(ITEM_NAMING_SERIES, 3)
+		self.assertEqual(reserve_series_numbers(ITEM_NAMING_SERIES, 0), [])
+		self.assertTrue(all(name.startswith(prefix) and len(name) == len(prefix) + 5 for name in first + second))
+		numbers = [int(name[len(prefix) :]) for name in first + second]
+		self.assertEqual(numbers, list(range(numbers[0], numbers[0] + 5)))
+
+	def test_failed_stream(self):
+		if not frappe.db.exists("DocType", "Paperless Document"):
+			raise unittest.SkipTest("frappe_goes_paperless is not installed")
+
+		with StubOpenAIServer(error_rate=1) as server:
+			ai = frappe.get_doc(
+				{
+					"doctype": "AI",
+					"caption": "Stream Failure Test",
+					"interface": "OpenAI Compatible",
+					"endpoint": server.url,
+					"stream_responses": 1,
+					"retry_max_attempts": 1,
+				}
+			).insert()
+			prompt = frappe.get_doc(
+				{
+					"doctype": "AI Prompt",
+					"caption": "Stream Failure Test",
+					"ai": ai.name,
+					"ai_output_mode": "Structured Output (JSON)",
+					"long_text_fnbe": "Extract the invoice.",
+					"json_scema": json.dumps({"type": "object", "properties": {}}),
+				}
+			).insert()
+			paperless_doc = frappe.get_doc(
+				{"doctype": "Paperless Document", "document_fulltext": "Invoice 4711"}
+			).insert()
+			doc = {"name": paperless_doc.name, "document_fulltext": "Invoice 4711"}
+			self.assertRaises(APIStatusError, run_ai_query, doc, prompt.name, ai.name, background=False)
+
+		# The AI Query the form was following records the error
+		ai_query = frappe.get_last_doc("AI Query", filters={"paperless_doc": paperless_doc.name})
+		self.assertIn("streaming failed", ai_query.validation_errors)
+		self.assertFalse(ai_query.ai_response)
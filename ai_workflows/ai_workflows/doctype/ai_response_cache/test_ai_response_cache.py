@@ -0,0 +1,109 @@
+# Copyright (c) 2026, itsdave GmbH and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ai_workflows.ai_workflows.response_cache import (
+	clear_response_cache,
+	get_cache_key,
+	get_cached_response,
+	set_cached_response,
+)
+
+MODE = "Structured Output (JSON)"
+
+
+def get_request(**changes):
+	request = {
+		"model": "gpt-4o",
+		"messages": [
+			{"role": "system", "content": "Extract the invoice."},
+			{"role": "user", "content": "Invoice 4711"},
+		],
+		"response_format": {"type": "json_schema", "json_schema": {"name": "invoice", "schema": {}}},
+	}
+	request.update(changes)
+	return request
+
+
+def set_settings(**values):
+	settings = frappe.get_single("AI Settings")
+	settings.update(values)
+	settings.save()
+
+
+class TestAIResponseCache(FrappeTestCase):
+	def setUp(self):
+		set_settings(
+			enable_response_cache=1,
+			persist_response_cache=0,
+			response_cache_ttl=0,
+			response_cache_max_entries=0,
+		)
+
+	def tearDown(self):
+		clear_response_cache()
+
+	def test_cache_key(self):
+		key = get_cache_key(MODE, get_request())
+		# Same request in a different key order
+		self.assertEqual(key, get_cache_key(MODE, dict(reversed(list(get_request().items())))))
+
+		variants = [
+			get_cache_key("Function Calling", get_request()),
+			get_cache_key(MODE, get_request(model="gpt-4o-mini")),
+			get_cache_key(MODE, get_request(messages=get_request()["messages"][:1])),
+			get_cache_key(MODE, get_request(response_format={"type": "json_object"})),
+			get_cache_key(MODE, get_request(messages=[{"role": "user", "content": "Invoice 4712"}])),
+			# Same text split differently between the messages
+			get_cache_key(
+				MODE,
+				get_request(
+					messages=[
+						{"role": "system", "content": "Extract the invoice.Invoice"},
+						{"role": "user", "content": " 4711"},
+					]
+				),
+			),
+		]
+		self.assertEqual(len(set(variants + [key])), len(variants) + 1)
+
+	def test_cached_response(self):
+		key = get_cache_key(MODE, get_request())
+		other_key = get_cache_key(MODE, get_request(model="gpt-4o-mini"))
+		self.assertIsNone(get_cached_response(key))
+
+		set_cached_response(key, '{"InvoiceNumber": "4711"}', MODE, "gpt-4o")
+		self.assertEqual(get_cached_response(key), '{"InvoiceNumber": "4711"}')
+		self.assertIsNone(get_cached_response(other_key))
+
+		# Empty answers are not cached
+		set_cached_response(other_key, "", MODE, "gpt-4o-mini")
+		self.assertIsNone(get_cached_response(other_key))
+
+	def test_max_entries(self):
+		set_settings(response_cache_max_entries=2)
+		keys = [get_cache_key(MODE, get_request(model=f"model-{i}")) for i in range(3)]
+		for i, key in enumerate(keys):
+			set_cached_response(key, str(i))
+
+		# The oldest entry is evicted
+		self.assertIsNone(get_cached_response(keys[0]))
+		self.assertEqual([get_cached_response(key) for key in keys[1:]], ["1", "2"])
+
+		# Writing a cached key again moves it to the end instead of adding it twice
+		set_cached_response(keys[1], "1")
+		set_cached_response(keys[0], "0")
+		self.assertIsNone(get_cached_response(keys[2]))
+		self.assertEqual([get_cached_response(key) for key in keys[:2]], ["0", "1"])
+
+	def test_persisted_response(self):
+		set_settings(persist_response_cache=1)
+		key = get_cache_key(MODE, get_request(model="persisted"))
+		set_cached_response(key, '{"InvoiceNumber": "4711"}', MODE, "persisted")
+		self.assertEqual(frappe.db.get_value("AI Response Cache", key, "model"), "persisted")
+
+		# A cleared redis cache is warmed up from the table
+		clear_response_cache()
+		self.assertEqual(get_cached_response(key), '{"InvoiceNumber": "4711"}')
@@ -1,9 +1,120 @@
 # Copyright (c) 2024, itsdave GmbH and contributors
 # For license information, please see license.txt
 
-# import frappe
+import re
+import threading
+from difflib import SequenceMatcher
+
+import frappe
 from frappe.model.document import Document
 
+from ai_workflows.ai_workflows.supplier_index import DEFAULT_FUZZY_THRESHOLD, normalize_name
+
+# Redis key holding the settings version, bumped on every save
+SETTINGS_VERSION_KEY = "ai_workflows_purchase_invoice_settings_version"
+
+# Per-worker mappings: site -> (version, PurchaseInvoiceSettings)
+_settings = {}
+_settings_lock = threading.Lock()
+
 
 class AIWorkflowPurchaseInvoiceSettings(Document):
-	pass
+	def validate(self):
+		for assignment in self.payment_terms_assignments:
+			if assignment.match_type != "Regex":
+				continue
+			try:
+				re.compile(assignment.ai_response_paymentmethod_string or "")
+			except re.error as e:
+				frappe.throw(
+					f"Row {assignment.idx}: invalid regular expression "
+					f"'{assignment.ai_response_paymentmethod_string}': {e}"
+				)
+
+	def on_update(self):
+		clear_purchase_invoice_settings_cache()
+
+
+class PurchaseInvoiceSettings:
+	"""
+	Pre-normalized view of AI Workflow Purchase Invoice Settings. PaymentMethod
+	strings are matched exactly after normalization (including aliases), then
+	against the regex rows, then fuzzily, and finally fall back to the
+	configured default term.
+	"""
+
+	def __init__(self, settings):
+		self.default_item_group = settings.default_item_group
+		self.fallback_payment_term = settings.fallback_payment_term
+		self.fuzzy_threshold = (
+			(settings.fuzzy_match_threshold or DEFAULT_FUZZY_THRESHOLD)
+			if settings.enable_fuzzy_matching
+			else None
+		)
+
+		self.payment_terms = {}
+		self.payment_term_patterns = []
+		for assignment in settings.payment_terms_assignments:
+			if not assignment.payment_term:
+				continue
+			if assignment.match_type == "Regex":
+				self.payment_term_patterns.append(
+					(
+						re.compile(assignment.ai_response_paymentmethod_string, re.IGNORECASE),
+						assignment.payment_term,
+					)
+				)
+				continue
+			for string in [assignment.ai_response_paymentmethod_string] + (
+				assignment.aliases or ""
+			).splitlines():
+				key = normalize_name(string)
+				if key:
+					self.payment_terms.setdefault(key, assignment.payment_term)
+
+	def get_payment_term(self, payment_method):
+		key = normalize_name(payment_method)
+		if key:
+			if key in self.payment_terms:
+				return self.payment_terms[key]
+
+			for pattern, payment_term in self.payment_term_patterns:
+				if pattern.search(payment_method):
+					return payment_term
+
+			if self.fuzzy_threshold:
+				best, best_score = None, 0
+				for candidate, payment_term in self.payment_terms.items():
+					score = SequenceMatcher(None, key, candidate).ratio()
+					if score > best_score:
+						best, best_score = payment_term, score
+				if best_score >= self.fuzzy_threshold:
+					return best
+
+		return self.fallback_payment_term
+
+
+def get_purchase_invoice_settings():
+	"""
+	Returns this worker's mapping for the current site, rebuilt when the
+	settings were saved since it was built.
+	"""
+	site = frappe.local.site
+	version = frappe.cache().get_value(SETTINGS_VERSION_KEY)
+	with _settings_lock:
+		cached = _settings.get(site)
+		if cached and cached[0] == version:
+			return cached[1]
+
+	settings = PurchaseInvoiceSettings(
+		frappe.get_cached_doc("AI Workflow Purchase Invoice Settings")
+	)
+	with _settings_lock:
+		_settings[site] = (version, settings)
+	return settings
+
+
+def clear_purchase_invoice_settings_cache():
+	frappe.cache().set_value(SETTINGS_VERSION_KEY, frappe.generate_hash(length=10))
+	with _settings_lock:
+		_settings.pop(frappe.local.site, None)
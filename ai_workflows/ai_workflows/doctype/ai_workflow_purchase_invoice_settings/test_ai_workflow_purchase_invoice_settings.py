@@ -1,9 +1,54 @@
 # Copyright (c) 2024, itsdave GmbH and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from ai_workflows.ai_workflows.doctype.ai_workflow_purchase_invoice_settings.ai_workflow_purchase_invoice_settings import (
+	PurchaseInvoiceSettings,
+)
+
+
+def make_settings(**kwargs):
+	return frappe._dict(
+		{
+			"default_item_group": "All Item Groups",
+			"fallback_payment_term": None,
+			"enable_fuzzy_matching": 0,
+			"fuzzy_match_threshold": 0,
+			"payment_terms_assignments": [
+				frappe._dict(
+					ai_response_paymentmethod_string="Überweisung",
+					aliases="Bank Transfer\nSEPA-Überweisung",
+					payment_term="Transfer",
+				),
+				frappe._dict(
+					ai_response_paymentmethod_string=r"lastschrift|direct debit",
+					match_type="Regex",
+					payment_term="Direct Debit",
+				),
+			],
+			**kwargs,
+		}
+	)
+
 
 class TestAIWorkflowPurchaseInvoiceSettings(FrappeTestCase):
-	pass
+	def test_normalized_and_alias_match(self):
+		settings = PurchaseInvoiceSettings(make_settings())
+		self.assertEqual(settings.get_payment_term("  ÜBERWEISUNG "), "Transfer")
+		self.assertEqual(settings.get_payment_term("bank-transfer"), "Transfer")
+		self.assertEqual(settings.get_payment_term("SEPA Überweisung"), "Transfer")
+
+	def test_regex_match(self):
+		settings = PurchaseInvoiceSettings(make_settings())
+		self.assertEqual(settings.get_payment_term("SEPA-Lastschrift"), "Direct Debit")
+
+	def test_fuzzy_match_and_fallback(self):
+		settings = PurchaseInvoiceSettings(make_settings(fallback_payment_term="Default"))
+		self.assertEqual(settings.get_payment_term("Uberweisung"), "Default")
+		self.assertEqual(settings.get_payment_term(None), "Default")
+
+		settings = PurchaseInvoiceSettings(make_settings(enable_fuzzy_matching=1))
+		self.assertEqual(settings.get_payment_term("Uberweisung"), "Transfer")
+		self.assertIsNone(settings.get_payment_term("Cash"))
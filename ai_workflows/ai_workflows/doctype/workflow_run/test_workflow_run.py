@@ -0,0 +1,102 @@
+# Copyright (c) 2026, itsdave GmbH and Contributors
+# See license.txt
+
+from collections import Counter
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ai_workflows.ai_workflows.workflow_engine import resume_workflow_run, run_steps, start_workflow
+
+TEMPLATE = "_Test Resumable Workflow"
+METHOD_PATH = "ai_workflows.ai_workflows.doctype.workflow_run.test_workflow_run"
+
+calls = Counter()
+
+
+def extract(context):
+	calls["extract"] += 1
+	return {"total": 1500}
+
+
+def book(context):
+	# Fails on the first attempt only
+	calls["book"] += 1
+	if calls["book"] == 1:
+		raise frappe.ValidationError("Booking failed")
+	return {"booked": 1}
+
+
+def make_step(step_name, sequence, method=None, **kwargs):
+	return {
+		"step_name": step_name,
+		"sequence": sequence,
+		"step_type": "Action",
+		"action_type": "Server Method",
+		"method_name": f"{METHOD_PATH}.{method}" if method else None,
+		"auto_proceed": 1,
+		**kwargs,
+	}
+
+
+class TestWorkflowRun(FrappeTestCase):
+	def setUp(self):
+		calls.clear()
+		if frappe.db.exists("Workflow Template", TEMPLATE):
+			return
+		frappe.get_doc(
+			{
+				"doctype": "Workflow Template",
+				"workflow_name": TEMPLATE,
+				"applicable_doctypes": "User",
+				"workflow_steps": [
+					make_step("Extract", 1, "extract"),
+					make_step("Check", 2, step_type="Decision", decision_condition="flt(total) > 1000"),
+					make_step("Book", 3, "book"),
+					make_step("Review", 3, action_type="Approval", auto_proceed=0),
+				],
+				"outcome_routes": [
+					{"decision_step": "Check", "outcome_value": "True", "next_step": "Book"},
+					{"decision_step": "Check", "outcome_value": "False", "next_step": "Review"},
+				],
+			}
+		).insert()
+
+	def get_steps(self, run):
+		return {row.step_name: row for row in frappe.get_doc("Workflow Run", run).steps}
+
+	@patch("ai_workflows.ai_workflows.workflow_engine.enqueue_step")
+	def test_resume_failed_run(self, enqueue_step):
+		run = start_workflow(TEMPLATE, "User", "Administrator")
+		enqueue_step.assert_called_once_with(run, "Extract")
+
+		run_steps(run, ["Extract"])
+		self.assertEqual(frappe.db.get_value("Workflow Run", run, ["status", "failed_step"]), ("Failed", "Book"))
+		steps = self.get_steps(run)
+		self.assertEqual(steps["Check"].outcome, "True")
+		self.assertEqual(steps["Review"].status, "Skipped")
+		self.assertEqual((steps["Book"].status, steps["Book"].attempts), ("Failed", 1))
+		self.assertIn("Booking failed", steps["Book"].error)
+
+		# Only the failed step is resumed, completed steps keep their outputs
+		self.assertEqual(resume_workflow_run(run), ["Book"])
+		self.assertEqual(frappe.db.get_value("Workflow Run", run, "status"), "Running")
+		run_steps(run, ["Book"])
+
+		self.assertEqual(frappe.db.get_value("Workflow Run", run, ["status", "failed_step"]), ("Completed", None))
+		steps = self.get_steps(run)
+		self.assertEqual((steps["Book"].status, steps["Book"].attempts), ("Completed", 2))
+		self.assertIn('"total": 1500', steps["Book"].inputs)
+		self.assertEqual(calls, Counter(extract=1, book=2))
+		self.assertEqual(resume_workflow_run(run), [])
+
+	@patch("ai_workflows.ai_workflows.workflow_engine.enqueue_step")
+	def test_duplicate_step_job(self, enqueue_step):
+		run = start_workflow(TEMPLATE, "User", "Administrator")
+		run_steps(run, ["Extract"])
+		# A second job for a finished step does not run it again
+		run_steps(run, ["Extract"])
+
+		self.assertEqual(calls["extract"], 1)
+		self.assertEqual(self.get_steps(run)["Extract"].attempts, 1)
@@ -0,0 +1,39 @@
+// Copyright (c) 2026, itsdave GmbH and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("Workflow Run", {
+	refresh(frm) {
+		if (frm.doc.status === "Failed" || frm.doc.status === "Running") {
+			frm.add_custom_button(__("Resume"), () => {
+				frappe
+					.call("ai_workflows.ai_workflows.workflow_engine.resume_workflow_run", {
+						run: frm.doc.name,
+					})
+					.then((r) => {
+						frappe.show_alert(
+							r.message && r.message.length
+								? __("Resumed at {0}", [r.message.join(", ")])
+								: __("Nothing to resume")
+						);
+						frm.reload_doc();
+					});
+			});
+		}
+		(frm.doc.steps || [])
+			.filter((step) => step.status === "Waiting")
+			.forEach((step) => {
+				frm.add_custom_button(
+					step.step_name,
+					() => {
+						frappe
+							.call("ai_workflows.ai_workflows.workflow_engine.proceed_workflow", {
+								run: frm.doc.name,
+								step: step.step_name,
+							})
+							.then(() => frm.reload_doc());
+					},
+					__("Proceed")
+				);
+			});
+	},
+});
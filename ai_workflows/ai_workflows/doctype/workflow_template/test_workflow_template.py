@@ -0,0 +1,80 @@
+# Copyright (c) 2024, itsdave GmbH and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ai_workflows.ai_workflows.safe_expression import SafeExpression
+from ai_workflows.ai_workflows.workflow_engine import WorkflowGraph
+
+
+def make_step(step_name, sequence, step_type="Action", **kwargs):
+	return frappe._dict(
+		step_name=step_name,
+		sequence=sequence,
+		step_type=step_type,
+		action_type="Server Method",
+		method_name="frappe.ping",
+		**kwargs,
+	)
+
+
+def make_template(outcome_routes=()):
+	return frappe._dict(
+		name="Test Workflow",
+		workflow_steps=[
+			make_step("Extract", 1),
+			make_step("Supplier", 2),
+			make_step("Items", 2),
+			make_step("Check", 3, "Decision", decision_condition="flt(total) > 1000"),
+			make_step("Approve", 4, next_step="Invoice"),
+			make_step("Invoice", 5),
+		],
+		outcome_routes=[
+			frappe._dict(decision_step="Check", outcome_value="True", next_step="Approve"),
+			frappe._dict(decision_step="Check", outcome_value="False", next_step="Invoice"),
+			*outcome_routes,
+		],
+	)
+
+
+class TestWorkflowTemplate(FrappeTestCase):
+	def test_compile_graph(self):
+		graph = WorkflowGraph(make_template())
+		self.assertEqual(graph.start_steps, ["Extract"])
+		# Steps of the same sequence run in parallel and are joined again
+		self.assertEqual(graph.successors["Extract"], ["Supplier", "Items"])
+		self.assertEqual(graph.predecessors["Check"], 2)
+		self.assertEqual(graph.predecessors["Invoice"], 2)
+
+	def test_decision_route(self):
+		graph = WorkflowGraph(make_template())
+		outcome = graph.conditions["Check"].evaluate({"total": "1500.00"})
+		self.assertEqual(graph.get_route("Check", outcome), ["Approve"])
+		outcome = graph.conditions["Check"].evaluate({"total": "15"})
+		self.assertEqual(graph.get_route("Check", outcome), ["Invoice"])
+
+	def test_reject_loops_and_unsafe_conditions(self):
+		loop = frappe._dict(decision_step="Check", outcome_value="Retry", next_step="Extract")
+		self.assertRaises(frappe.ValidationError, WorkflowGraph, make_template([loop]))
+
+		template = make_template()
+		template.workflow_steps[3].decision_condition = "().__class__.__bases__"
+		self.assertRaises(frappe.ValidationError, WorkflowGraph, template)
+
+	def test_expression_limits(self):
+		def evaluate(source, **names):
+			return SafeExpression(source).evaluate(names)
+
+		self.assertEqual(evaluate("len(code * 3) + 7 % 4", code="ab"), 9)
+		self.assertTrue(evaluate("doc.grand_total > 5", doc=frappe._dict(grand_total=10)))
+		for source, names in (
+			("len('a' * 1000000000)", {}),
+			("len([0] * 1000000000)", {}),
+			("'%0999999999d' % 1", {}),
+			("str.mro", {}),
+			("code.upper", {"code": "ab"}),
+			# A context name must not replace a function
+			("len(code)", {"code": "ab", "len": lambda value: 0}),
+		):
+			self.assertRaises(frappe.ValidationError, evaluate, source, **names)
@@ -0,0 +1,35 @@
+// Copyright (c) 2024, itsdave GmbH and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("Workflow Template", {
+	refresh(frm) {
+		if (frm.is_new() || !frm.doc.active) {
+			return;
+		}
+		frm.add_custom_button(__("Start for Document"), () => {
+			frappe.prompt(
+				{
+					fieldname: "docname",
+					fieldtype: "Link",
+					label: __(frm.doc.applicable_doctypes),
+					options: frm.doc.applicable_doctypes,
+					reqd: 1,
+				},
+				(values) => {
+					frappe.call({
+						method: "ai_workflows.ai_workflows.workflow_engine.start_workflow",
+						args: {
+							template: frm.doc.name,
+							doctype: frm.doc.applicable_doctypes,
+							docname: values.docname,
+						},
+						callback: (r) => {
+							frappe.set_route("Form", "Workflow Run", r.message);
+						},
+					});
+				},
+				__("Start Workflow")
+			);
+		});
+	},
+});
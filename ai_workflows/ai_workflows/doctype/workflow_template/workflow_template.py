@@ -4,6 +4,10 @@
 # import frappe
 from frappe.model.document import Document
 
+from ai_workflows.ai_workflows.workflow_engine import WorkflowGraph
+
 
 class WorkflowTemplate(Document):
-	pass
\ No newline at end of file
+	def validate(self):
+		# Compiling checks step names, routes, conditions and loops
+		WorkflowGraph(self)
@@ -0,0 +1,186 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""
+Near-duplicate detection of Paperless Documents before extraction, e.g. the
+same invoice scanned twice with slightly different OCR.
+
+Fulltexts get a MinHash signature over character shingles (one permutation
+hashing: the minimum hash per bucket of a single hash), which is split
+into bands stored as redis sets (locality sensitive hashing). Documents
+sharing a band are candidates and are confirmed on their exact shingle and
+number similarity. The index is partitioned per supplier, recognised by the
+VAT IDs in the text, and per AI Prompt.
+"""
+
+import hashlib
+import re
+
+import frappe
+from frappe.utils import add_days, today
+
+# Redis set per (prompt, supplier, band, band value) holding AI Query names
+INDEX_PREFIX = "ai_workflows_duplicates|"
+
+SHINGLE_SIZE = 5
+# 64 buckets in 16 bands of 4 rows: documents with a shingle similarity of
+# 0.8 become candidates with a probability of over 99.9%
+MINHASH_BUCKET_BITS = 6
+MINHASH_BUCKETS = 1 << MINHASH_BUCKET_BITS
+BAND_ROWS = 4
+
+DEFAULT_SIMILARITY = 0.8
+DEFAULT_WINDOW_DAYS = 90
+# Invoice numbers, dates and amounts must match too, templates of one supplier
+# alone make different invoices look alike
+MIN_NUMBER_SIMILARITY = 0.8
+
+NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+NUMBER_TOKEN = re.compile(r"\d[\d.,/-]*\d")
+# DE123456789, ATU12345678, DE 123 456 789
+VAT_ID = re.compile(r"\b[A-Z]{2}U? ?\d{3}(?: ?\d){5,9}\b")
+
+
+def normalize_text(text):
+    # Casefolded words only, OCR varies most in punctuation and spacing
+    return " ".join(NON_WORD.sub(" ", (text or "").casefold()).split())
+
+
+def get_shingles(text):
+    normalized = normalize_text(text)
+    return {normalized[i : i + SHINGLE_SIZE] for i in range(max(len(normalized) - SHINGLE_SIZE + 1, 1))}
+
+
+def get_number_tokens(text):
+    # "1.234,50" and "1,234.50" are the same amount to OCR
+    return {re.sub(r"\D", "", token) for token in NUMBER_TOKEN.findall(text or "")}
+
+
+def get_minhash(shingles):
+    # One pass over the shingles, empty buckets stay 0
+    signature = [None] * MINHASH_BUCKETS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        bucket = value & (MINHASH_BUCKETS - 1)
+        value >>= MINHASH_BUCKET_BITS
+        if signature[bucket] is None or value < signature[bucket]:
+            signature[bucket] = value
+    return [value or 0 for value in signature]
+
+
+def get_band_keys(prompt, text):
+    """
+    Redis keys of the LSH bands of a fulltext, partitioned by AI Prompt and
+    the supplier's VAT IDs found in it.
+    """
+    supplier_key = ",".join(sorted({re.sub(r"\s", "", vat_id) for vat_id in VAT_ID.findall(text or "")}))
+    signature = get_minhash(get_shingles(text))
+    keys = []
+    for band, start in enumerate(range(0, MINHASH_BUCKETS, BAND_ROWS)):
+        rows = ",".join(str(value) for value in signature[start : start + BAND_ROWS])
+        band_hash = hashlib.blake2b(rows.encode(), digest_size=8).hexdigest()
+        keys.append(f"{INDEX_PREFIX}{prompt}|{supplier_key}|{band}|{band_hash}")
+    return keys
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def is_duplicate_detection_enabled():
+    return bool(frappe.get_cached_doc("AI Settings").enable_duplicate_detection)
+
+
+def find_duplicate_query(prompt, paperless_doc, text):
+    """
+    Returns the earlier AI Query of a near-duplicate of the document for the
+    same AI Prompt, or None. Only valid extractions of other documents count.
+    """
+    if not text or not text.strip():
+        return None
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+    for key in get_band_keys(prompt, text):
+        pipeline.smembers(cache.make_key(key))
+    candidates = {frappe.safe_decode(name) for members in pipeline.execute() for name in members}
+    if not candidates:
+        return None
+
+    queries = frappe.get_all(
+        "AI Query",
+        filters={
+            "name": ["in", list(candidates)],
+            "ai_prompt_template": prompt,
+            "paperless_doc": ["!=", paperless_doc],
+            "duplicate_of": ["is", "not set"],
+        },
+        fields=["name", "paperless_doc", "validation_errors", "creation"],
+        order_by="creation asc",
+    )
+    queries = [query for query in queries if not query.validation_errors]
+    if not queries:
+        return None
+    fulltexts = dict(
+        frappe.get_all(
+            "Paperless Document",
+            filters={"name": ["in", list({query.paperless_doc for query in queries})]},
+            fields=["name", "document_fulltext"],
+            as_list=True,
+        )
+    )
+
+    settings = frappe.get_cached_doc("AI Settings")
+    min_similarity = settings.duplicate_similarity or DEFAULT_SIMILARITY
+    shingles = get_shingles(text)
+    numbers = get_number_tokens(text)
+    for query in queries:
+        candidate_text = fulltexts.get(query.paperless_doc)
+        if not candidate_text:
+            continue
+        if (
+            jaccard(shingles, get_shingles(candidate_text)) >= min_similarity
+            and jaccard(numbers, get_number_tokens(candidate_text)) >= MIN_NUMBER_SIMILARITY
+        ):
+            return query.name
+    return None
+
+
+def add_to_duplicate_index(prompt, ai_query, text):
+    # Bands expire after the window, duplicates arrive within weeks
+    if not text or not text.strip():
+        return
+    settings = frappe.get_cached_doc("AI Settings")
+    expires_in = (settings.duplicate_window_days or DEFAULT_WINDOW_DAYS) * 86400
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+    for key in get_band_keys(prompt, text):
+        pipeline.sadd(cache.make_key(key), ai_query)
+        pipeline.expire(cache.make_key(key), expires_in)
+    pipeline.execute()
+
+
+@frappe.whitelist()
+def rebuild_duplicate_index():
+    """
+    Indexes the valid AI Queries of the duplicate window again, e.g. after
+    redis was flushed.
+    """
+    frappe.only_for("System Manager")
+    settings = frappe.get_cached_doc("AI Settings")
+    queries = frappe.get_all(
+        "AI Query",
+        filters={
+            "creation": [">=", add_days(today(), -(settings.duplicate_window_days or DEFAULT_WINDOW_DAYS))],
+            "paperless_doc": ["is", "set"],
+            "duplicate_of": ["is", "not set"],
+        },
+        fields=["name", "ai_prompt_template", "paperless_doc", "validation_errors"],
+    )
+    for query in queries:
+        if query.validation_errors or not query.ai_prompt_template:
+            continue
+        text = frappe.db.get_value("Paperless Document", query.paperless_doc, "document_fulltext")
+        add_to_duplicate_index(query.ai_prompt_template, query.name, text)
+    return len(queries)
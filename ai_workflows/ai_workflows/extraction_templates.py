@@ -0,0 +1,602 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""
+Per supplier extraction templates learned from confirmed extractions: AI
+Queries whose Purchase Invoice was submitted. A template holds one rule per
+field of the AI response:
+
+- anchor: a regex of the text in front of the value, e.g. "Invoice number:"
+- rows: one regex per item line, with a group per item field
+- constant: a text header field the same in every example that no anchor
+  reproduces, e.g. the currency or payment method. Numbers, dates and item
+  fields are always read from the text.
+
+Rules are only kept when they reproduce every example. Documents are matched
+to a template by the supplier's VAT ID in the fulltext, and the result must
+pass the JSON schema, the sum of its line totals must be written in the text
+and the totals check of the AI Prompt must pass, otherwise the document goes
+to the AI.
+"""
+
+import json
+import re
+from datetime import datetime
+
+import frappe
+from frappe.utils import flt, now_datetime
+
+from ai_workflows.ai_workflows.cascade import check_invoice_totals, is_number
+from ai_workflows.ai_workflows.chunking import ITEM_LIST_KEY, ITEMS_KEY
+from ai_workflows.ai_workflows.duplicates import VAT_ID
+from ai_workflows.ai_workflows.schema_validation import get_compiled_schema
+
+TEMPLATE_MIN_EXAMPLES = 3
+TEMPLATE_MAX_EXAMPLES = 10
+# Text in front of a value tried as anchor, in characters and words
+ANCHOR_MAX_LENGTH = 60
+ANCHOR_MAX_WORDS = 6
+# Combinations of value positions tried per item line
+ROW_MAX_CANDIDATES = 200
+NUMBER_TOLERANCE = 0.005
+
+NUMBER = r"-?\d(?:[\d.,']*\d)?"
+DATE = r"\d{1,4}[./-]\d{1,2}[./-]\d{2,4}"
+TOKEN = r"\S+"
+PHRASE = r"\S(?:[^\n]*?\S)?"
+# A phrase ends before a column gap or the end of the line
+PHRASE_END = r"(?=[ \t]{2,}|[ \t]*(?:\n|$))"
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+DATE_FORMATS = ("%d.%m.%Y", "%d.%m.%y", "%d/%m/%Y", "%m/%d/%Y", "%Y-%m-%d", "%d-%m-%Y", "%Y/%m/%d")
+LITERAL_PART = re.compile(r"\s+|\d+|.", re.S)
+
+MISSING = object()
+
+
+class TemplateError(Exception):
+    # A field of the examples no rule reproduces
+    pass
+
+
+def normalize_tax_id(tax_id):
+    return re.sub(r"\s", "", tax_id or "").upper()
+
+
+def get_tax_ids(text):
+    return {normalize_tax_id(vat_id) for vat_id in VAT_ID.findall(text or "")}
+
+
+# Values
+
+
+def get_kind(values):
+    # How the values of a field are found in the text
+    values = [value for value in values if value is not None]
+    if not values or any(isinstance(value, (bool, dict, list)) for value in values):
+        return None
+    if all(isinstance(value, (int, float)) for value in values):
+        return "number"
+    if all(isinstance(value, str) and ISO_DATE.match(value) for value in values):
+        return "date"
+    if all(isinstance(value, str) for value in values):
+        return "phrase" if any(len(value.split()) > 1 for value in values) else "token"
+    return None
+
+
+def get_value_pattern(kind):
+    return {"number": NUMBER, "date": DATE, "token": TOKEN, "phrase": PHRASE}[kind]
+
+
+def parse_number(text, decimal):
+    thousands = "," if decimal == "." else "."
+    try:
+        return float(text.replace("'", "").replace(thousands, "").replace(decimal, "."))
+    except ValueError:
+        return None
+
+
+def parse_date(text, date_format):
+    try:
+        return datetime.strptime(text, date_format).date().isoformat()
+    except ValueError:
+        return None
+
+
+def convert(text, spec):
+    # Text of a regex group to the JSON value of a field
+    if spec.get("subpattern"):
+        match = re.fullmatch(spec["subpattern"], text)
+        if not match:
+            return None
+        text = match.group(1)
+    if spec["kind"] == "number":
+        value = parse_number(text, spec["decimal"])
+        if value is not None and spec.get("integer"):
+            return int(round(value))
+        return value
+    if spec["kind"] == "date":
+        return parse_date(text, spec["date_format"])
+    return text.strip()
+
+
+def values_equal(a, b):
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+        return abs(a - b) < NUMBER_TOLERANCE
+    return a == b
+
+
+def find_values(text, value, kind, start=0, end=None):
+    """
+    Yields (start, end, spec) of the places the value is written in the text,
+    with the decimal separator or date format it is written in.
+    """
+    end = len(text) if end is None else end
+    if kind == "number":
+        for match in re.finditer(NUMBER, text[start:end]):
+            for decimal in (".", ","):
+                if values_equal(parse_number(match.group(), decimal), value):
+                    spec = {"kind": kind, "decimal": decimal, "integer": isinstance(value, int)}
+                    yield start + match.start(), start + match.end(), spec
+    elif kind == "date":
+        for match in re.finditer(DATE, text[start:end]):
+            for date_format in DATE_FORMATS:
+                if parse_date(match.group(), date_format) == value:
+                    yield start + match.start(), start + match.end(), {"kind": kind, "date_format": date_format}
+    else:
+        pattern = r"(?<!\w)" + re.escape(value.strip()) + r"(?!\w)"
+        for match in re.finditer(pattern, text[start:end]):
+            yield start + match.start(), start + match.end(), {"kind": kind}
+
+
+# Paths
+
+
+def get_leaves(data, path=()):
+    # (path, value) of the scalars and lists of a JSON object
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from get_leaves(value, path + (key,))
+        else:
+            yield path + (key,), value
+
+
+def get_at_path(data, path):
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            return MISSING
+        data = data[key]
+    return data
+
+
+def set_at_path(data, path, value):
+    for key in path[:-1]:
+        data = data.setdefault(key, {})
+    data[path[-1]] = value
+
+
+# Learning
+
+
+def learn_rules(examples):
+    """
+    Learns the rules of a template from (fulltext, data) pairs. Raises
+    TemplateError naming the first field no rule reproduces.
+    """
+    paths = []
+    for _, data in examples:
+        for path, _ in get_leaves(data):
+            if path not in paths:
+                paths.append(path)
+
+    fields = []
+    rows = []
+    for path in paths:
+        values = [get_at_path(data, path) for _, data in examples]
+        label = ".".join(path)
+        if any(isinstance(value, list) for value in values):
+            rule = learn_row_rule(examples, path)
+            if not rule:
+                raise TemplateError(f"no line pattern reproduces the lines of {label}")
+            rows.append(rule)
+            continue
+        rule = learn_anchor_rule(examples, path)
+        if not rule and is_constant(values):
+            rule = {"path": list(path), "type": "constant", "value": values[0]}
+        if not rule:
+            raise TemplateError(f"no anchor in the text reproduces {label}")
+        fields.append(rule)
+
+    rules = {"fields": fields, "rows": rows}
+    for text, data in examples:
+        errors = check_line_sum(apply_rules(rules, text), text)
+        if errors:
+            raise TemplateError(errors[0])
+    return rules
+
+
+def is_constant(values):
+    # Only text header fields, a number or date the same in a few examples is chance
+    if any(value is MISSING for value in values) or get_kind(values) in ("number", "date"):
+        return False
+    return all(json.dumps(value, sort_keys=True) == json.dumps(values[0], sort_keys=True) for value in values)
+
+
+def learn_anchor_rule(examples, path):
+    values = [get_at_path(data, path) for _, data in examples]
+    kind = get_kind([value for value in values if value is not MISSING])
+    if not kind:
+        return None
+    # Values missing or null in an example must not be found in its text
+    expected = [MISSING if value is None else value for value in values]
+
+    # Candidates from the first example having the value, checked against all
+    text, value = next((text, value) for (text, _), value in zip(examples, expected) if value is not MISSING)
+    tried = set()
+    for start, _, spec in find_values(text, value, kind):
+        for anchor in get_anchors(text[max(start - ANCHOR_MAX_LENGTH, 0) : start]):
+            rule = {
+                "path": list(path),
+                "type": "anchor",
+                "pattern": get_anchor_pattern(anchor) + r"\s*(" + get_value_pattern(kind) + ")"
+                + (PHRASE_END if kind == "phrase" else ""),
+                "optional": MISSING in expected,
+                "null": None in values,
+                **spec,
+            }
+            if rule["pattern"] in tried:
+                continue
+            tried.add(rule["pattern"])
+            if all(
+                values_equal(apply_anchor_rule(rule, text), value)
+                for (text, _), value in zip(examples, expected)
+            ):
+                return rule
+    return None
+
+
+def get_anchors(context):
+    # Text in front of a value, shortest first, from its last word on
+    words = context.split()
+    for count in range(1, min(len(words), ANCHOR_MAX_WORDS) + 1):
+        anchor = " ".join(words[-count:])
+        if any(ch.isalpha() for ch in anchor):
+            yield anchor
+
+
+def get_anchor_pattern(anchor):
+    # Any whitespace between the words, OCR is not exact about it
+    return r"\s+".join(re.escape(word) for word in anchor.split())
+
+
+def learn_row_rule(examples, path):
+    all_items = [get_at_path(data, path) for _, data in examples]
+    if any(not isinstance(items, list) for items in all_items):
+        return None
+    items = [item for example_items in all_items for item in example_items]
+    if not items or not all(isinstance(item, dict) for item in items):
+        return None
+    keys = list(items[0])
+    if any(list(item) != keys for item in items):
+        return None
+
+    variable = []
+    for key in keys:
+        values = [item[key] for item in items]
+        kind = get_kind(values)
+        if not kind or any(value is None for value in values):
+            return None
+        variable.append((key, kind))
+
+    # Candidate patterns from the first item line, checked against all examples
+    text, items = next((text, items) for (text, _), items in zip(examples, all_items) if items)
+    tried = set()
+    for line_start, line_end in get_line_bounds(text):
+        for rule in get_row_candidates(text, line_start, line_end, items[0], variable):
+            rule.update({"path": list(path), "keys": keys})
+            if rule["pattern"] in tried:
+                continue
+            tried.add(rule["pattern"])
+            if all(
+                rows_equal(apply_row_rule(rule, text), items)
+                for (text, _), items in zip(examples, all_items)
+            ):
+                for key, kind in variable:
+                    if not is_column_certain(rule, key, kind, examples, all_items):
+                        raise TemplateError(
+                            f"{'.'.join(path)}.{key} is written at more than one place in every item line"
+                        )
+                return rule
+    return None
+
+
+def is_column_certain(rule, key, kind, examples, all_items):
+    """
+    Whether at least one item line has the value of the field at one place
+    only. Otherwise the examples do not tell the column, e.g. a quantity of 1
+    in every line next to the position 1, or totals equal to unit prices.
+    Places inside the value of another field do not count.
+    """
+    group = rule["fields"][key]["group"]
+    others = {field["group"] for other, field in rule["fields"].items() if other != key} - {group}
+    for (text, _), items in zip(examples, all_items):
+        for match, item in zip(re.finditer(rule["pattern"], text, re.M), items):
+            inside = [match.span(other) for other in others]
+            places = {
+                (start, end)
+                for start, end, _ in find_values(text, item[key], kind, match.start(), match.end())
+                if not any(o_start <= start and end <= o_end for o_start, o_end in inside)
+            }
+            if len(places) == 1:
+                return True
+    return False
+
+
+def get_line_bounds(text):
+    start = 0
+    for line in text.split("\n"):
+        yield start, start + len(line)
+        start += len(line) + 1
+
+
+def get_row_candidates(text, line_start, line_end, item, variable):
+    """
+    One pattern per combination of places of the item's values in a line.
+    A value inside another one, e.g. an item name at the start of the
+    description, is taken from that value's group with a pattern of its own.
+    """
+    places = []
+    for key, kind in variable:
+        found = list(find_values(text, item[key], kind, line_start, line_end))
+        if not found:
+            return
+        places.append(found)
+
+    for count, combination in enumerate(iter_combinations(places)):
+        if count == ROW_MAX_CANDIDATES:
+            return
+        kinds = {}
+        for (_, kind), (start, end, _) in zip(variable, combination):
+            kinds.setdefault((start, end), kind)
+        # Longest first, so values inside another one find it as outer span
+        spans = []
+        inner = {}
+        for span in sorted(kinds, key=lambda span: (span[0], -span[1])):
+            outer = next((outer for outer in spans if outer[0] <= span[0] and span[1] <= outer[1]), None)
+            if outer:
+                inner[span] = outer
+            elif spans and spans[-1][1] > span[0]:
+                break
+            else:
+                spans.append(span)
+        else:
+            groups = {span: f"g{i}" for i, span in enumerate(spans)}
+            fields = {}
+            for (key, _), (start, end, spec) in zip(variable, combination):
+                outer = inner.get((start, end))
+                if outer:
+                    subpattern = (
+                        get_literal_pattern(text[outer[0] : start])
+                        + f"({get_value_pattern(kinds[(start, end)])})"
+                        + get_literal_pattern(text[end : outer[1]])
+                    )
+                    fields[key] = {"group": groups[outer], "subpattern": subpattern, **spec}
+                else:
+                    fields[key] = {"group": groups[(start, end)], **spec}
+
+            pattern = r"^[ \t]*" + get_literal_pattern(text[line_start : spans[0][0]].lstrip(" \t"))
+            for i, span in enumerate(spans):
+                if i:
+                    pattern += get_literal_pattern(text[spans[i - 1][1] : span[0]])
+                pattern += f"(?P<{groups[span]}>{get_value_pattern(kinds[span])})"
+            pattern += get_literal_pattern(text[spans[-1][1] : line_end].rstrip(" \t")) + r"[ \t]*$"
+            yield {"type": "rows", "pattern": pattern, "fields": fields}
+
+
+def iter_combinations(places, chosen=()):
+    if len(chosen) == len(places):
+        yield chosen
+        return
+    for place in places[len(chosen)]:
+        yield from iter_combinations(places, chosen + (place,))
+
+
+def get_literal_pattern(text):
+    # Text between the values of an item line: digits (e.g. positions) vary
+    pattern = ""
+    for part in LITERAL_PART.findall(text):
+        if part.isspace():
+            pattern += r"[ \t]+"
+        elif part.isdigit():
+            pattern += r"\d+"
+        else:
+            pattern += re.escape(part)
+    return pattern
+
+
+def rows_equal(rows, items):
+    return len(rows) == len(items) and all(
+        list(row) == list(item) and all(values_equal(row[key], item[key]) for key in item)
+        for row, item in zip(rows, items)
+    )
+
+
+# Extraction
+
+
+def apply_anchor_rule(rule, text):
+    match = re.search(rule["pattern"], text)
+    if not match:
+        return MISSING
+    return convert(match.group(1), rule)
+
+
+def apply_row_rule(rule, text):
+    rows = []
+    for match in re.finditer(rule["pattern"], text, re.M):
+        rows.append(
+            {key: convert(match.group(rule["fields"][key]["group"]), rule["fields"][key]) for key in rule["keys"]}
+        )
+    return rows
+
+
+def apply_rules(rules, text):
+    """
+    Extracts a document with the rules of a template. Returns None when a
+    required field is not found.
+    """
+    data = {}
+    for rule in rules["fields"]:
+        if rule["type"] == "constant":
+            value = rule["value"]
+        else:
+            value = apply_anchor_rule(rule, text)
+            if value is MISSING and rule["null"]:
+                value = None
+            elif value is MISSING and rule["optional"]:
+                continue
+            elif value is MISSING or value is None:
+                return None
+        set_at_path(data, rule["path"], value)
+    for rule in rules["rows"]:
+        set_at_path(data, rule["path"], apply_row_rule(rule, text))
+    return data
+
+
+def extract_with_template(prompt, text):
+    """
+    Returns (template, response) of the first template of the supplier whose
+    extraction passes the schema and the totals check, else (None, None).
+    """
+    tax_ids = get_tax_ids(text)
+    if not tax_ids:
+        return None, None
+    templates = frappe.get_all(
+        "AI Extraction Template",
+        filters={"ai_prompt": prompt.name, "tax_id": ["in", list(tax_ids)], "enabled": 1, "status": "Active"},
+        fields=["name", "rules"],
+    )
+    for template in templates:
+        data = apply_rules(json.loads(template.rules), text)
+        errors = ["$: a field of the template was not found"] if data is None else []
+        if not errors and prompt.json_scema:
+            errors = get_compiled_schema(prompt).validate(data)
+        if not errors:
+            errors = check_line_sum(data, text) or check_invoice_totals(prompt, data)
+        count_template_use(template.name, "fallbacks" if errors else "hits")
+        if not errors:
+            return template.name, json.dumps(data)
+    return None, None
+
+
+def check_line_sum(data, text):
+    """
+    The line totals of an extraction must add up to an amount written in the
+    text, e.g. the net total. Catches item lines a rule missed or misread.
+    """
+    items = get_at_path(data or {}, (ITEMS_KEY, ITEM_LIST_KEY))
+    if not isinstance(items, list) or not items:
+        return [f"$.{ITEMS_KEY}.{ITEM_LIST_KEY}: no item lines"]
+    totals = [item.get("Total") if isinstance(item, dict) else None for item in items]
+    if not all(is_number(total) for total in totals):
+        return [f"$.{ITEMS_KEY}.{ITEM_LIST_KEY}: not every line has a Total"]
+    line_sum = round(sum(flt(total) for total in totals), 2)
+    if next(find_values(text, line_sum, "number"), None) is None:
+        return [f"$.{ITEMS_KEY}.{ITEM_LIST_KEY}: the line totals add up to {line_sum}, not found in the text"]
+    return []
+
+
+def count_template_use(template, field):
+    frappe.db.sql(
+        f"update `tabAI Extraction Template` set `{field}` = `{field}` + 1 where name = %s",
+        template,
+    )
+
+
+# Learning from submitted Purchase Invoices
+
+
+def learn_from_purchase_invoice(doc, method=None):
+    # doc_events hook: learn again from the confirmed extractions of the supplier
+    for ai_prompt in frappe.get_all(
+        "AI Query", filters={"document": doc.name}, pluck="ai_prompt_template", distinct=True
+    ):
+        if ai_prompt and frappe.get_cached_value("AI Prompt", ai_prompt, "enable_extraction_templates"):
+            frappe.enqueue(
+                "ai_workflows.ai_workflows.extraction_templates.learn_extraction_template",
+                queue="short",
+                ai_prompt=ai_prompt,
+                supplier=doc.supplier,
+                enqueue_after_commit=True,
+            )
+
+
+def learn_extraction_template(ai_prompt, supplier):
+    """
+    Learns the template of a supplier and AI Prompt from the latest AI
+    Queries with a submitted Purchase Invoice. Needs TEMPLATE_MIN_EXAMPLES.
+    """
+    tax_id = normalize_tax_id(frappe.db.get_value("Supplier", supplier, "tax_id"))
+    if not tax_id:
+        return None
+    examples = get_examples(ai_prompt, supplier)
+    if len(examples) < TEMPLATE_MIN_EXAMPLES:
+        return None
+
+    name = frappe.db.get_value("AI Extraction Template", {"ai_prompt": ai_prompt, "supplier": supplier})
+    template = frappe.get_doc("AI Extraction Template", name) if name else frappe.new_doc("AI Extraction Template")
+    template.ai_prompt = ai_prompt
+    template.supplier = supplier
+    template.tax_id = tax_id
+    template.examples = len(examples)
+    template.last_learned = now_datetime()
+    try:
+        template.rules = json.dumps(learn_rules(examples), indent=1)
+        template.status = "Active"
+        template.status_message = ""
+    except TemplateError as e:
+        template.status = "Incomplete"
+        template.status_message = str(e)
+    template.save(ignore_permissions=True)
+    return template.name
+
+
+def get_examples(ai_prompt, supplier):
+    queries = frappe.get_all(
+        "AI Query",
+        filters={
+            "ai_prompt_template": ai_prompt,
+            "supplier": supplier,
+            "document": ["is", "set"],
+            "paperless_doc": ["is", "set"],
+            "duplicate_of": ["is", "not set"],
+        },
+        fields=["document", "paperless_doc", "ai_response_json"],
+        order_by="creation desc",
+        limit=TEMPLATE_MAX_EXAMPLES * 2,
+    )
+    if not queries:
+        return []
+    submitted = set(
+        frappe.get_all(
+            "Purchase Invoice",
+            filters={"name": ["in", [query.document for query in queries]], "docstatus": 1},
+            pluck="name",
+        )
+    )
+
+    examples = []
+    for query in queries:
+        # An invoice may have been extracted more than once
+        if query.document not in submitted:
+            continue
+        submitted.discard(query.document)
+        try:
+            data = json.loads(query.ai_response_json)
+        except (TypeError, ValueError):
+            continue
+        text = frappe.db.get_value("Paperless Document", query.paperless_doc, "document_fulltext")
+        if text and isinstance(data, dict):
+            examples.append((text, data))
+        if len(examples) == TEMPLATE_MAX_EXAMPLES:
+            break
+    return examples
@@ -0,0 +1,285 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""
+Few-shot examples for AI Prompts: confirmed extractions (AI Queries whose
+Purchase Invoice was submitted) are stored as AI Few-Shot Examples, and the
+most similar ones by BM25 over their words are added to the prompt of a new
+document.
+
+Each worker keeps an in-memory BM25 index per AI Prompt and updates it
+incrementally when another process added or removed examples.
+"""
+
+import json
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+import frappe
+
+from ai_workflows.ai_workflows.compaction import compact_fulltext
+from ai_workflows.ai_workflows.tokens import count_tokens
+
+# Redis key per AI Prompt holding the index version, bumped on every change
+INDEX_VERSION_KEY = "ai_workflows_few_shot_version|"
+MAX_EXAMPLES_PER_PROMPT = 3
+DEFAULT_MAX_INDEX_SIZE = 500
+DEFAULT_EXAMPLE_TOKENS = 800
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Layout words, amounts and numbers differ between any two documents
+WORD = re.compile(r"[^\W\d_]{2,}", re.UNICODE)
+
+# Per-worker indexes: (site, prompt) -> (version, FewShotIndex)
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_terms(text):
+    return Counter(word.casefold() for word in WORD.findall(text or ""))
+
+
+class FewShotIndex:
+    """
+    In-memory BM25 index of the AI Few-Shot Examples of one AI Prompt.
+    """
+
+    def __init__(self, examples=()):
+        self.entries = {}
+        self.postings = defaultdict(set)
+        self.total_length = 0
+        for example in examples:
+            self.add(example)
+
+    def add(self, example):
+        self.remove(example.name)
+        terms = get_terms(example.input_text)
+        length = sum(terms.values())
+        self.entries[example.name] = (example, terms, length)
+        self.total_length += length
+        for term in terms:
+            self.postings[term].add(example.name)
+
+    def remove(self, name):
+        if name not in self.entries:
+            return
+        _, terms, length = self.entries.pop(name)
+        self.total_length -= length
+        for term in terms:
+            self.postings[term].discard(name)
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def search(self, text, limit, exclude=None):
+        """
+        Returns the limit examples scoring highest for the text, skipping
+        examples of the Paperless Document exclude.
+        """
+        if not self.entries or limit <= 0:
+            return []
+        count = len(self.entries)
+        average_length = self.total_length / count or 1
+        scores = defaultdict(float)
+        for term in get_terms(text):
+            names = self.postings.get(term)
+            if not names:
+                continue
+            idf = math.log(1 + (count - len(names) + 0.5) / (len(names) + 0.5))
+            for name in names:
+                _, terms, length = self.entries[name]
+                frequency = terms[term]
+                scores[name] += idf * frequency * (BM25_K1 + 1) / (
+                    frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                )
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        examples = []
+        for name, _ in ranked:
+            example = self.entries[name][0]
+            if exclude and example.paperless_doc == exclude:
+                continue
+            examples.append(example)
+            if len(examples) == limit:
+                break
+        return examples
+
+    def sync(self, rows):
+        # Applies the current example names of the prompt, loading only new ones
+        names = {row.name for row in rows}
+        for name in set(self.entries) - names:
+            self.remove(name)
+        new = [row.name for row in rows if row.name not in self.entries]
+        for example in get_example_rows({"name": ["in", new]}) if new else ():
+            self.add(example)
+
+
+def get_example_rows(filters):
+    return frappe.get_all(
+        "AI Few-Shot Example",
+        filters=filters,
+        fields=["name", "paperless_doc", "input_text", "output_json"],
+    )
+
+
+def get_few_shot_index(prompt):
+    """
+    Returns this worker's index of an AI Prompt, brought up to date when
+    another process added or removed examples since.
+    """
+    key = (frappe.local.site, prompt)
+    version = frappe.cache().get_value(INDEX_VERSION_KEY + prompt)
+    with _indexes_lock:
+        cached = _indexes.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    if cached:
+        index = cached[1]
+        index.sync(frappe.get_all("AI Few-Shot Example", filters={"ai_prompt": prompt}, fields=["name"]))
+    else:
+        index = FewShotIndex(get_example_rows({"ai_prompt": prompt}))
+    with _indexes_lock:
+        _indexes[key] = (version, index)
+    return index
+
+
+def bump_index_version(prompt):
+    frappe.cache().set_value(INDEX_VERSION_KEY + prompt, frappe.generate_hash(length=10))
+
+
+def get_few_shot_examples(prompt, document_fulltext, paperless_doc=None):
+    # The examples of an AI Prompt most similar to a document
+    limit = min(prompt.get("few_shot_examples") or 0, MAX_EXAMPLES_PER_PROMPT)
+    if limit <= 0 or not document_fulltext:
+        return []
+    return get_few_shot_index(prompt.name).search(document_fulltext, limit, exclude=paperless_doc)
+
+
+def get_few_shot_messages(examples):
+    # Each example as a turn of the conversation, between instructions and document
+    messages = []
+    for example in examples:
+        messages.append({"role": "user", "content": example.input_text})
+        messages.append({"role": "assistant", "content": example.output_json})
+    return messages
+
+
+def add_few_shot_example(ai_query):
+    """
+    Stores a confirmed AI Query as example of its AI Prompt and drops the
+    oldest examples above the prompt's Few-Shot Index Size. Documents longer
+    than the prompt's Few-Shot Example Tokens are no example: a shortened
+    text would teach the model items it does not show.
+    """
+    query = frappe.db.get_value(
+        "AI Query",
+        ai_query,
+        ["name", "ai_prompt_template", "paperless_doc", "supplier", "ai_response_json"],
+        as_dict=True,
+    )
+    if not query or not query.ai_prompt_template or not query.paperless_doc:
+        return None
+    prompt = frappe.get_cached_doc("AI Prompt", query.ai_prompt_template)
+    try:
+        output = json.loads(query.ai_response_json)
+    except (TypeError, ValueError):
+        return None
+    text = compact_fulltext(
+        prompt, frappe.db.get_value("Paperless Document", query.paperless_doc, "document_fulltext")
+    )
+    if not text:
+        return None
+
+    name = frappe.db.get_value("AI Few-Shot Example", {"ai_query": ai_query})
+    if count_tokens(text) > (prompt.get("few_shot_example_tokens") or DEFAULT_EXAMPLE_TOKENS):
+        if name:
+            frappe.delete_doc("AI Few-Shot Example", name, ignore_permissions=True)
+            bump_index_version(prompt.name)
+        return None
+    example = frappe.get_doc("AI Few-Shot Example", name) if name else frappe.new_doc("AI Few-Shot Example")
+    example.update(
+        {
+            "ai_prompt": prompt.name,
+            "ai_query": query.name,
+            "paperless_doc": query.paperless_doc,
+            "supplier": query.supplier,
+            "input_text": text,
+            "output_json": json.dumps(output, ensure_ascii=False, separators=(",", ":")),
+        }
+    )
+    example.save(ignore_permissions=True)
+
+    max_size = prompt.get("few_shot_index_size") or DEFAULT_MAX_INDEX_SIZE
+    for old in frappe.get_all(
+        "AI Few-Shot Example",
+        filters={"ai_prompt": prompt.name},
+        order_by="creation desc",
+        limit_start=max_size,
+        limit_page_length=1000,
+        pluck="name",
+    ):
+        frappe.delete_doc("AI Few-Shot Example", old, ignore_permissions=True)
+    bump_index_version(prompt.name)
+    return example.name
+
+
+def update_few_shot_examples(doc, method=None):
+    """
+    Purchase Invoice on_submit / on_cancel hook: its LLM extractions become
+    examples on submit and are dropped on cancel.
+    """
+    queries = frappe.get_all(
+        "AI Query",
+        filters={"document": doc.name, "duplicate_of": ["is", "not set"], "extraction_template": ["is", "not set"]},
+        fields=["name", "ai_prompt_template"],
+    )
+    for query in queries:
+        if not query.ai_prompt_template or not frappe.get_cached_value(
+            "AI Prompt", query.ai_prompt_template, "few_shot_examples"
+        ):
+            continue
+        if method == "on_cancel":
+            for name in frappe.get_all("AI Few-Shot Example", filters={"ai_query": query.name}, pluck="name"):
+                frappe.delete_doc("AI Few-Shot Example", name, ignore_permissions=True)
+            bump_index_version(query.ai_prompt_template)
+        else:
+            add_few_shot_example(query.name)
+
+
+@frappe.whitelist()
+def rebuild_few_shot_examples(ai_prompt):
+    """
+    Stores the confirmed AI Queries of an AI Prompt as examples again, newest
+    last so the size limit keeps the latest ones.
+    """
+    frappe.only_for("System Manager")
+    prompt = frappe.get_doc("AI Prompt", ai_prompt)
+    queries = frappe.get_all(
+        "AI Query",
+        filters={
+            "ai_prompt_template": ai_prompt,
+            "document": ["is", "set"],
+            "duplicate_of": ["is", "not set"],
+            "extraction_template": ["is", "not set"],
+        },
+        fields=["name", "document"],
+        order_by="creation desc",
+        limit=prompt.get("few_shot_index_size") or DEFAULT_MAX_INDEX_SIZE,
+    )
+    if not queries:
+        return 0
+    submitted = set(
+        frappe.get_all(
+            "Purchase Invoice",
+            filters={"name": ["in", [query.document for query in queries]], "docstatus": 1},
+            pluck="name",
+        )
+    )
+    added = 0
+    for query in reversed(queries):
+        if query.document in submitted and add_few_shot_example(query.name):
+            added += 1
+    return added
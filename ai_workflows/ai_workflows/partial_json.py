@@ -0,0 +1,59 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import json
+from collections import deque
+
+# Number of earlier cut points tried when the completed text does not parse
+MAX_CUT_CANDIDATES = 5
+
+
+def parse_partial_json(text):
+    """
+    Best-effort parse of a JSON object that is still being streamed.
+
+    Open strings, objects and arrays are closed; if that does not parse, the
+    text is cut back to the last complete member. Returns None while nothing
+    parseable has arrived yet. Only for showing progress, final answers are
+    parsed with schema_validation.parse_json_response.
+    """
+    start = text.find("{") if text else -1
+    if start < 0:
+        return None
+
+    stack = []
+    in_string = False
+    escape = False
+    # (position, closers needed at that position)
+    cuts = deque(maxlen=MAX_CUT_CANDIDATES)
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            cuts.append((i + 1, "".join(reversed(stack))))
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            cuts.append((i + 1, "".join(reversed(stack))))
+        elif ch == ",":
+            cuts.append((i, "".join(reversed(stack))))
+
+    body = text[start:-1] if escape else text[start:]
+    candidates = [body + ('"' if in_string else "") + "".join(reversed(stack))]
+    candidates += [text[start:cut] + closers for cut, closers in reversed(cuts)]
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            continue
+    return None
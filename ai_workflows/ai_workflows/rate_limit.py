@@ -0,0 +1,146 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
+import frappe
+
+from ai_workflows.ai_workflows.tokens import count_request_tokens
+
+# Assumed completion size when a request does not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 1000
+# In-flight slots are leased, so a crashed worker cannot block an AI forever
+INFLIGHT_LEASE_MS = 600000
+# Poll interval while waiting for a free in-flight slot
+INFLIGHT_POLL_INTERVAL = 0.25
+
+# Two token buckets (requests and tokens per minute) refilled continuously.
+# Returns 0 when capacity was taken, otherwise the milliseconds to wait.
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local cost = math.min(tonumber(ARGV[3]), tpm)
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'ts')
+local requests = tonumber(state[1]) or rpm
+local tokens = tonumber(state[2]) or tpm
+local elapsed = math.max(0, now_ms - (tonumber(state[3]) or now_ms))
+requests = math.min(rpm, requests + elapsed * rpm / 60000)
+tokens = math.min(tpm, tokens + elapsed * tpm / 60000)
+local wait = 0
+if rpm > 0 and requests < 1 then
+    wait = math.max(wait, (1 - requests) * 60000 / rpm)
+end
+if tpm > 0 and tokens < cost then
+    wait = math.max(wait, (cost - tokens) * 60000 / tpm)
+end
+if wait == 0 then
+    requests = requests - 1
+    tokens = tokens - cost
+end
+redis.call('HSET', KEYS[1], 'requests', tostring(requests), 'tokens', tostring(tokens), 'ts', now_ms)
+redis.call('PEXPIRE', KEYS[1], 120000)
+return math.ceil(wait)
+"""
+
+# Leased semaphore on a sorted set scored by lease expiry
+ACQUIRE_SLOT_SCRIPT = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], now_ms + tonumber(ARGV[2]), ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[2]))
+    return 1
+end
+return 0
+"""
+
+
+class RateLimiter:
+    """
+    Redis backed limiter shared by all workers and bench nodes using the same
+    redis cache. Budgets come from the AI record: requests per minute, tokens
+    per minute and max in-flight requests (0 means unlimited).
+
+    Build it on a frappe thread, acquire() and release() only talk to redis and
+    can be used from worker threads.
+    """
+
+    def __init__(self, ai_name):
+        limits = frappe.get_cached_value(
+            "AI",
+            ai_name,
+            ["requests_per_minute", "tokens_per_minute", "max_inflight_requests"],
+            as_dict=True,
+        )
+        self.requests_per_minute = limits.requests_per_minute or 0
+        self.tokens_per_minute = limits.tokens_per_minute or 0
+        self.max_inflight_requests = limits.max_inflight_requests or 0
+
+        cache = frappe.cache()
+        self.redis = cache
+        self.bucket_key = cache.make_key(f"ai_workflows_rate_limit|{ai_name}")
+        self.inflight_key = cache.make_key(f"ai_workflows_inflight|{ai_name}")
+
+    @property
+    def enabled(self):
+        return bool(
+            self.requests_per_minute or self.tokens_per_minute or self.max_inflight_requests
+        )
+
+    def acquire(self, tokens):
+        # Blocks until the request fits into the budget, returns the slot id
+        if self.requests_per_minute or self.tokens_per_minute:
+            while True:
+                wait_ms = self.redis.eval(
+                    TOKEN_BUCKET_SCRIPT,
+                    1,
+                    self.bucket_key,
+                    self.requests_per_minute,
+                    self.tokens_per_minute,
+                    tokens,
+                )
+                if not wait_ms:
+                    break
+                # Small jitter keeps waiting workers from retrying in lockstep
+                time.sleep(int(wait_ms) / 1000 + random.uniform(0, 0.05))
+
+        if self.max_inflight_requests:
+            slot = uuid.uuid4().hex
+            while not self.redis.eval(
+                ACQUIRE_SLOT_SCRIPT,
+                1,
+                self.inflight_key,
+                self.max_inflight_requests,
+                INFLIGHT_LEASE_MS,
+                slot,
+            ):
+                time.sleep(INFLIGHT_POLL_INTERVAL + random.uniform(0, 0.05))
+            return slot
+
+    def release(self, slot):
+        if slot:
+            self.redis.zrem(self.inflight_key, slot)
+
+    @contextmanager
+    def limit(self, request):
+        if not self.enabled:
+            yield
+            return
+        slot = self.acquire(estimate_request_tokens(request))
+        try:
+            yield
+        finally:
+            self.release(slot)
+
+
+def estimate_request_tokens(request):
+    # Prompt tokens counted locally plus the expected completion size
+    return count_request_tokens(request) + (
+        request.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    )
@@ -0,0 +1,40 @@
+# Copyright (c) 2026, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, getdate
+
+from ai_workflows.ai_workflows.tracing import get_stage_statistics
+
+# Column -> (statistics key, label, fieldtype)
+COLUMNS = (
+	("count", _("Count"), "Int"),
+	("wall_time_p50", _("Wall p50 (ms)"), "Float"),
+	("wall_time_p95", _("Wall p95 (ms)"), "Float"),
+	("wall_time_p99", _("Wall p99 (ms)"), "Float"),
+	("db_queries_avg", _("Avg DB Queries"), "Float"),
+	("db_queries_p95", _("DB Queries p95"), "Int"),
+	("db_time_p95", _("DB p95 (ms)"), "Float"),
+	("llm_time_p50", _("LLM p50 (ms)"), "Float"),
+	("llm_time_p95", _("LLM p95 (ms)"), "Float"),
+	("llm_time_p99", _("LLM p99 (ms)"), "Float"),
+)
+
+
+def execute(filters=None):
+	filters = frappe._dict(filters or {})
+
+	columns = [{"fieldname": "stage", "label": _("Stage"), "fieldtype": "Data", "width": 200}]
+	columns += [
+		{"fieldname": key, "label": label, "fieldtype": fieldtype, "precision": 1, "width": 120}
+		for key, label, fieldtype in COLUMNS
+	]
+
+	data = get_stage_statistics(
+		getdate(filters.from_date),
+		# Include the whole last day
+		add_days(getdate(filters.to_date), 1) if filters.to_date else None,
+		filters.ai_prompt,
+	)
+	return columns, data
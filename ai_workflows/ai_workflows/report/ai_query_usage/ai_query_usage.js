@@ -0,0 +1,35 @@
+// Copyright (c) 2026, itsdave GmbH and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["AI Query Usage"] = {
+	filters: [
+		{
+			fieldname: "from_date",
+			label: __("From Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.add_months(frappe.datetime.get_today(), -1),
+			reqd: 1,
+		},
+		{
+			fieldname: "to_date",
+			label: __("To Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.get_today(),
+			reqd: 1,
+		},
+		{
+			fieldname: "group_by",
+			label: __("Group By"),
+			fieldtype: "Select",
+			options: ["AI Prompt", "Supplier", "Day", "Model"],
+			default: "AI Prompt",
+			reqd: 1,
+		},
+		{
+			fieldname: "ai",
+			label: __("AI"),
+			fieldtype: "Link",
+			options: "AI",
+		},
+	],
+};
@@ -0,0 +1,56 @@
+# Copyright (c) 2026, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+
+# Group By filter -> (SQL expression, column label, fieldtype, options)
+GROUP_BY = {
+	"AI Prompt": ("ai_prompt_template", _("AI Prompt"), "Link", "AI Prompt"),
+	"Supplier": ("supplier", _("Supplier"), "Link", "Supplier"),
+	"Day": ("date(creation)", _("Day"), "Date", None),
+	"Model": ("model", _("Model"), "Data", None),
+}
+
+
+def execute(filters=None):
+	filters = frappe._dict(filters or {})
+	group_expression, label, fieldtype, options = GROUP_BY[filters.group_by or "AI Prompt"]
+
+	columns = [
+		{"fieldname": "group_value", "label": label, "fieldtype": fieldtype, "options": options, "width": 200},
+		{"fieldname": "queries", "label": _("Queries"), "fieldtype": "Int", "width": 90},
+		{"fieldname": "cache_hits", "label": _("Cache Hits"), "fieldtype": "Int", "width": 100},
+		{"fieldname": "prompt_tokens", "label": _("Prompt Tokens"), "fieldtype": "Int", "width": 130},
+		{"fieldname": "cached_tokens", "label": _("Cached Tokens"), "fieldtype": "Int", "width": 130},
+		{"fieldname": "cached_share", "label": _("Cached Share"), "fieldtype": "Percent", "width": 120},
+		{"fieldname": "completion_tokens", "label": _("Completion Tokens"), "fieldtype": "Int", "width": 150},
+		{"fieldname": "cost", "label": _("Cost"), "fieldtype": "Float", "precision": 4, "width": 110},
+		{"fieldname": "avg_cost", "label": _("Avg Cost per Query"), "fieldtype": "Float", "precision": 6, "width": 150},
+	]
+
+	conditions = "date(creation) between %(from_date)s and %(to_date)s"
+	if filters.ai:
+		conditions += " and ai = %(ai)s"
+
+	data = frappe.db.sql(
+		f"""
+		select
+			{group_expression} as group_value,
+			count(*) as queries,
+			sum(served_from_cache) as cache_hits,
+			sum(prompt_tokens) as prompt_tokens,
+			sum(cached_tokens) as cached_tokens,
+			100 * sum(cached_tokens) / nullif(sum(prompt_tokens), 0) as cached_share,
+			sum(completion_tokens) as completion_tokens,
+			sum(cost) as cost,
+			avg(cost) as avg_cost
+		from `tabAI Query`
+		where {conditions}
+		group by {group_expression}
+		order by cost desc
+		""",
+		filters,
+		as_dict=True,
+	)
+	return columns, data
@@ -0,0 +1,93 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import hashlib
+import json
+import time
+
+import frappe
+
+# Redis key prefix for cached responses, and the sorted set of cache keys by
+# insert time used for size-based eviction
+CACHE_PREFIX = "ai_workflows_response|"
+CACHE_INDEX_KEY = "ai_workflows_response_inserted"
+
+
+def get_cache_key(ai_output_mode, request):
+    # Hash over output mode and the full request (model, messages, schema)
+    payload = json.dumps(
+        {"ai_output_mode": ai_output_mode, "request": request},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_cached_response(cache_key):
+    """
+    Returns the cached response text for a cache key, or None on a miss.
+    """
+    settings = frappe.get_cached_doc("AI Settings")
+    if not settings.enable_response_cache:
+        return None
+
+    resp = frappe.cache().get_value(CACHE_PREFIX + cache_key)
+    if resp is None and settings.persist_response_cache:
+        resp = frappe.db.get_value("AI Response Cache", cache_key, "response")
+        if resp is not None:
+            # Warm up redis again for the next hit
+            _set_redis_value(settings, cache_key, resp)
+    return resp
+
+
+def set_cached_response(cache_key, resp, ai_output_mode=None, model=None):
+    settings = frappe.get_cached_doc("AI Settings")
+    # Never cache empty answers, they are most likely failures
+    if not settings.enable_response_cache or not resp:
+        return
+
+    _set_redis_value(settings, cache_key, resp)
+
+    if settings.persist_response_cache and not frappe.db.exists(
+        "AI Response Cache", cache_key
+    ):
+        cache_doc = frappe.new_doc("AI Response Cache")
+        cache_doc.cache_key = cache_key
+        cache_doc.ai_output_mode = ai_output_mode
+        cache_doc.model = model
+        cache_doc.response = resp
+        cache_doc.insert(ignore_permissions=True)
+
+
+def clear_response_cache():
+    # Drop all redis entries, the persistent table is left untouched
+    cache = frappe.cache()
+    index_key = cache.make_key(CACHE_INDEX_KEY)
+    for cache_key in cache.zrange(index_key, 0, -1):
+        cache.delete_value(CACHE_PREFIX + frappe.safe_decode(cache_key))
+    cache.delete(index_key)
+
+
+def _set_redis_value(settings, cache_key, resp):
+    cache = frappe.cache()
+    cache.set_value(
+        CACHE_PREFIX + cache_key,
+        resp,
+        expires_in_sec=settings.response_cache_ttl or None,
+    )
+    # Writing a key again only moves it to its new insert time
+    now = time.time()
+    index_key = cache.make_key(CACHE_INDEX_KEY)
+    cache.zadd(index_key, {cache_key: now})
+    if settings.response_cache_ttl:
+        # Entries expired in redis no longer count
+        cache.zremrangebyscore(index_key, "-inf", now - settings.response_cache_ttl)
+
+    # Evict oldest entries when the size limit is exceeded
+    max_entries = settings.response_cache_max_entries
+    if max_entries:
+        excess = cache.zcard(index_key) - max_entries
+        if excess > 0:
+            for oldest, _ in cache.zpopmin(index_key, excess):
+                cache.delete_value(CACHE_PREFIX + frappe.safe_decode(oldest))
@@ -0,0 +1,153 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import ast
+
+import frappe
+from frappe.utils import cint, flt, getdate
+
+# Syntax allowed in decision conditions: literals, names, comparisons,
+# boolean logic, arithmetic, item/attribute access and calls of SAFE_FUNCTIONS
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BoolOp,
+    ast.And,
+    ast.Or,
+    ast.UnaryOp,
+    ast.Not,
+    ast.USub,
+    ast.UAdd,
+    ast.BinOp,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Compare,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.In,
+    ast.NotIn,
+    ast.Is,
+    ast.IsNot,
+    ast.IfExp,
+    ast.Constant,
+    ast.Name,
+    ast.Load,
+    ast.Attribute,
+    ast.Subscript,
+    ast.Slice,
+    ast.List,
+    ast.Tuple,
+    ast.Dict,
+    ast.Call,
+)
+
+# Longest str, list or tuple an expression may build by multiplication
+MAX_SEQUENCE_LENGTH = 10000
+
+SAFE_FUNCTIONS = {
+    "len": len,
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": bool,
+    "min": min,
+    "max": max,
+    "abs": abs,
+    "round": round,
+    "cint": cint,
+    "flt": flt,
+    "getdate": getdate,
+}
+
+
+class SafeExpression:
+    """
+    An expression validated and compiled once, evaluated against a dict of
+    names, e.g. SafeExpression("flt(grand_total) > 1000").evaluate(context).
+    Multiplication, modulo and attribute access are checked at evaluation.
+    """
+
+    def __init__(self, source):
+        self.source = source.strip()
+        try:
+            tree = ast.parse(self.source, mode="eval")
+        except SyntaxError as e:
+            frappe.throw(f"Invalid expression '{self.source}': {e.msg}")
+        validate_tree(tree, self.source)
+        tree = ast.fix_missing_locations(GuardTransformer().visit(tree))
+        self.code = compile(tree, "<expression>", "eval")
+
+    def evaluate(self, names):
+        clashes = [name for name in names if name in SAFE_FUNCTIONS or name.startswith("_")]
+        if clashes:
+            frappe.throw(f"Names {', '.join(clashes)} cannot be used in expression '{self.source}'")
+        return eval(self.code, {"__builtins__": {}, **SAFE_FUNCTIONS, **GUARDS}, names)
+
+
+def validate_tree(tree, source):
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            frappe.throw(f"'{type(node).__name__}' is not allowed in expression '{source}'")
+        if isinstance(node, ast.Attribute) and node.attr.startswith("_"):
+            frappe.throw(f"Private attribute '{node.attr}' is not allowed in expression '{source}'")
+        if isinstance(node, ast.Name) and node.id.startswith("_"):
+            frappe.throw(f"Private name '{node.id}' is not allowed in expression '{source}'")
+        if isinstance(node, ast.Call) and not (
+            isinstance(node.func, ast.Name) and node.func.id in SAFE_FUNCTIONS
+        ):
+            frappe.throw(f"Only calls of {', '.join(SAFE_FUNCTIONS)} are allowed in expression '{source}'")
+
+
+class GuardTransformer(ast.NodeTransformer):
+    # Replaces a * b, a % b and a.b by calls of the GUARDS
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        guard = {ast.Mult: "_multiply", ast.Mod: "_modulo"}.get(type(node.op))
+        if not guard:
+            return node
+        return ast.Call(func=ast.Name(guard, ast.Load()), args=[node.left, node.right], keywords=[])
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        return ast.Call(
+            func=ast.Name("_get_attribute", ast.Load()), args=[node.value, ast.Constant(node.attr)], keywords=[]
+        )
+
+
+def multiply(a, b):
+    # "a" * 10000000 would build the string before any comparison
+    for sequence, count in ((a, b), (b, a)):
+        if (
+            isinstance(sequence, (str, bytes, list, tuple))
+            and isinstance(count, int)
+            and len(sequence) * count > MAX_SEQUENCE_LENGTH
+        ):
+            frappe.throw(f"Sequences longer than {MAX_SEQUENCE_LENGTH} are not allowed in expressions")
+    return a * b
+
+
+def modulo(a, b):
+    # "%" on strings is formatting, "%0999999999d" builds a huge string
+    if isinstance(a, (str, bytes)):
+        frappe.throw("String formatting is not allowed in expressions")
+    return a % b
+
+
+def get_attribute(value, attr):
+    # Only data: fields of documents and dicts, no types, functions or methods
+    if isinstance(value, type) or callable(value):
+        frappe.throw(f"Attribute '{attr}' of a type or function is not allowed in expressions")
+    result = getattr(value, attr)
+    if callable(result):
+        frappe.throw(f"Attribute '{attr}' is a method, only data attributes are allowed in expressions")
+    return result
+
+
+GUARDS = {"_multiply": multiply, "_modulo": modulo, "_get_attribute": get_attribute}
@@ -0,0 +1,312 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import copy
+import json
+import re
+import threading
+
+import frappe
+
+
+FUNCTION_CALL_MODE = "Structured Output (JSON)"
+JSON_SCHEMA_MODE = "Structured Output (JSON Schema)"
+STRUCTURED_OUTPUT_MODES = (FUNCTION_CALL_MODE, JSON_SCHEMA_MODE)
+
+# Errors reported per response, enough to repair it without flooding the prompt
+MAX_REPORTED_ERRORS = 20
+
+CODE_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "null": type(None),
+}
+
+# Per-worker compiled schemas: (site, prompt, mode) -> (modified, CompiledSchema)
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def is_structured(prompt):
+    return prompt.ai_output_mode in STRUCTURED_OUTPUT_MODES
+
+
+class CompiledSchema:
+    """
+    The JSON schema of an AI Prompt, parsed once: the strict variant sent as
+    response_format and a validator compiled into nested check functions.
+    """
+
+    def __init__(self, json_schema, strict=True):
+        if not isinstance(json_schema, dict):
+            raise TypeError("the schema must be a JSON object")
+        self.schema = json_schema
+        self.strict_schema = to_strict_schema(json_schema)
+        # Function calling is validated against the schema as written
+        validated_schema = self.strict_schema if strict else json_schema
+        definitions = {
+            **validated_schema.get("definitions", {}),
+            **validated_schema.get("$defs", {}),
+        }
+        self.check = compile_schema(validated_schema, definitions, {})
+
+    def validate(self, data):
+        errors = []
+        self.check(data, "$", errors)
+        return errors[:MAX_REPORTED_ERRORS]
+
+
+def get_compiled_schema(prompt, json_schema=None):
+    """
+    Returns the compiled schema of an AI Prompt, compiled again once the prompt
+    was modified. Sub-schemas (e.g. per chunk) are compiled on the fly.
+    """
+    strict = prompt.ai_output_mode == JSON_SCHEMA_MODE
+    if json_schema is not None:
+        return CompiledSchema(json_schema, strict)
+
+    key = (frappe.local.site, prompt.name, prompt.ai_output_mode)
+    modified = str(prompt.modified)
+    with _schemas_lock:
+        cached = _schemas.get(key)
+        if cached and cached[0] == modified:
+            return cached[1]
+
+    schema = prompt.json_scema
+    compiled = CompiledSchema(json.loads(schema) if isinstance(schema, str) else schema, strict)
+    with _schemas_lock:
+        _schemas[key] = (modified, compiled)
+    return compiled
+
+
+def to_strict_schema(json_schema):
+    """
+    Strict structured outputs need every property listed as required and no
+    additional properties. Optional properties become nullable instead.
+    """
+    schema = copy.deepcopy(json_schema)
+
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+            return
+        if not isinstance(node, dict):
+            return
+        properties = node.get("properties")
+        if isinstance(properties, dict):
+            required = set(node.get("required", []))
+            for key, value in properties.items():
+                if key not in required and isinstance(value, dict):
+                    make_nullable(value)
+            node["required"] = list(properties)
+            node["additionalProperties"] = False
+        for value in node.values():
+            walk(value)
+
+    walk(schema)
+    return schema
+
+
+def make_nullable(schema):
+    if "$ref" in schema:
+        schema["anyOf"] = [{"$ref": schema.pop("$ref")}, {"type": "null"}]
+        return
+    types = schema.get("type")
+    if isinstance(types, str) and types != "null":
+        schema["type"] = [types, "null"]
+    elif isinstance(types, list) and "null" not in types:
+        schema["type"] = types + ["null"]
+    if "enum" in schema and None not in schema["enum"]:
+        schema["enum"] = schema["enum"] + [None]
+
+
+def compile_schema(schema, definitions, compiled_refs):
+    """
+    Compiles a schema node into check(value, path, errors). Supports the
+    keywords allowed for structured outputs: type, enum, const, properties,
+    required, additionalProperties, items, anyOf and local $ref.
+    """
+    if not isinstance(schema, dict):
+        return lambda value, path, errors: None
+
+    ref = schema.get("$ref")
+    if ref:
+        name = ref.rsplit("/", 1)[-1]
+        if name not in compiled_refs:
+            # Resolve lazily so recursive definitions compile
+            compiled_refs[name] = None
+            compiled_refs[name] = compile_schema(definitions.get(name, {}), definitions, compiled_refs)
+        return lambda value, path, errors: compiled_refs[name](value, path, errors)
+
+    checks = []
+
+    types = schema.get("type")
+    if types:
+        types = [types] if isinstance(types, str) else types
+        python_types = ()
+        for name in types:
+            python_type = JSON_TYPES.get(name, object)
+            python_types += python_type if isinstance(python_type, tuple) else (python_type,)
+
+        def check_type(value, path, errors):
+            # bool is a subclass of int, but not a JSON number
+            if isinstance(value, bool) and "boolean" not in types:
+                valid = False
+            elif isinstance(value, float) and "integer" in types and "number" not in types:
+                valid = value.is_integer()
+            else:
+                valid = isinstance(value, python_types)
+            if not valid:
+                errors.append(f"{path}: expected {'/'.join(types)}, got {json_type(value)}")
+            return valid
+
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+
+        def check_enum(value, path, errors):
+            if value not in allowed:
+                errors.append(f"{path}: {json.dumps(value)} is not one of {json.dumps(allowed)}")
+                return False
+            return True
+
+        checks.append(check_enum)
+
+    if "const" in schema:
+        constant = schema["const"]
+
+        def check_const(value, path, errors):
+            if value != constant:
+                errors.append(f"{path}: expected {json.dumps(constant)}")
+                return False
+            return True
+
+        checks.append(check_const)
+
+    properties = {
+        key: compile_schema(value, definitions, compiled_refs)
+        for key, value in (schema.get("properties") or {}).items()
+    }
+    required = schema.get("required", [])
+    additional = schema.get("additionalProperties", True)
+    if properties or required or additional is False:
+
+        def check_object(value, path, errors):
+            if not isinstance(value, dict):
+                return True
+            for key in required:
+                if key not in value:
+                    errors.append(f"{path}: missing required property '{key}'")
+            for key, item in value.items():
+                if key in properties:
+                    properties[key](item, f"{path}.{key}", errors)
+                elif additional is False:
+                    errors.append(f"{path}: unexpected property '{key}'")
+            return True
+
+        checks.append(check_object)
+
+    if "items" in schema:
+        check_item = compile_schema(schema["items"], definitions, compiled_refs)
+
+        def check_array(value, path, errors):
+            if isinstance(value, list):
+                for i, item in enumerate(value):
+                    check_item(item, f"{path}[{i}]", errors)
+            return True
+
+        checks.append(check_array)
+
+    if "anyOf" in schema:
+        options = [compile_schema(option, definitions, compiled_refs) for option in schema["anyOf"]]
+
+        def check_any_of(value, path, errors):
+            for option in options:
+                option_errors = []
+                option(value, path, option_errors)
+                if not option_errors:
+                    return True
+            errors.append(f"{path}: matches none of the allowed schemas")
+            return False
+
+        checks.append(check_any_of)
+
+    def check(value, path, errors):
+        for check_part in checks:
+            # Stop at the first failing keyword, nested errors would be noise
+            if not check_part(value, path, errors):
+                return
+
+    return check
+
+
+def json_type(value):
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    for name, python_type in JSON_TYPES.items():
+        if isinstance(value, python_type):
+            return name
+    return type(value).__name__
+
+
+def parse_json_response(resp):
+    """
+    Parses a complete model answer into a JSON object, repairing syntax only:
+    code fences, text around the object and trailing commas. Answers cut off
+    at the token limit are not completed, see TRUNCATED_ERROR in ai_query.
+    """
+    if not resp:
+        return None
+    text = CODE_FENCE.sub("", resp.strip())
+    candidates = [text, text[text.find("{") : text.rfind("}") + 1]]
+    candidates.append(TRAILING_COMMA.sub(r"\1", candidates[-1]))
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        return data if isinstance(data, dict) else None
+    return None
+
+
+def drop_null_optionals(data, json_schema):
+    """
+    Removes the nulls strict mode returns for optional properties, so consumers
+    keep seeing missing keys as before.
+    """
+    if isinstance(data, list):
+        items = json_schema.get("items", {}) if isinstance(json_schema, dict) else {}
+        return [drop_null_optionals(item, items) for item in data]
+    if not isinstance(data, dict) or not isinstance(json_schema, dict):
+        return data
+    properties = json_schema.get("properties") or {}
+    required = set(json_schema.get("required", []))
+    return {
+        key: drop_null_optionals(value, properties.get(key, {}))
+        for key, value in data.items()
+        if value is not None or key in required
+    }
+
+
+def get_repair_messages(request, resp, errors):
+    # Follow-up turn asking the model to correct its previous answer
+    return request["messages"] + [
+        {"role": "assistant", "content": resp or ""},
+        {
+            "role": "user",
+            "content": "Your answer does not pass these checks of the required JSON schema:\n"
+            + "\n".join(f"- {error}" for error in errors)
+            + "\nReturn the complete corrected JSON object only.",
+        },
+    ]
@@ -0,0 +1,249 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""
+OpenAI-compatible chat completions server on localhost for tests and local
+runs without a model, e.g. as endpoint of an AI with the OpenAI Compatible
+interface:
+
+    python -m ai_workflows.ai_workflows.stub_server --port 8000 --answer '{"InvoiceDetails": {}}'
+
+Only uses the standard library, so it also runs outside a bench.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ANSWER = "{}"
+# Like OpenAI, prompts are cached from 1024 tokens on in steps of 128
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP = 128
+
+
+class StubOpenAIServer:
+    """
+    Answers every chat completion with the given answer (a string or a
+    function of the request), after delay plus up to jitter seconds. A share
+    of error_rate requests fails with error_status instead. Keeps the
+    requests and the highest number of requests in flight at once. Prompts
+    repeating all but the last message of an earlier one report that part as
+    cached tokens. Answers longer than max_tokens (4 characters per token)
+    are cut off with finish_reason "length".
+
+        with StubOpenAIServer('{"InvoiceDetails": {}}') as server:
+            ... AI endpoint = server.url ...
+    """
+
+    def __init__(
+        self,
+        answer=DEFAULT_ANSWER,
+        delay=0,
+        host="127.0.0.1",
+        port=0,
+        jitter=0,
+        error_rate=0,
+        error_status=503,
+        seed=None,
+    ):
+        self.answer = answer
+        self.delay = delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.errors = 0
+        self.requests = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.prefixes = set()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), StubRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def get_cached_tokens(self, request):
+        prefix = json.dumps(request.get("messages", [])[:-1])
+        tokens = len(prefix) // 4
+        with self.lock:
+            cached = prefix in self.prefixes
+            self.prefixes.add(prefix)
+        if not cached or tokens < PROMPT_CACHE_MIN_TOKENS:
+            return 0
+        return tokens - tokens % PROMPT_CACHE_STEP
+
+    def complete(self, request):
+        # Returns the answer, or None when the request is to fail
+        with self.lock:
+            self.requests.append(request)
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            delay = self.delay + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        try:
+            if delay:
+                time.sleep(delay)
+            if failed:
+                return None
+            return self.answer(request) if callable(self.answer) else self.answer
+        finally:
+            with self.lock:
+                self.inflight -= 1
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json({"object": "list", "data": [{"id": "stub", "object": "model"}]})
+        else:
+            self.send_json({"error": {"message": "not found"}}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json({"error": {"message": "not found"}}, 404)
+            return
+
+        answer = self.server.stub.complete(request)
+        if answer is None:
+            self.send_json(
+                {"error": {"message": "injected error", "type": "server_error"}},
+                self.server.stub.error_status,
+            )
+            return
+        finish_reason = "stop"
+        if request.get("max_tokens") and len(answer) > request["max_tokens"] * 4:
+            answer = answer[: request["max_tokens"] * 4]
+            finish_reason = "length"
+        usage = {
+            "prompt_tokens": len(json.dumps(request.get("messages", []))) // 4,
+            "completion_tokens": len(answer) // 4,
+            "prompt_tokens_details": {"cached_tokens": self.server.stub.get_cached_tokens(request)},
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if request.get("stream"):
+            self.send_stream(request, answer, usage, finish_reason)
+        else:
+            self.send_json(get_completion(request, answer, usage, finish_reason))
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, request, answer, usage, finish_reason="stop"):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        function_call = bool(request.get("functions"))
+        # A few deltas are enough to exercise the client's stream handling
+        size = max(len(answer) // 4, 1)
+        for start in range(0, len(answer), size):
+            part = answer[start : start + size]
+            delta = {"function_call": {"arguments": part}} if function_call else {"content": part}
+            self.send_event(get_chunk(request, [{"index": 0, "delta": delta, "finish_reason": None}]))
+        self.send_event(get_chunk(request, [{"index": 0, "delta": {}, "finish_reason": finish_reason}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self.send_event(get_chunk(request, [], usage))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def send_event(self, body):
+        self.wfile.write(f"data: {json.dumps(body)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        # Keep test output clean
+        pass
+
+
+def get_completion(request, answer, usage, finish_reason="stop"):
+    # Function calling answers with arguments, everything else with content
+    message = {"role": "assistant", "content": answer}
+    if request.get("functions"):
+        name = request["functions"][0]["name"]
+        message = {"role": "assistant", "content": None, "function_call": {"name": name, "arguments": answer}}
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model") or "stub",
+        "choices": [{"index": 0, "finish_reason": finish_reason, "message": message}],
+        "usage": usage,
+    }
+
+
+def get_chunk(request, choices, usage=None):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": request.get("model") or "stub",
+        "choices": choices,
+        "usage": usage,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--answer", default=DEFAULT_ANSWER, help="answer to every request")
+    parser.add_argument("--delay", type=float, default=0, help="seconds per request")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many seconds more")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of failing requests")
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+
+    server = StubOpenAIServer(
+        args.answer,
+        args.delay,
+        args.host,
+        args.port,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    print(f"Serving chat completions at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
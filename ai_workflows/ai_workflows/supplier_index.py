@@ -0,0 +1,209 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import json
+import re
+import threading
+from collections import defaultdict
+
+import frappe
+
+# Redis counter holding the index version, incremented on every Supplier change
+INDEX_VERSION_KEY = "ai_workflows_supplier_index_version"
+# Supplier fields the index is built from
+INDEX_FIELDS = ("name", "supplier_name", "tax_id")
+# Minimum trigram similarity (Jaccard) for a fuzzy name match, unless
+# AI Workflow Purchase Invoice Settings has a Fuzzy Match Threshold
+DEFAULT_FUZZY_THRESHOLD = 0.85
+
+NON_ALNUM = re.compile(r"[\W_]+", re.UNICODE)
+
+# Per-worker indexes: site -> ((version, fuzzy threshold), SupplierIndex)
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def normalize_tax_id(tax_id):
+    # "DE 123.456.789" -> "DE123456789"
+    return NON_ALNUM.sub("", tax_id or "").upper()
+
+
+def normalize_name(name):
+    # "Acme  GmbH." -> "acme gmbh"
+    return " ".join(NON_ALNUM.sub(" ", (name or "").casefold()).split())
+
+
+def get_trigrams(normalized_name):
+    padded = f"  {normalized_name} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class SupplierIndex:
+    """
+    In-memory lookup of Suppliers by normalized tax ID, normalized name and
+    name trigrams for fuzzy matches.
+    """
+
+    def __init__(self, suppliers=(), fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD):
+        self.fuzzy_threshold = fuzzy_threshold
+        self.by_tax_id = {}
+        self.by_name = {}
+        self.by_trigram = defaultdict(set)
+        self.trigrams = {}
+        self.entries = {}
+        for supplier in suppliers:
+            self.add(supplier.name, supplier.supplier_name, supplier.tax_id)
+
+    def add(self, name, supplier_name, tax_id=None):
+        self.remove(name)
+        tax_key = normalize_tax_id(tax_id)
+        name_key = normalize_name(supplier_name)
+        self.entries[name] = (tax_key, name_key)
+        if tax_key:
+            self.by_tax_id.setdefault(tax_key, name)
+        if name_key:
+            self.by_name.setdefault(name_key, name)
+            self.trigrams[name] = get_trigrams(name_key)
+            for trigram in self.trigrams[name]:
+                self.by_trigram[trigram].add(name)
+
+    def remove(self, name):
+        tax_key, name_key = self.entries.pop(name, (None, None))
+        # Another Supplier with the same tax ID or name takes over the key
+        if tax_key and self.by_tax_id.get(tax_key) == name:
+            del self.by_tax_id[tax_key]
+            other = next((other for other, keys in self.entries.items() if keys[0] == tax_key), None)
+            if other:
+                self.by_tax_id[tax_key] = other
+        if name_key and self.by_name.get(name_key) == name:
+            del self.by_name[name_key]
+            other = next((other for other, keys in self.entries.items() if keys[1] == name_key), None)
+            if other:
+                self.by_name[name_key] = other
+        for trigram in self.trigrams.pop(name, ()):
+            self.by_trigram[trigram].discard(name)
+
+    def lookup(self, tax_id=None, supplier_name=None):
+        """
+        Returns the Supplier name for a tax ID or supplier name, trying the tax
+        ID, the normalized name and then a fuzzy name match.
+        """
+        tax_key = normalize_tax_id(tax_id)
+        if tax_key and tax_key in self.by_tax_id:
+            return self.by_tax_id[tax_key]
+
+        name_key = normalize_name(supplier_name)
+        if not name_key:
+            return None
+        if name_key in self.by_name:
+            return self.by_name[name_key]
+        return self.fuzzy_lookup(name_key)
+
+    def fuzzy_lookup(self, name_key):
+        trigrams = get_trigrams(name_key)
+        shared = defaultdict(int)
+        for trigram in trigrams:
+            for name in self.by_trigram.get(trigram, ()):
+                shared[name] += 1
+
+        best, best_score = None, 0
+        for name, count in shared.items():
+            score = count / (len(trigrams) + len(self.trigrams[name]) - count)
+            if score > best_score:
+                best, best_score = name, score
+        return best if best_score >= self.fuzzy_threshold else None
+
+
+def get_supplier_index():
+    """
+    Returns this worker's index for the current site, rebuilt from the Supplier
+    table when another process changed a Supplier or the fuzzy threshold
+    changed since it was built.
+    """
+    site = frappe.local.site
+    fuzzy_threshold = get_fuzzy_threshold()
+    version = (get_index_version(), fuzzy_threshold)
+    with _indexes_lock:
+        cached = _indexes.get(site)
+        if cached and cached[0] == version:
+            return cached[1]
+
+    index = SupplierIndex(
+        frappe.get_all("Supplier", fields=list(INDEX_FIELDS)), fuzzy_threshold
+    )
+    with _indexes_lock:
+        _indexes[site] = (version, index)
+    return index
+
+
+def get_index_version():
+    cache = frappe.cache()
+    return int(cache.get(cache.make_key(INDEX_VERSION_KEY)) or 0)
+
+
+def get_fuzzy_threshold():
+    settings = frappe.get_cached_doc("AI Workflow Purchase Invoice Settings")
+    return settings.fuzzy_match_threshold or DEFAULT_FUZZY_THRESHOLD
+
+
+def update_supplier_index(doc, method=None):
+    """
+    Supplier after_insert / on_update / on_trash hook: once the transaction is
+    committed, bumps the version so other workers rebuild their index, and
+    updates this worker's index in place if it was current until now. Rolled
+    back changes reach no index.
+    """
+    if method == "on_update" and not any(doc.has_value_changed(field) for field in INDEX_FIELDS):
+        # Saves that do not change a looked up field leave all indexes valid
+        return
+    site = frappe.local.site
+    name, supplier_name, tax_id = doc.name, doc.supplier_name, doc.tax_id
+
+    def update_index():
+        cache = frappe.cache()
+        version = cache.incr(cache.make_key(INDEX_VERSION_KEY))
+        with _indexes_lock:
+            cached = _indexes.get(site)
+            if not cached:
+                return
+            if cached[0][0] != version - 1:
+                # Missing another process's change, rebuild on the next lookup
+                del _indexes[site]
+                return
+            index = cached[1]
+            if method == "on_trash":
+                index.remove(name)
+            else:
+                index.add(name, supplier_name, tax_id)
+            _indexes[site] = ((version, cached[0][1]), index)
+
+    frappe.db.after_commit.add(update_index)
+
+
+@frappe.whitelist()
+def resolve_suppliers(ai_queries):
+    """
+    Resolves the suppliers of many AI Queries in one pass and links the matches.
+    Returns {ai_query: supplier or None}.
+    """
+    if isinstance(ai_queries, str):
+        ai_queries = json.loads(ai_queries)
+
+    index = get_supplier_index()
+    result = {}
+    for query in frappe.get_all(
+        "AI Query",
+        filters={"name": ["in", ai_queries]},
+        fields=["name", "supplier", "ai_response_json"],
+    ):
+        try:
+            invoice_details = json.loads(query.ai_response_json or "").get("InvoiceDetails") or {}
+        except (ValueError, AttributeError):
+            invoice_details = {}
+        supplier = index.lookup(
+            invoice_details.get("SupplierUstId"), invoice_details.get("SupplierName")
+        )
+        result[query.name] = supplier
+        if supplier and supplier != query.supplier:
+            frappe.db.set_value("AI Query", query.name, "supplier", supplier)
+    return result
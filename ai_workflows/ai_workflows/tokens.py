@@ -0,0 +1,111 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import json
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Fallback estimate when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+DEFAULT_ENCODING = "o200k_base"
+# Fixed per-message overhead of the chat format
+TOKENS_PER_MESSAGE = 4
+
+TRUNCATION_MARKER = "\n[...]\n"
+
+
+@lru_cache(maxsize=16)
+def get_encoding(model):
+    if not tiktoken:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text, model=None):
+    """
+    Counts tokens locally with tiktoken if available, otherwise estimates them.
+    """
+    if not text:
+        return 0
+    encoding = get_encoding(model or "")
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def count_request_tokens(request):
+    # Prompt tokens of a chat completion request, including function/schema definitions
+    model = request.get("model")
+    tokens = 0
+    for message in request.get("messages", []):
+        tokens += TOKENS_PER_MESSAGE + count_tokens(message.get("content") or "", model)
+    for key in ("functions", "response_format"):
+        if request.get(key):
+            tokens += count_tokens(json.dumps(request[key]), model)
+    return tokens
+
+
+def truncate_to_tokens(text, max_tokens, strategy="Keep Head", model=None):
+    """
+    Shortens text to roughly max_tokens. "Keep Head and Tail" keeps the start
+    and end of the document (header and totals), "Keep Head" only the start.
+    """
+    if max_tokens <= 0:
+        return ""
+    tokens = count_tokens(text, model)
+    if tokens <= max_tokens:
+        return text
+
+    # Scale by characters and tighten until it fits
+    keep_chars = int(len(text) * max_tokens / tokens)
+    while keep_chars > 0:
+        if strategy == "Keep Head and Tail":
+            half = keep_chars // 2
+            truncated = text[:half] + TRUNCATION_MARKER + text[len(text) - half:]
+        else:
+            truncated = text[:keep_chars] + TRUNCATION_MARKER
+        if count_tokens(truncated, model) <= max_tokens:
+            return truncated
+        keep_chars = int(keep_chars * 0.9)
+    return ""
+
+
+def get_usage(chat_response):
+    # Token usage of a chat completion, or of the final chunk of a stream
+    usage = getattr(chat_response, "usage", None)
+    if not usage:
+        return {}
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "completion_tokens": usage.completion_tokens or 0,
+        "cached_tokens": (getattr(details, "cached_tokens", 0) or 0) if details else 0,
+    }
+
+
+def add_usage(total, usage):
+    for key, value in (usage or {}).items():
+        total[key] = total.get(key, 0) + value
+    return total
+
+
+def get_cost(usage, prices):
+    """
+    Cost of a request from prices per 1M tokens (input, cached input, output).
+    Cached prompt tokens fall back to the input price.
+    """
+    cached_tokens = usage.get("cached_tokens", 0)
+    uncached_tokens = usage.get("prompt_tokens", 0) - cached_tokens
+    cached_price = prices.get("cached_input_token_price") or prices.get("input_token_price") or 0
+    return (
+        uncached_tokens * (prices.get("input_token_price") or 0)
+        + cached_tokens * cached_price
+        + usage.get("completion_tokens", 0) * (prices.get("output_token_price") or 0)
+    ) / 1000000
@@ -0,0 +1,273 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""
+Per-stage tracing of AI Query processing. Stages record wall time, database
+queries and their time, and the LLM requests and their latency. The
+outermost stage stores all of them as AI Query Stage rows of the AI Query
+set with set_trace_ai_query().
+
+    @traced("create_or_update_address")
+    def create_or_update_address(...):
+
+    with trace("llm"):
+        ...
+"""
+
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+from werkzeug.wrappers import Response
+
+# Percentiles of the report and the metrics export
+PERCENTILES = (50, 95, 99)
+# Metrics are computed over the stages of the last METRICS_WINDOW_HOURS
+METRICS_WINDOW_HOURS = 24
+METRICS_MAX_ROWS = 100000
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class QueryCounter:
+    """
+    Counts frappe.db.sql calls and their time while installed. Every ORM and
+    query builder query goes through frappe.db.sql.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.db = None
+        self.sql = None
+
+    def install(self):
+        self.db = frappe.db
+        self.sql = sql = self.db.sql
+
+        def counting_sql(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return sql(*args, **kwargs)
+            finally:
+                self.count += 1
+                self.seconds += time.perf_counter() - started
+
+        self.db.sql = counting_sql
+
+    def uninstall(self):
+        self.db.sql = self.sql
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+
+class Tracer:
+    # Stages of one traced call; LLM requests may be added from worker threads
+    def __init__(self):
+        self.queries = QueryCounter()
+        self.llm_requests = 0
+        self.llm_seconds = 0.0
+        self.lock = threading.Lock()
+        self.stages = []
+        self.level = 0
+        self.ai_query = None
+
+    def add_llm_request(self, seconds):
+        with self.lock:
+            self.llm_requests += 1
+            self.llm_seconds += seconds
+
+    def get_counters(self):
+        with self.lock:
+            return (
+                time.perf_counter(),
+                self.queries.count,
+                self.queries.seconds,
+                self.llm_requests,
+                self.llm_seconds,
+            )
+
+    @contextmanager
+    def stage(self, name):
+        started_at = now_datetime()
+        start = self.get_counters()
+        level = self.level
+        self.level += 1
+        try:
+            yield self
+        finally:
+            self.level -= 1
+            end = self.get_counters()
+            self.stages.append(
+                {
+                    "stage": name,
+                    "level": level,
+                    "started_at": started_at,
+                    "wall_time": (end[0] - start[0]) * 1000,
+                    "db_queries": end[1] - start[1],
+                    "db_time": (end[2] - start[2]) * 1000,
+                    "llm_requests": end[3] - start[3],
+                    "llm_time": (end[4] - start[4]) * 1000,
+                }
+            )
+
+    def save(self):
+        # Appends the stages to the AI Query without saving (and validating) it again
+        if not self.ai_query or not frappe.db.exists("AI Query", self.ai_query):
+            return
+        idx = frappe.db.count("AI Query Stage", {"parent": self.ai_query, "parenttype": "AI Query"})
+        # Stages finish inside out, store them in the order they started
+        for stage in sorted(self.stages, key=lambda stage: stage["started_at"]):
+            idx += 1
+            frappe.get_doc(
+                {
+                    "doctype": "AI Query Stage",
+                    "parent": self.ai_query,
+                    "parenttype": "AI Query",
+                    "parentfield": "stages",
+                    "idx": idx,
+                    **stage,
+                }
+            ).db_insert()
+
+
+def get_tracer():
+    return getattr(frappe.local, "ai_workflows_tracer", None)
+
+
+def set_trace_ai_query(ai_query):
+    # The AI Query the running trace is stored on
+    tracer = get_tracer()
+    if tracer:
+        tracer.ai_query = ai_query
+
+
+@contextmanager
+def trace(name):
+    """
+    Traces a stage. The outermost stage starts the tracer and, unless it
+    fails, stores the stages on the AI Query set with set_trace_ai_query().
+    """
+    tracer = get_tracer()
+    if tracer:
+        with tracer.stage(name):
+            yield tracer
+        return
+
+    tracer = frappe.local.ai_workflows_tracer = Tracer()
+    tracer.queries.install()
+    try:
+        with tracer.stage(name):
+            yield tracer
+    finally:
+        tracer.queries.uninstall()
+        frappe.local.ai_workflows_tracer = None
+    tracer.save()
+
+
+def traced(name):
+    # Decorator form of trace()
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def get_stage_statistics(from_datetime, to_datetime=None, ai_prompt=None):
+    """
+    Count, sums and percentiles of wall time, DB queries, DB time and LLM
+    latency per stage, over the stages started in the given period.
+    """
+    conditions = "stage.started_at >= %(from_datetime)s"
+    if to_datetime:
+        conditions += " and stage.started_at <= %(to_datetime)s"
+    if ai_prompt:
+        conditions += " and query.ai_prompt_template = %(ai_prompt)s"
+    rows = frappe.db.sql(
+        f"""
+        select stage.stage, stage.wall_time, stage.db_queries, stage.db_time, stage.llm_time
+        from `tabAI Query Stage` stage
+        join `tabAI Query` query on query.name = stage.parent
+        where stage.parenttype = 'AI Query' and {conditions}
+        order by stage.started_at desc
+        limit {METRICS_MAX_ROWS}
+        """,
+        {"from_datetime": from_datetime, "to_datetime": to_datetime, "ai_prompt": ai_prompt},
+        as_dict=True,
+    )
+
+    by_stage = {}
+    for row in rows:
+        by_stage.setdefault(row.stage, []).append(row)
+
+    statistics = []
+    for stage, stage_rows in sorted(by_stage.items()):
+        result = frappe._dict(stage=stage, count=len(stage_rows))
+        for field in ("wall_time", "db_queries", "db_time", "llm_time"):
+            values = sorted(row[field] or 0 for row in stage_rows)
+            result[f"{field}_sum"] = sum(values)
+            result[f"{field}_avg"] = sum(values) / len(values)
+            for p in PERCENTILES:
+                result[f"{field}_p{p}"] = percentile(values, p)
+        statistics.append(result)
+    return statistics
+
+
+@frappe.whitelist()
+def metrics(hours=METRICS_WINDOW_HOURS):
+    """
+    Stage percentiles in OpenMetrics text format for Prometheus, e.g. scraped
+    from /api/method/ai_workflows.ai_workflows.tracing.metrics with an API key.
+    """
+    frappe.only_for("System Manager")
+    statistics = get_stage_statistics(add_to_date(now_datetime(), hours=-float(hours)))
+    return Response(to_openmetrics(statistics), content_type=OPENMETRICS_CONTENT_TYPE)
+
+
+def to_openmetrics(statistics):
+    # Summaries in seconds, DB queries per stage call
+    families = (
+        ("ai_workflows_stage_duration_seconds", "wall_time", 0.001, "Wall time of AI Query stages"),
+        ("ai_workflows_stage_db_seconds", "db_time", 0.001, "Database time of AI Query stages"),
+        ("ai_workflows_stage_llm_seconds", "llm_time", 0.001, "LLM latency of AI Query stages"),
+        ("ai_workflows_stage_db_queries", "db_queries", 1, "Database queries of AI Query stages"),
+    )
+    lines = []
+    for name, field, scale, help_text in families:
+        lines.append(f"# TYPE {name} summary")
+        lines.append(f"# HELP {name} {help_text}.")
+        if field != "db_queries":
+            lines.append(f"# UNIT {name} seconds")
+        for row in statistics:
+            label = escape_label(row.stage)
+            for p in PERCENTILES:
+                value = row[f"{field}_p{p}"] * scale
+                lines.append(f'{name}{{stage="{label}",quantile="{p / 100}"}} {value:g}')
+            lines.append(f'{name}_sum{{stage="{label}"}} {row[f"{field}_sum"] * scale:g}')
+            lines.append(f'{name}_count{{stage="{label}"}} {row.count}')
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
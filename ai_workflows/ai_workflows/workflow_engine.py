@@ -0,0 +1,485 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import json
+import threading
+from collections import defaultdict, deque
+
+import frappe
+from frappe.desk.doctype.notification_log.notification_log import enqueue_create_notification
+from frappe.utils import add_to_date, now_datetime, time_diff_in_seconds
+
+from ai_workflows.ai_workflows.safe_expression import SafeExpression
+
+STEP_JOB_TIMEOUT = 1800
+
+# Per-worker compiled templates: (site, template) -> (modified, WorkflowGraph)
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+class WorkflowGraph:
+    """
+    A Workflow Template compiled into a DAG of its steps.
+
+    Edges come from the Next Step of actions, the Outcome Routes of decisions
+    and, for actions without a Next Step, from the sequence: such an action
+    leads to all steps of the next higher sequence, which then run in
+    parallel. A step with several incoming edges waits for all of them.
+    """
+
+    def __init__(self, template):
+        self.name = template.name
+        self.steps = {}
+        for step in sorted(template.workflow_steps, key=lambda step: step.sequence or 0):
+            if step.step_name in self.steps:
+                frappe.throw(f"Step name '{step.step_name}' is used more than once.")
+            self.steps[step.step_name] = step
+
+        self.conditions = {}
+        self.routes = defaultdict(list)
+        for route in template.get("outcome_routes") or []:
+            self.check_step(route.decision_step)
+            self.check_step(route.next_step)
+            self.routes[route.decision_step].append((str(route.outcome_value).strip(), route.next_step))
+
+        sequences = sorted({step.sequence or 0 for step in self.steps.values()})
+        self.successors = {}
+        for name, step in self.steps.items():
+            if step.step_type == "Decision":
+                if not step.decision_condition:
+                    frappe.throw(f"Decision step '{name}' has no Decision Condition.")
+                self.conditions[name] = SafeExpression(step.decision_condition)
+                successors = [next_step for _, next_step in self.routes[name]]
+            elif step.next_step:
+                self.check_step(step.next_step)
+                successors = [step.next_step]
+            else:
+                later = [sequence for sequence in sequences if sequence > (step.sequence or 0)]
+                successors = [
+                    other.step_name
+                    for other in self.steps.values()
+                    if later and (other.sequence or 0) == later[0]
+                ]
+            if step.step_type == "Action" and step.action_type == "Server Method" and not step.method_name:
+                frappe.throw(f"Server Method step '{name}' has no Method Name.")
+            self.successors[name] = list(dict.fromkeys(successors))
+
+        self.predecessors = defaultdict(int)
+        for successors in self.successors.values():
+            for successor in successors:
+                self.predecessors[successor] += 1
+        self.start_steps = [name for name in self.steps if not self.predecessors[name]]
+        self.check_acyclic()
+
+    def check_step(self, name):
+        if name not in self.steps:
+            frappe.throw(f"Workflow Template '{self.name}' has no step '{name}'.")
+
+    def check_acyclic(self):
+        # Kahn's algorithm, every step must be reachable in topological order
+        in_degree = dict(self.predecessors)
+        ready = deque(self.start_steps)
+        visited = 0
+        while ready:
+            name = ready.popleft()
+            visited += 1
+            for successor in self.successors[name]:
+                in_degree[successor] -= 1
+                if not in_degree[successor]:
+                    ready.append(successor)
+        if visited != len(self.steps):
+            frappe.throw(f"The steps of Workflow Template '{self.name}' contain a loop.")
+
+    def get_route(self, name, outcome):
+        # Successors of a decision taken for the evaluated outcome
+        outcome = str(outcome).strip().lower()
+        return [
+            next_step
+            for outcome_value, next_step in self.routes[name]
+            if outcome_value.lower() == outcome
+        ]
+
+
+def get_workflow_graph(template):
+    """
+    Returns this worker's compiled graph of a Workflow Template, compiled again
+    once the template was modified.
+    """
+    key = (frappe.local.site, template)
+    modified = str(frappe.get_cached_value("Workflow Template", template, "modified"))
+    with _graphs_lock:
+        cached = _graphs.get(key)
+        if cached and cached[0] == modified:
+            return cached[1]
+
+    graph = WorkflowGraph(frappe.get_cached_doc("Workflow Template", template))
+    with _graphs_lock:
+        _graphs[key] = (modified, graph)
+    return graph
+
+
+class WorkflowRunState:
+    """
+    Checkpoints of a Workflow Run. Every step records its inputs, outputs,
+    timings and join counters on its Workflow Run Step row. Rows are updated
+    one by one, so parallel branches never save the whole run.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.template = frappe.db.get_value("Workflow Run", run, "workflow_template")
+
+    def get_steps(self, fields=("*",)):
+        return {
+            row.step_name: row
+            for row in frappe.get_all(
+                "Workflow Run Step",
+                filters={"parent": self.run, "parenttype": "Workflow Run"},
+                fields=list(fields),
+                order_by="idx asc",
+            )
+        }
+
+    def get_step(self, step):
+        return frappe.db.get_value(
+            "Workflow Run Step",
+            {"parent": self.run, "parenttype": "Workflow Run", "step_name": step},
+            ["name", "status", "attempts", "started_on"],
+            as_dict=True,
+        )
+
+    def get_context(self):
+        # Run context plus the outputs of all completed steps, in completion order
+        context = frappe._dict(
+            json.loads(frappe.db.get_value("Workflow Run", self.run, "context") or "{}")
+        )
+        for row in frappe.get_all(
+            "Workflow Run Step",
+            filters={"parent": self.run, "parenttype": "Workflow Run", "status": "Completed"},
+            fields=["outputs"],
+            order_by="ended_on asc, idx asc",
+        ):
+            context.update(json.loads(row.outputs or "{}"))
+        return context
+
+    def start_step(self, step, context):
+        """
+        Marks a step as running and commits the checkpoint. Returns False when
+        the step already finished, e.g. in a duplicate or resumed job.
+        """
+        row = self.get_step(step)
+        if row.status in ("Completed", "Skipped", "Waiting"):
+            return False
+        frappe.db.set_value(
+            "Workflow Run Step",
+            row.name,
+            {
+                "status": "Running",
+                "attempts": (row.attempts or 0) + 1,
+                "inputs": json.dumps(context, default=str, indent=2),
+                "started_on": now_datetime(),
+                "ended_on": None,
+                "error": None,
+            },
+        )
+        frappe.db.commit()
+        return True
+
+    def end_step(self, step, status, outputs=None, outcome=None, error=None):
+        row = self.get_step(step)
+        ended_on = now_datetime()
+        values = {"status": status, "ended_on": ended_on, "error": error}
+        if row.started_on:
+            values["duration"] = time_diff_in_seconds(ended_on, row.started_on)
+        if outputs is not None:
+            values["outputs"] = json.dumps(outputs, default=str, indent=2)
+        if outcome is not None:
+            values["outcome"] = str(outcome)
+        frappe.db.set_value("Workflow Run Step", row.name, values)
+
+    def arrive(self, step, active):
+        # Records one incoming edge, the row lock serializes parallel branches
+        frappe.db.sql(
+            """update `tabWorkflow Run Step`
+            set arrived = arrived + 1, active = active + %s
+            where parent = %s and parenttype = 'Workflow Run' and step_name = %s""",
+            (1 if active else 0, self.run, step),
+        )
+        return frappe.db.get_value(
+            "Workflow Run Step",
+            {"parent": self.run, "parenttype": "Workflow Run", "step_name": step},
+            ["arrived", "active"],
+        )
+
+    def finish(self, step):
+        # Counts a finished or skipped step, returns the number done so far
+        frappe.db.sql(
+            "update `tabWorkflow Run` set finished_steps = finished_steps + 1 where name = %s",
+            self.run,
+        )
+        return frappe.db.get_value("Workflow Run", self.run, "finished_steps")
+
+    def set_status(self, status, **values):
+        if status in ("Completed", "Failed"):
+            values["ended_on"] = now_datetime()
+        frappe.db.set_value("Workflow Run", self.run, {"status": status, **values})
+
+
+@frappe.whitelist()
+def start_workflow(template, doctype, docname, context=None):
+    """
+    Starts a run of a Workflow Template for a document. The start steps run in
+    background jobs, the Workflow Run is returned.
+    """
+    if isinstance(context, str):
+        context = json.loads(context)
+    graph = get_workflow_graph(template)
+    ai, ai_prompt = frappe.get_cached_value("Workflow Template", template, ["ai", "ai_prompt"])
+
+    run = frappe.get_doc(
+        {
+            "doctype": "Workflow Run",
+            "workflow_template": template,
+            "reference_doctype": doctype,
+            "reference_name": docname,
+            "status": "Running",
+            "started_on": now_datetime(),
+            "steps": [{"step_name": step, "status": "Pending"} for step in graph.steps],
+        }
+    )
+    run.insert(ignore_permissions=True)
+    run.db_set(
+        "context",
+        json.dumps(
+            {
+                "workflow_run": run.name,
+                "doctype": doctype,
+                "docname": docname,
+                "ai": ai or frappe.db.get_single_value("AI Settings", "default_ai"),
+                "ai_prompt": ai_prompt,
+                **(context or {}),
+            },
+            default=str,
+            indent=2,
+        ),
+    )
+    for step in graph.start_steps:
+        enqueue_step(run.name, step)
+    return run.name
+
+
+def start_document_workflows(doc, method=None):
+    # doc_events hook: start every active Workflow Template for this DocType
+    for template in frappe.get_all(
+        "Workflow Template",
+        filters={"active": 1, "applicable_doctypes": doc.doctype},
+        pluck="name",
+    ):
+        start_workflow(template, doc.doctype, doc.name)
+
+
+def enqueue_step(run, step):
+    frappe.enqueue(
+        "ai_workflows.ai_workflows.workflow_engine.run_steps",
+        queue="long",
+        timeout=STEP_JOB_TIMEOUT,
+        run=run,
+        steps=[step],
+        enqueue_after_commit=True,
+    )
+
+
+def run_steps(run, steps):
+    """
+    Background job running a branch of a workflow run. Steps that become ready
+    one at a time continue in this job, further parallel branches are handed to
+    their own jobs.
+    """
+    state = WorkflowRunState(run)
+    graph = get_workflow_graph(state.template)
+    ready = deque(steps)
+    while ready:
+        name = ready.popleft()
+        context = state.get_context()
+        if not state.start_step(name, context):
+            continue
+        try:
+            successors = execute_step(state, graph, name, context)
+            if successors is not None:
+                ready.extend(complete_step(state, graph, name, successors))
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            state.end_step(name, "Failed", error=frappe.get_traceback())
+            state.set_status("Failed", failed_step=name)
+            frappe.db.commit()
+            frappe.log_error(title=f"Workflow step '{name}' of {run} failed")
+            return
+
+        while len(ready) > 1:
+            enqueue_step(run, ready.pop())
+        frappe.db.commit()
+
+
+def execute_step(state, graph, name, context):
+    """
+    Runs a single step and checkpoints its result. Returns the successors to
+    activate, or None when the run has to wait for a user before continuing.
+    """
+    step = graph.steps[name]
+
+    if step.step_type == "Decision":
+        outcome = graph.conditions[name].evaluate(context)
+        state.end_step(name, "Completed", outputs={}, outcome=outcome)
+        return graph.get_route(name, outcome)
+
+    outputs = {}
+    if step.action_type == "Server Method":
+        result = frappe.get_attr(step.method_name)(context)
+        if isinstance(result, dict):
+            outputs = result
+        if not step.auto_proceed:
+            state.end_step(name, "Waiting", outputs=outputs)
+            pause_step(state, step, context)
+            return None
+
+    elif step.action_type == "Notification":
+        notify_step_users(step, context, f"Workflow step '{name}' was reached")
+
+    else:
+        # Approvals and client scripts always wait for a user
+        state.end_step(name, "Waiting", outputs=outputs)
+        pause_step(state, step, context)
+        return None
+
+    state.end_step(name, "Completed", outputs=outputs)
+    return graph.successors[name]
+
+
+def complete_step(state, graph, name, active_successors):
+    """
+    Passes a finished step on to its successors and returns those that became
+    ready. Successors that were not taken are skipped, and a step all of whose
+    incoming edges were skipped is skipped itself.
+    """
+    ready = []
+    done = deque([(name, active_successors)])
+    while done:
+        name, active_successors = done.popleft()
+        if state.finish(name) == len(graph.steps):
+            state.set_status("Completed")
+            frappe.publish_realtime(
+                "workflow_run_completed",
+                {"workflow_run": state.run, "template": graph.name},
+            )
+        for successor in graph.successors[name]:
+            arrived, active = state.arrive(successor, successor in active_successors)
+            if arrived < graph.predecessors[successor]:
+                continue
+            if active:
+                ready.append(successor)
+            else:
+                state.end_step(successor, "Skipped")
+                done.append((successor, []))
+    return ready
+
+
+def pause_step(state, step, context):
+    state.set_status("Waiting")
+    notify_step_users(step, context, f"Workflow step '{step.step_name}' is waiting for you")
+    frappe.publish_realtime(
+        "workflow_step_pending",
+        {
+            "workflow_run": state.run,
+            "step": step.step_name,
+            "method_name": step.method_name,
+            "doctype": context.doctype,
+            "docname": context.docname,
+        },
+    )
+
+
+def notify_step_users(step, context, subject):
+    if not step.assigned_role:
+        return
+    users = frappe.get_all(
+        "Has Role",
+        filters={"role": step.assigned_role, "parenttype": "User"},
+        pluck="parent",
+    )
+    if not users:
+        return
+    enqueue_create_notification(
+        users,
+        {
+            "subject": subject,
+            "type": "Alert",
+            "document_type": context.doctype,
+            "document_name": context.docname,
+        },
+    )
+
+
+@frappe.whitelist()
+def proceed_workflow(run, step):
+    """
+    Continues a run paused at a step (approval, client script or a server
+    method without Auto Proceed) in a background job.
+    """
+    state = WorkflowRunState(run)
+    graph = get_workflow_graph(state.template)
+    if step not in graph.steps:
+        frappe.throw(f"{run} has no step '{step}'.")
+    assigned_role = graph.steps[step].assigned_role
+    if assigned_role and assigned_role not in frappe.get_roles():
+        frappe.throw(f"Only users with role '{assigned_role}' can proceed with this step.")
+    if state.get_step(step).status != "Waiting":
+        frappe.throw(f"Workflow step '{step}' is not waiting to proceed.")
+
+    state.end_step(step, "Completed")
+    state.set_status("Running")
+    for successor in complete_step(state, graph, step, graph.successors[step]):
+        enqueue_step(run, successor)
+
+
+@frappe.whitelist()
+def resume_workflow_run(run):
+    """
+    Continues a failed or interrupted run from its first incomplete steps.
+    Completed steps keep their outputs and are not executed again.
+    """
+    state = WorkflowRunState(run)
+    graph = get_workflow_graph(state.template)
+    steps = state.get_steps(["step_name", "status", "arrived", "active"])
+
+    resumed = []
+    for name, row in steps.items():
+        if row.status in ("Completed", "Skipped", "Waiting"):
+            continue
+        started = row.status in ("Running", "Failed")
+        ready = not graph.predecessors[name] or (
+            row.arrived >= graph.predecessors[name] and row.active
+        )
+        if started or ready:
+            resumed.append(name)
+
+    if not resumed:
+        return []
+    state.set_status("Running", failed_step=None)
+    for name in resumed:
+        enqueue_step(run, name)
+    return resumed
+
+
+def resume_stalled_workflow_runs():
+    # Scheduler hook: resume runs whose worker died while a step was running
+    cutoff = add_to_date(now_datetime(), seconds=-STEP_JOB_TIMEOUT)
+    for run in frappe.get_all(
+        "Workflow Run Step",
+        filters={"parenttype": "Workflow Run", "status": "Running", "started_on": ["<", cutoff]},
+        pluck="parent",
+        distinct=True,
+    ):
+        resume_workflow_run(run)
+        frappe.db.commit()
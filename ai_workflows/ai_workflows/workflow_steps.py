@@ -0,0 +1,61 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""
+Server Methods for Workflow Steps. Each one gets the run context (doctype,
+docname, ai, ai_prompt and whatever earlier steps returned) and returns the
+values it adds to the context.
+
+Steps can run again when a Workflow Run is resumed, so each one first looks
+for the result of an earlier attempt instead of repeating LLM calls or
+creating duplicates.
+"""
+
+import frappe
+
+from ai_workflows.ai_workflows.doctype.ai_query import ai_query
+
+
+def extract_document(context):
+    # Paperless Document -> AI Query
+    if not context.ai or not context.ai_prompt:
+        frappe.throw("The Workflow Template needs an AI and an AI Prompt to extract documents.")
+    existing_query = frappe.db.get_value(
+        "AI Query",
+        {
+            "paperless_doc": context.docname,
+            "ai_prompt_template": context.ai_prompt,
+            "creation": [">=", frappe.db.get_value("Workflow Run", context.workflow_run, "creation")],
+        },
+        order_by="creation desc",
+    )
+    if existing_query:
+        return {"ai_query": existing_query}
+
+    doc = ai_query.get_paperless_document_data(context.docname)
+    new_query = ai_query.run_ai_query(doc, context.ai_prompt, context.ai)
+    return {"ai_query": new_query.name}
+
+
+def create_supplier(context):
+    # AI Query -> Supplier with address and contact
+    supplier = frappe.db.get_value("AI Query", context.ai_query, "supplier")
+    if supplier:
+        return {"supplier": supplier}
+
+    ai_query.create_supplier(get_ai_query_json(context.ai_query))
+    return {"supplier": frappe.db.get_value("AI Query", context.ai_query, "supplier")}
+
+
+def create_purchase_invoice(context):
+    # AI Query with Supplier -> draft Purchase Invoice
+    purchase_invoice = frappe.db.get_value("AI Query", context.ai_query, "document")
+    if purchase_invoice:
+        return {"purchase_invoice": purchase_invoice}
+
+    ai_query.create_purchase_invoice(get_ai_query_json(context.ai_query))
+    return {"purchase_invoice": frappe.db.get_value("AI Query", context.ai_query, "document")}
+
+
+def get_ai_query_json(name):
+    return frappe.as_json(frappe.get_doc("AI Query", name).as_dict())
@@ -7,10 +7,43 @@ app_license = "gpl-3.0"
 
 
 doc_events = {
+    "AI": {
+        "on_update": "ai_workflows.ai_workflows.ai_client.clear_client_cache",
+        "on_trash": "ai_workflows.ai_workflows.ai_client.clear_client_cache",
+    },
+    "AI Settings": {
+        "on_update": "ai_workflows.ai_workflows.ai_client.clear_client_cache",
+    },
+    "Supplier": {
+        "after_insert": "ai_workflows.ai_workflows.supplier_index.update_supplier_index",
+        "on_update": "ai_workflows.ai_workflows.supplier_index.update_supplier_index",
+        "on_trash": "ai_workflows.ai_workflows.supplier_index.update_supplier_index",
+    },
+    "Paperless Document": {
+        "after_insert": "ai_workflows.ai_workflows.workflow_engine.start_document_workflows",
+    },
     "Purchase Invoice": {
-        "on_submit": "ai_workflows.ai_workflows.doctype.ai_query.ai_query.update_paperless_document_status",
-        "on_cancel": "ai_workflows.ai_workflows.doctype.ai_query.ai_query.update_paperless_document_status",
+        "on_submit": [
+            "ai_workflows.ai_workflows.doctype.ai_query.ai_query.update_paperless_document_status",
+            "ai_workflows.ai_workflows.extraction_templates.learn_from_purchase_invoice",
+            "ai_workflows.ai_workflows.few_shot.update_few_shot_examples",
+        ],
+        "on_cancel": [
+            "ai_workflows.ai_workflows.doctype.ai_query.ai_query.update_paperless_document_status",
+            "ai_workflows.ai_workflows.few_shot.update_few_shot_examples",
+        ],
+    },
+}
+
+scheduler_events = {
+    "cron": {
+        "*/10 * * * *": [
+            "ai_workflows.ai_workflows.doctype.ai_batch_job.ai_batch_job.poll_batch_jobs",
+        ],
     },
+    "hourly": [
+        "ai_workflows.ai_workflows.workflow_engine.resume_stalled_workflow_runs",
+    ],
 }
 
 # required_apps = []
@@ -20,7 +53,7 @@ doc_events = {
 
 # include js, css files in header of desk.html
 # app_include_css = "/assets/ai_workflows/css/ai_workflows.css"
-# app_include_js = "/assets/ai_workflows/js/ai_workflows.js"
+app_include_js = "/assets/ai_workflows/js/ai_workflows.js"
 
 # include js, css files in header of web template
 # web_include_css = "/assets/ai_workflows/css/ai_workflows.css"
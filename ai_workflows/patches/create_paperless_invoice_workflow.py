@@ -0,0 +1,60 @@
+import frappe
+
+
+def execute():
+	# Ships the Paperless ingest -> draft Purchase Invoice flow as an inactive
+	# template, it is activated once an AI Prompt is selected
+	if frappe.db.exists("Workflow Template", "Paperless Invoice") or not frappe.db.exists(
+		"DocType", "Paperless Document"
+	):
+		return
+
+	method = "ai_workflows.ai_workflows.workflow_steps."
+	frappe.get_doc(
+		{
+			"doctype": "Workflow Template",
+			"workflow_name": "Paperless Invoice",
+			"applicable_doctypes": "Paperless Document",
+			"description": "Extracts ingested Paperless Documents and creates the Supplier and a draft Purchase Invoice.",
+			"active": 0,
+			"workflow_steps": [
+				{
+					"step_name": "Extract Document",
+					"sequence": 1,
+					"step_type": "Action",
+					"action_type": "Server Method",
+					"method_name": method + "extract_document",
+					"auto_proceed": 1,
+				},
+				{
+					"step_name": "Create Supplier",
+					"sequence": 2,
+					"step_type": "Action",
+					"action_type": "Server Method",
+					"method_name": method + "create_supplier",
+					"auto_proceed": 1,
+				},
+				{
+					"step_name": "Supplier Found",
+					"sequence": 3,
+					"step_type": "Decision",
+					"decision_condition": "bool(supplier)",
+				},
+				{
+					"step_name": "Create Purchase Invoice",
+					"sequence": 4,
+					"step_type": "Action",
+					"action_type": "Server Method",
+					"method_name": method + "create_purchase_invoice",
+					"auto_proceed": 1,
+				},
+			],
+			"outcome_routes": [
+				{
+					"decision_step": "Supplier Found",
+					"outcome_value": "True",
+					"next_step": "Create Purchase Invoice",
+				},
+			],
+		}
+	).insert()
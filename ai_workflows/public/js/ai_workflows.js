@@ -0,0 +1,18 @@
+$(document).on("app_ready", function() {
+    // A streamed AI Query is created before its response arrives: open it
+    // from the Paperless Document it was started on, so its form can follow
+    // the partial results
+    frappe.realtime.on("ai_query_stream_started", (data) => {
+        const route = frappe.get_route();
+        if (route[0] === "Form" && route[1] === "Paperless Document" && route[2] === data.paperless_doc) {
+            frappe.set_route("Form", "AI Query", data.ai_query);
+            return;
+        }
+        frappe.show_alert({
+            message: __("AI Query {0} started", [
+                `<a href="/app/ai-query/${encodeURIComponent(data.ai_query)}">${frappe.utils.escape_html(data.ai_query)}</a>`
+            ]),
+            indicator: "blue"
+        }, 10);
+    });
+});